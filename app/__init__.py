@@ -1,3 +1,4 @@
+import os
 import threading
 
 import socketio
@@ -18,9 +19,27 @@ app.config.from_object(config)
 #    return NotFoundError
 
 # Import a module / component using its blueprint handler variable (mod_auth)
-from app.util.jobs import JobQueue
+from app.util import crypto
+from app.util.devices import DeviceDirectory
+from app.util.jobs import JOB_METRICS_INTERVAL, JobQueue
+from app.util.journal import RatchetJournal
+from app.util.keyring import Keyring
+from app.util.outbox import Outbox
+from app.util.prekeys import PrekeyPool
+from app.util.sessions import SessionCache
 
-job_queue = JobQueue()
+# Move the keys from the per-file pem layout into the keystore
+crypto.migrate_legacy_keys()
+
+job_queue = JobQueue(outbox=Outbox())
+# the jobs not acknowledged before the last shutdown are queued again
+job_queue.restore()
+session_cache = SessionCache(journal=RatchetJournal(crypto.keystore_path / "journal"))
+# the ratchet changes a crash left on the journal reach the keystore before any chat is loaded
+session_cache.recover()
+opk_pool = PrekeyPool()
+keyring = Keyring()
+device_directory = DeviceDirectory()
 
 from app.util.api import Api
 
@@ -35,3 +54,11 @@ import app.modules.user.events
 # Build the database:
 # This will create the database file using SQLAlchemy
 threading.Thread(target=api.job_handler, daemon=True).start()
+threading.Thread(target=session_cache.flush_handler, daemon=True).start()
+threading.Thread(target=crypto.key_pool.refill_handler, daemon=True).start()
+
+metrics_interval = float(os.environ.get("JOB_METRICS_INTERVAL", JOB_METRICS_INTERVAL))
+if metrics_interval > 0:
+    threading.Thread(
+        target=job_queue.metrics_handler, args=(metrics_interval,), daemon=True
+    ).start()
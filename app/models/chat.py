@@ -28,6 +28,12 @@ class Chat:
     ctime: datetime = dc.field(default_factory=lambda: datetime.now(pytz.utc))
     mtime: datetime = dc.field(default_factory=lambda: datetime.now(pytz.utc))
     back_id: ObjectId = dc.field(default=None)
+    # on groups, the chat id of every other member, by telephone, and the owner telephone
+    back_ids: dict[str, ObjectId] = dc.field(default_factory=dict)
+    owner: str = dc.field(default=None)
+    # the chat id on each device of the recipient, by device id
+    devices: dict[str, ObjectId] = dc.field(default_factory=dict)
+    mode: str = dc.field(default="aes-cbc")
     _id: ObjectId = dc.field(default_factory=ObjectId)
 
     def __post_init__ (self) -> None:
@@ -1,5 +1,7 @@
 from app import api, job_queue, sio
+from app.modules.user.events import backlog, replenish_opkeys
 from app.services import user as ussr
+from app.util import wire
 from app.util.jobs import RefreshJob
 
 ResponseData = dict[str, str | dict[str, str]]
@@ -8,6 +10,9 @@ ResponseData = dict[str, str | dict[str, str]]
 def handle_connect () -> None:
     print(f"connection established")
 
+    # the jobs queued while offline are sent right away, in priority order
+    job_queue.wake(api.user_id)
+
 @sio.on("auth_response")
 def handle_auth_response (resp: dict):
     print(resp["msg"])
@@ -15,7 +20,15 @@ def handle_auth_response (resp: dict):
         job_queue.add_job(api.user_id, 0, RefreshJob)
 
     elif resp["status"] == "ok":
-        pass
+        # servers that predate the binary envelope keep receiving json
+        api.wire_format = wire.negotiate_wire([ (resp.get("data") or dict()).get("wire", "") ])
+
+        # the messages received while offline are replayed right after the login
+        backlog.start()
+        replenish_opkeys()
+
+        # the jobs refused while offline are sent again without waiting their backoff
+        job_queue.wake(api.user_id)
 
     else:
         api.logout()
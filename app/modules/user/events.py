@@ -1,17 +1,48 @@
+import threading
 from typing import Union
 
+from bson import ObjectId
+from cryptography.exceptions import InvalidTag
+
 import app.util.jobs as jobs
-from app import api, job_queue, sio
+from app import (api, device_directory, job_queue, keyring, opk_pool, session_cache,
+                 sio)
 from app.models.chat import Chat
 from app.models.user import User
 from app.services import chat as chsr
 from app.services import user as ussr
-from app.util import crypto
+from app.util import attachments, crypto, devices, groups, wire
+from app.util.acks import AckBatcher
+from app.util.backlog import BacklogDrain
 
 ResponseData = dict[str, Union[str, dict[str, str]]]
 
+incoming_attachments: dict[str, attachments.IncomingAttachment] = dict()
+
+def message_header (data: dict[str, str]) -> crypto.MessageHeader:
+    return crypto.MessageHeader(
+        data["dh_ratchet"],
+        data.get("counter", None),
+        data.get("mode", crypto.CBC_MODE),
+        data["sender"]["chat_id"]
+    )
+
+def replenish_opkeys () -> None:
+    if not opk_pool.low():
+        return
+
+    def replenish () -> None:
+        try:
+            print(f"Uploaded {api.replenish_opkeys()} one time prekeys")
+
+        except Exception as exc:
+            print(f"Failed to replenish the one time prekeys: {exc}")
+
+    threading.Thread(target=replenish, daemon=True).start()
+
 @sio.on("create-chat")
 def handle_create_chat (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
     print(resp["msg"])
 
     if resp["status"] == "pending":
@@ -29,13 +60,31 @@ def handle_create_chat (resp: ResponseData) -> None:
 
             ussr.insert_user(owner)
 
+        # on groups, the other members invited along with the user
+        members = [
+            telephone for telephone in data.get("users", [])
+            if telephone not in (user.telephone, owner.telephone)
+        ]
+
         chat = Chat(
             back_id=data["owner"]["chat_id"],
-            users=[ owner.telephone ],
+            users=[ owner.telephone ] + members,
             name=data["name"],
-            desc=data.get("description", "default description")
+            desc=data.get("description", "default description"),
+            mode=crypto.negotiate_mode(data.get("modes", [ crypto.CBC_MODE ]))
         )
 
+        # one to one chats keep a session for each device of the other user
+        owner_device = None
+
+        if groups.is_group(chat):
+            chat.owner = owner.telephone
+            chat.back_ids = { owner.telephone: chat.back_id }
+
+        elif data["owner"].get("device", None) is not None:
+            owner_device = data["owner"]["device"]
+            chat.devices = { owner_device: chat.back_id }
+
         chsr.insert_chat(chat)
 
         print({
@@ -50,19 +99,26 @@ def handle_create_chat (resp: ResponseData) -> None:
         dh_ratchet_key = data["user"]["used_keys"][0]
 
         pvt_keys = {
-            "IK": crypto.load_private_key("id_key"),
-            "SPK": crypto.load_private_key("sgn_key"),
-            "OPK": crypto.load_private_key(f"{opkey}_opk")
+            "IK": keyring.load("id_key"),
+            "SPK": keyring.load("sgn_key"),
+            "OPK": opk_pool.load(opkey)
         }
-        dh_ratchet = crypto.load_private_key(f"{dh_ratchet_key}_opk")
+        dh_ratchet = opk_pool.load(dh_ratchet_key)
         user_ratchet = data["user"]["dh_ratchet"]
         root_ratchet = crypto.create_chat_encryption(
             pvt_keys, data["owner"]["keys"]["pb_keys"], sender=False
         )
 
-        crypto.save_ratchet(chat._id, "dh_ratchet", dh_ratchet)
-        crypto.save_ratchet(chat._id, "user_ratchet", user_ratchet)
-        crypto.save_ratchet(chat._id, "root_ratchet", root_ratchet)
+        session_id = devices.device_session(groups.session_id(chat, owner.telephone), owner_device)
+        session_cache.save_ratchets(session_id, {
+            "dh_ratchet": dh_ratchet,
+            "dh_public": None,
+            "user_ratchet": user_ratchet,
+            "root_ratchet": root_ratchet
+        })
+
+        opk_pool.consume(data["user"]["used_keys"])
+        replenish_opkeys()
 
         try:
             data = {
@@ -73,10 +129,12 @@ def handle_create_chat (resp: ResponseData) -> None:
                         "telephone": data["owner"]["telephone"],
                         "chat_id": data["owner"]["chat_id"]
                     },
+                    "mode": chat.mode,
                     "user": {
                         "name": user.name,
                         "telephone": user.telephone,
                         "chat_id": str(chat._id),
+                        "device": device_directory.local_device(),
                         "keys": {
                             "dh_ratchet": crypto.public_key(dh_ratchet),
                             "OPK": crypto.public_key(pvt_keys["OPK"]),
@@ -86,7 +144,7 @@ def handle_create_chat (resp: ResponseData) -> None:
                     },
                 }
             }
-            sio.emit("confirm-create-chat", data)
+            api.emit("confirm-create-chat", data)
 
         except ConnectionRefusedError:
             print(f"Retry to send the confirmation of the creation of the chat {chat._id}")
@@ -96,104 +154,438 @@ def handle_create_chat (resp: ResponseData) -> None:
             print(f"Unkown error happened creating the chat {chat._id}")
             raise exc
 
+        # the owner relays the sender key of the user to the other members
+        if groups.is_group(chat):
+            sender_key = groups.create_sender_key()
+            session_cache.save_ratchets(groups.group_record(chat._id), sender_key)
+
+            api.send_sender_key(
+                chat, owner.telephone, user.telephone, sender_key[groups.SENDER_CHAIN],
+                sender_key[groups.SENDER_SIGNING].public_key(), chat._id
+            )
+
 @sio.on("confirm-create-chat")
 def confirm_create_chat (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
     print(resp["msg"])
 
     if resp["status"] == "ok":
-        data = resp["data"]
+        confirm_chat(resp["data"])
 
-        user = ussr.find_with_telephone(data["user"]["telephone"])
+def confirm_chat (data: ResponseData) -> None:
+    user = ussr.find_with_telephone(data["user"]["telephone"])
 
-        user_name = data["user"]["name"]
-        if user.name == "default user" and user.name != user_name:
-            ussr.update_user_name(user._id, user_name)
+    user_name = data["user"]["name"]
+    if user.name == "default user" and user.name != user_name:
+        ussr.update_user_name(user._id, user_name)
 
-        chsr.update_back_id(
-            data["owner"]["chat_id"], data["user"]["chat_id"]
-        )
-        chat = chsr.find_with_id(data["owner"]["chat_id"])
+    chat = chsr.find_with_id(data["owner"]["chat_id"])
+    user_device = data["user"].get("device", None)
 
-        eph_key = crypto.load_private_key(f"eph-{chat._id}-{api.user_id}")
-        dh_ratchet = crypto.load_private_key(f"dhr-{chat._id}-{api.user_id}")
+    if groups.is_group(chat):
+        chsr.update_back_ids(chat._id, user.telephone, data["user"]["chat_id"])
+        user_device = None
 
-        user_ratchet = data["user"]["keys"].pop("dh_ratchet")
-        user_keys = data["user"]["keys"]
-        root_ratchet = crypto.create_chat_encryption(
-            { "IK": api.id_key, "EK": eph_key }, pb_keys=user_keys, sender=True
+    else:
+        chsr.update_back_id(chat._id, data["user"]["chat_id"])
+
+        # every device of the user confirms the chat with its own keys
+        if user_device is not None:
+            chsr.update_devices(chat._id, user_device, data["user"]["chat_id"])
+
+    chsr.update_mode(chat._id, data.get("mode", crypto.CBC_MODE))
+    chat = chsr.find_with_id(chat._id)
+
+    eph_key = crypto.load_private_key(f"eph-{chat._id}-{api.user_id}")
+    dh_ratchet = crypto.load_private_key(f"dhr-{chat._id}-{api.user_id}")
+
+    user_ratchet = data["user"]["keys"].pop("dh_ratchet")
+    user_keys = data["user"]["keys"]
+    root_ratchet = crypto.create_chat_encryption(
+        { "IK": keyring.load("id_key"), "EK": eph_key }, pb_keys=user_keys, sender=True
+    )
+
+    print({
+        "chat": {
+            "name": chat.name,
+            "bob-id": chat.back_id,
+            "id": chat._id,
+        }
+    })
+
+    session_id = devices.device_session(groups.session_id(chat, user.telephone), user_device)
+    session_cache.save_ratchets(session_id, {
+        "dh_ratchet": dh_ratchet,
+        "dh_public": None,
+        "user_ratchet": user_ratchet,
+        "root_ratchet": root_ratchet
+    })
+
+    if not groups.is_group(chat):
+        # the keys of the creation are kept until every known device confirmed
+        known = device_directory.load(user.telephone)
+
+        if user_device is None or known is None or set(known) <= set(chat.devices):
+            crypto.clean_chat_keys(chat._id, api.user_id)
+
+        return
+
+    # the keys of the creation are shared by every member, until the last one joins
+    if set(chat.users) <= set(chat.back_ids):
+        crypto.clean_chat_keys(chat._id, api.user_id)
+
+    ratchets, _ = session_cache.load_ratchets(groups.group_record(chat._id))
+    owner = ussr.find_with_id(api.user_id)
+
+    # the new member receives the sender key of the owner and of every member known
+    api.send_sender_key(
+        chat, user.telephone, owner.telephone, ratchets[groups.SENDER_CHAIN],
+        ratchets[groups.SENDER_SIGNING].public_key(), chat._id
+    )
+
+    for member, (chain, sgn_key) in groups.member_keys(ratchets).items():
+        if member != user.telephone:
+            api.send_sender_key(
+                chat, user.telephone, member, chain, sgn_key, chat.back_ids[member]
+            )
+
+def confirm_chats (confirmations: list[ResponseData]) -> None:
+    # the chats of a batch are read, updated and cleaned at once
+    chats = {
+        str(chat._id): chat for chat in chsr.find_many_with_ids([
+            data["owner"]["chat_id"] for data in confirmations
+        ])
+    }
+    users = {
+        user.telephone: user for user in ussr.find_many([
+            data["user"]["telephone"] for data in confirmations
+        ])
+    }
+    id_key = keyring.load("id_key")
+
+    updates = dict()
+    sessions = dict()
+    confirmed = []
+
+    for data in confirmations:
+        chat = chats.get(str(data["owner"]["chat_id"]), None)
+
+        # the members of a group get the sender keys, chat by chat
+        if chat is None or groups.is_group(chat):
+            confirm_chat(data)
+            continue
+
+        user = users.get(data["user"]["telephone"], None)
+        if user is not None and user.name == "default user" and user.name != data["user"]["name"]:
+            ussr.update_user_name(user._id, data["user"]["name"])
+
+        user_device = data["user"].get("device", None)
+        update = updates.setdefault(chat._id, dict())
+        update["back_id"] = ObjectId(data["user"]["chat_id"])
+        update["mode"] = data.get("mode", crypto.CBC_MODE)
+
+        if user_device is not None:
+            update[f"devices.{user_device}"] = ObjectId(data["user"]["chat_id"])
+            chat.devices[user_device] = data["user"]["chat_id"]
+
+        user_keys = dict(data["user"]["keys"])
+        user_ratchet = user_keys.pop("dh_ratchet")
+        root_ratchet = crypto.create_chat_encryption({
+            "IK": id_key,
+            "EK": crypto.load_private_key(f"eph-{chat._id}-{api.user_id}")
+        }, pb_keys=user_keys, sender=True)
+
+        sessions[devices.device_session(chat._id, user_device)] = {
+            "dh_ratchet": crypto.load_private_key(f"dhr-{chat._id}-{api.user_id}"),
+            "dh_public": None,
+            "user_ratchet": user_ratchet,
+            "root_ratchet": root_ratchet
+        }
+
+        known = device_directory.load(data["user"]["telephone"])
+        if user_device is None or known is None or set(known) <= set(chat.devices):
+            confirmed.append(chat._id)
+
+    session_cache.save_sessions(sessions)
+    chsr.update_chats(updates)
+    crypto.clean_chats_keys(confirmed, api.user_id)
+
+    print(f"{len(sessions)} chats confirmed")
+
+@sio.on("confirm-create-chats")
+def confirm_create_chats (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
+    print(resp["msg"])
+
+    # the confirmations of the chats created in bulk arrive in batches
+    if resp["status"] == "ok":
+        confirm_chats(resp["data"])
+
+@sio.on("sender-key")
+def handle_sender_key (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
+    print(resp["msg"])
+
+    if resp["status"] == "pending":
+        data = resp["data"]
+        chat = chsr.find_with_id(data["receiver"]["chat_id"])
+        telephone = data["sender"]["telephone"]
+        session_id = groups.session_id(chat, telephone)
+
+        ratchets, pbkey = session_cache.load_ratchets(session_id)
+        ratchets["user_ratchet"] = pbkey
+
+        cipher = data["cipher"]
+        if isinstance(cipher, str):
+            cipher = crypto.encode_b64(cipher)
+
+        packed = crypto.rcv_msg(ratchets, message_header(data), cipher, chat.mode)
+        session_cache.save_ratchets(session_id, ratchets)
+
+        chain, sgn_key, member_chat_id = groups.unpack_sender_key(
+            packed[ : groups.SENDER_KEY.size ]
         )
+        member = bytes(packed[ groups.SENDER_KEY.size : ]).decode("utf-8")
 
-        print({
-            "chat": {
-                "name": chat.name,
-                "bob-id": chat.back_id,
-                "id": chat._id,
-            }
+        session_cache.save_ratchets(groups.group_record(chat._id), {
+            f"chain-{member}": chain,
+            f"sgn-{member}": sgn_key
         })
 
-        crypto.save_ratchet(chat._id, "dh_ratchet", dh_ratchet)
-        crypto.save_ratchet(chat._id, "user_ratchet", user_ratchet)
-        crypto.save_ratchet(chat._id, "root_ratchet", root_ratchet)
+        if member not in chat.back_ids:
+            chsr.update_back_ids(chat._id, member, member_chat_id)
+            chat.back_ids[member] = member_chat_id
 
-        crypto.clean_chat_keys(chat._id, api.user_id)
+        # the owner relays the key of a member to every other member already joined
+        if chat.owner is None and member == telephone:
+            for other in chat.back_ids:
+                if other != member:
+                    api.send_sender_key(chat, other, member, chain, sgn_key, member_chat_id)
 
-@sio.on("message")
-def handle_message (resp: ResponseData) -> None:
+@sio.on("group-message")
+def handle_group_message (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
     print(resp["msg"])
 
     if resp["status"] == "pending":
         data = resp["data"]
+        record = groups.group_record(data["receiver"]["chat_id"])
 
-        receiver = ussr.find_with_id(api.user_id)
-        chat_id = data["receiver"]["chat_id"]
+        cipher = data["cipher"]
+        if isinstance(cipher, str):
+            cipher = crypto.encode_b64(cipher)
+
+        signature = data["signature"]
+        if isinstance(signature, str):
+            signature = crypto.encode_b64(signature)
 
-        cipher = crypto.encode_b64(data["cipher"])
-        pbkey = crypto.load_public_key(data["dh_ratchet"])
-        ratchets, _ = crypto.load_ratchets(chat_id)
+        header = crypto.MessageHeader(
+            data["dh_ratchet"], data["counter"], data.get("mode", crypto.GCM_MODE),
+            data["group_id"]
+        )
+
+        ratchets, _ = session_cache.load_ratchets(record)
+        msg = groups.rcv_group_msg(
+            ratchets, data["sender"]["telephone"], header, cipher, signature
+        )
+        session_cache.save_ratchets(record, ratchets)
 
-        msg = crypto.rcv_msg(ratchets, pbkey, cipher)
         print("decoded message -> ", msg.decode("utf-8"))
 
-        ratchets.pop("rcv_ratchet", None)
+def receive_messages (chat_id: str, messages: list[ResponseData]) -> dict | None:
+    # the ratchets of the chat are loaded and saved once for the whole batch
+    ratchets, pbkey = session_cache.load_ratchets(chat_id)
+    ratchets["user_ratchet"] = pbkey
+
+    if "dh_ratchet" not in ratchets:
+        print(f"No session for the chat {chat_id}, its messages are left unconfirmed")
+
+        return None
 
-        ratchets["user_ratchet"] = data["dh_ratchet"]
-        for ratchet_name, ratchet in ratchets.items():
-            crypto.save_ratchet(chat_id, ratchet_name, ratchet)
+    chat = chsr.find_with_id(messages[0]["receiver"]["chat_id"])
+    if chat is None:
+        print(f"Unknown chat {chat_id}, its messages are left unconfirmed")
 
+        return None
+
+    acks = []
+    for data in messages:
         try:
+            cipher = data["cipher"]
+            if isinstance(cipher, str):
+                cipher = crypto.encode_b64(cipher)
+
+            msg = crypto.rcv_msg(ratchets, message_header(data), cipher, chat.mode)
+            print("decoded message -> ", msg.decode("utf-8"))
+
+            acks.append(data.get("message_id", None))
+
+        except Exception as exc:
+            print(f"Failed to decode a message of the chat {chat_id}: {exc}")
+
+    # the messages that failed left the ratchets untouched, nothing to save nor confirm
+    if len(acks) == 0:
+        return None
+
+    session_cache.save_ratchets(chat_id, ratchets)
+
+    return {
+        "sender": messages[-1]["sender"],
+        "receiver": messages[-1]["receiver"],
+        "dh_ratchet": crypto.dh_public_key(ratchets),
+        "acks": acks
+    }
+
+def confirm_messages (confirmations: list[dict]) -> None:
+    receiver = ussr.find_with_id(api.user_id)
+
+    try:
+        if len(confirmations) == 1:
+            api.emit("confirm-message", {
+                "Signed-Message": api.sign_message(),
+                "telephone": receiver.telephone,
+                "body": confirmations[0]
+            })
+
+        else:
+            # a drained backlog is acknowledged with a single event
+            api.emit("confirm-messages", {
+                "Signed-Message": api.sign_message(),
+                "telephone": receiver.telephone,
+                "body": confirmations
+            })
+
+    except ConnectionRefusedError:
+        print("Retry to send the confirmation of the message received")
+
+        for confirmation in confirmations:
             data = {
                 "Signed-Message": api.sign_message(),
                 "telephone": receiver.telephone,
-                "body": {
-                    "sender": data["sender"],
-                    "receiver": data["receiver"],
-                    "dh_ratchet": crypto.public_key(ratchets["dh_ratchet"])
-                }
+                "body": confirmation
             }
-            sio.emit("confirm-message", data)
+            chat_id = confirmation["receiver"]["chat_id"]
 
-        except ConnectionRefusedError:
-            print("Retry to send the confirmation of the message received")
             job_queue.add_job(api.user_id, 2, jobs.ConfirmMessageJob, data=data, chat_id=chat_id)
 
-        except Exception as exc:
-            print("Unkown error happened")
-            raise exc
+    except Exception as exc:
+        print("Unkown error happened")
+        raise exc
+
+backlog = BacklogDrain(receive_messages, confirm_messages)
+# the messages received one by one are confirmed together, a few at a time
+ack_batcher = AckBatcher(confirm_messages)
+
+@sio.on("message")
+def handle_message (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
+    print(resp["msg"])
+
+    if resp["status"] == "pending":
+        data = resp["data"]
+        session_id = devices.device_session(
+            data["receiver"]["chat_id"], data["sender"].get("device", None)
+        )
+
+        # while the server replays the backlog, the messages are decrypted in bulk
+        if backlog.add(session_id, data):
+            return
+
+        confirmation = receive_messages(session_id, [data])
+        if confirmation is not None:
+            ack_batcher.add(confirmation)
+
+@sio.on("attachment")
+def handle_attachment (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
+    print(resp["msg"])
+
+    # the attachments that stopped receiving chunks are dropped, closing their files
+    attachments.expire_attachments(incoming_attachments)
+
+    if resp["status"] == "pending":
+        data = resp["data"]
+        chat_id = data["receiver"]["chat_id"]
+        chat = chsr.find_with_id(chat_id)
+
+        session_id = devices.device_session(chat_id, data["sender"].get("device", None))
+
+        header = message_header(data)
+        ratchets, pbkey = session_cache.load_ratchets(session_id)
+        ratchets["user_ratchet"] = pbkey
+
+        cipher = data["cipher"]
+        if isinstance(cipher, str):
+            cipher = crypto.encode_b64(cipher)
+
+        key, init_vector = crypto.rcv_key(ratchets, header, chat.mode)
+        file_name = crypto.decrypt(key, init_vector, cipher, header).decode("utf-8")
+
+        session_cache.save_ratchets(session_id, ratchets)
+
+        incoming_attachments[data["attachment_id"]] = attachments.IncomingAttachment(
+            data["attachment_id"],
+            crypto.attachment_key(key, init_vector),
+            attachments.attachment_path(chat_id, data["attachment_id"], file_name),
+            data["chunk_size"]
+        )
+
+@sio.on("attachment-chunk")
+def handle_attachment_chunk (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
+    attachments.expire_attachments(incoming_attachments)
+
+    if resp["status"] == "pending":
+        data = resp["data"]
+        attachment = incoming_attachments.get(data["attachment_id"], None)
+
+        if attachment is None:
+            print(f"Chunk of unknown attachment {data['attachment_id']}")
+            return
+
+        chunk = data["chunk"]
+        if isinstance(chunk, str):
+            chunk = crypto.encode_b64(chunk)
+
+        try:
+            if attachment.write_chunk(data["index"], chunk, data["final"]):
+                incoming_attachments.pop(data["attachment_id"])
+                print(f"attachment saved at {attachment.file_path}")
+
+        except InvalidTag:
+            print(f"Tampered chunk on attachment {data['attachment_id']}, discarding it")
+
+            incoming_attachments.pop(data["attachment_id"])
+            attachment.abort()
 
 @sio.on("confirm-message")
 def handle_confirm_message (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
     print(resp["msg"])
 
+    # the ratchets are saved as soon as the message is sent, the confirmation
+    # only acknowledges its delivery
     if resp["status"] == "ok":
-        data = resp["data"]
-        tmp_ratchets, _ = crypto.load_ratchets(data["sender"]["chat_id"], tmp=True)
+        confirmations = resp["data"] if isinstance(resp["data"], list) else [ resp["data"] ]
+
+        # a batched confirmation acknowledges every message received since the last one
+        for data in confirmations:
+            delivered = len(data.get("acks", None) or [ None ])
+            print(f"{delivered} messages delivered to chat {data['receiver']['chat_id']}")
 
-        ratchets = { "user_ratchet": data["dh_ratchet"] }
-        for key, value in tmp_ratchets.items():
-            ratchet_name = key.removeprefix("tmp-")
+@sio.on("confirm-messages")
+def handle_confirm_messages (resp: ResponseData) -> None:
+    handle_confirm_message(resp)
 
-            crypto.delete_ratchet(data["sender"]["chat_id"], ratchet_name, tmp=True)
-            ratchets[ratchet_name] = value
+@sio.on("device-change")
+def handle_device_change (resp: ResponseData) -> None:
+    resp = wire.payload(resp)
+    print(resp["msg"])
+
+    # the cached devices of the user are dropped, and replaced if the server sent them
+    if resp["status"] == "pending":
+        data = resp["data"]
+        device_directory.invalidate(data["telephone"])
 
-        for ratchet_name, ratchet in ratchets.items():
-            crypto.save_ratchet(data["sender"]["chat_id"], ratchet_name, ratchet)
\ No newline at end of file
+        if data.get("devices", None) is not None:
+            device_directory.store(data["telephone"], data["devices"])
@@ -1,4 +1,7 @@
+from typing import Any
+
 from bson import ObjectId
+from pymongo import UpdateOne
 
 from app.models.chat import Chat, Message
 from app.util import config, mongodb
@@ -19,11 +22,36 @@ def find_with_id (chat_id: ObjectId) -> Chat:
 
     return Chat(**result)
 
+def find_many_with_ids (chat_ids: list[ObjectId]) -> list[Chat]:
+    mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
+
+    chats = []
+    for result in mdb.find_many({ "_id": {"$in": [ ObjectId(chat_id) for chat_id in chat_ids ]} }):
+        result["messages"] = [
+            Message(**key) for key in result.get("messages", ())
+        ]
+        chats.append(Chat(**result))
+
+    return chats
+
 def insert_chat (chat: Chat) -> None:
     mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
 
     mdb.insert_one(chat.to_insert())
 
+def insert_chats (chats: list[Chat]) -> None:
+    mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
+
+    mdb.insert_many([ chat.to_insert() for chat in chats ])
+
+def update_chats (updates: dict[ObjectId, dict[str, Any]]) -> bool:
+    mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
+
+    return mdb.bulk_write([
+        UpdateOne({ "_id": ObjectId(chat_id) }, { "$set": update_data })
+        for chat_id, update_data in updates.items()
+    ])
+
 def update_back_id (chat_id: ObjectId, back_id: ObjectId) -> bool:
     mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
     if not isinstance(chat_id, ObjectId):
@@ -34,6 +62,36 @@ def update_back_id (chat_id: ObjectId, back_id: ObjectId) -> bool:
         update_data={ "$set": { "back_id": ObjectId(back_id) }}
     )
 
+def update_back_ids (chat_id: ObjectId, telephone: str, back_id: ObjectId) -> bool:
+    mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
+    if not isinstance(chat_id, ObjectId):
+        chat_id = ObjectId(chat_id)
+
+    mdb.update_one(
+        filter={ "_id": chat_id },
+        update_data={ "$set": { f"back_ids.{telephone}": ObjectId(back_id) }}
+    )
+
+def update_devices (chat_id: ObjectId, device: str, back_id: ObjectId) -> bool:
+    mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
+    if not isinstance(chat_id, ObjectId):
+        chat_id = ObjectId(chat_id)
+
+    mdb.update_one(
+        filter={ "_id": chat_id },
+        update_data={ "$set": { f"devices.{device}": ObjectId(back_id) }}
+    )
+
+def update_mode (chat_id: ObjectId, mode: str) -> bool:
+    mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
+    if not isinstance(chat_id, ObjectId):
+        chat_id = ObjectId(chat_id)
+
+    mdb.update_one(
+        filter={ "_id": chat_id },
+        update_data={ "$set": { "mode": mode }}
+    )
+
 def init_chat_db () -> None:
     mdb = mongodb.Mongo(config.MONGO_CONN, config.MONGO_DB, "chat")
 
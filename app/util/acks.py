@@ -0,0 +1,74 @@
+import dataclasses as dc
+import threading
+from collections.abc import Callable
+from typing import Any
+
+# acknowledged ids sent at most in a single confirmation, and seconds one waits for others
+ACK_BATCH = 64
+ACK_DELAY = 0.05
+
+Confirmation = dict[str, Any]
+
+def confirmation_key (confirmation: Confirmation) -> tuple[str, str]:
+    # each device of the sender keeps its own ratchets, so its confirmations are kept apart
+    return (
+        str(confirmation["receiver"]["chat_id"]),
+        confirmation["sender"].get("device", None)
+    )
+
+def merge_confirmations (older: Confirmation, newer: Confirmation) -> Confirmation:
+    # the latest dh ratchet of the chat, with every id acknowledged since the first one
+    return newer | { "acks": list(older.get("acks", [])) + list(newer.get("acks", [])) }
+
+@dc.dataclass()
+class AckBatcher:
+    """
+        Merges the confirmations of the messages received on each chat, sending them
+        once a chat holds enough acknowledged ids or once the oldest one waited long
+        enough, instead of a confirmation for every message.\n
+        :send Callable:     sends the merged confirmations, at once\n
+        :max_acks int:      acknowledged ids that send the confirmation of a chat right away\n
+        :delay float:       seconds the confirmations wait for the others\n
+    """
+    send: Callable[[list[Confirmation]], None]
+    max_acks: int = dc.field(default=ACK_BATCH)
+    delay: float = dc.field(default=ACK_DELAY)
+
+    pending: dict[tuple[str, str], Confirmation] = dc.field(init=False, default_factory=dict)
+
+    _timer: threading.Timer = dc.field(init=False, default=None)
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+
+    def add (self, confirmation: Confirmation) -> None:
+        key = confirmation_key(confirmation)
+
+        with self._lock:
+            if key in self.pending:
+                confirmation = merge_confirmations(self.pending[key], confirmation)
+
+            full = len(confirmation.get("acks", [])) >= self.max_acks
+
+            if full:
+                self.pending.pop(key, None)
+
+            else:
+                self.pending[key] = confirmation
+
+                if self._timer is None:
+                    self._timer = threading.Timer(self.delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if full:
+            self.send([ confirmation ])
+
+    def flush (self) -> None:
+        with self._lock:
+            confirmations, self.pending = list(self.pending.values()), dict()
+
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        if len(confirmations) > 0:
+            self.send(confirmations)
@@ -1,19 +1,23 @@
 import asyncio
 import dataclasses as dc
-import time
+import os
+import threading
+from collections.abc import Callable
 from enum import Enum, auto
 
+from bson import ObjectId
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
-from socketio.exceptions import ConnectionError
+from socketio.exceptions import BadNamespaceError, ConnectionError
 from werkzeug.security import generate_password_hash
 
-from app import job_queue, sio
+from app import (device_directory, job_queue, keyring, opk_pool, session_cache,
+                 sio)
 from app.models.chat import Chat
 from app.models.user import User
 from app.services import chat as chsr
 from app.services import user as ussr
-from app.util import config, crypto, jobs
+from app.util import attachments, config, crypto, devices, groups, jobs, wire
 
 
 class ConnectionResults (Enum):
@@ -31,8 +35,13 @@ class Api:
     id_key: X25519PrivateKey = dc.field(init=False, default=None)
     sgn_key: X25519PrivateKey = dc.field(init=False, default=None)
     ed_key: Ed25519PrivateKey = dc.field(init=False, default=None)
+    wire_format: str = dc.field(init=False, default=wire.JSON_WIRE)
+
+    _emit_lock: threading.Lock = dc.field(init=False, default=None)
 
     def __init__ (self, logged_in: bool = False) -> None:
+        # the binary events span several packets, which the client does not keep together
+        self._emit_lock = threading.Lock()
         self.headers_client = {
             "Param-Auth": config.CHAT_SECRET
         }
@@ -47,17 +56,22 @@ class Api:
 
     def _setup_user (self) -> None:
         self.user_id = config.USER_ID
-        self.id_key = crypto.load_private_key("id_key")
-        self.sgn_key = crypto.load_private_key("sgn_key")
-        self.ed_key = crypto.load_private_key("ed_key")
+
+        # the keys are decrypted once here, every later use reads the keyring
+        keyring.unlock()
+        self.id_key = keyring.load("id_key")
+        self.sgn_key = keyring.load("sgn_key")
+        self.ed_key = keyring.load("ed_key")
 
         self._update_header_user()
 
     def _setdown_user (self) -> None:
         self.user_id = None
+        keyring.lock()
         self.id_key = None
         self.sgn_key = None
         self.ed_key = None
+        self.wire_format = wire.JSON_WIRE
 
         self._update_header_user(logout=True)
 
@@ -73,7 +87,26 @@ class Api:
     def sign_message (self) -> str:
         return crypto.sign_message(self.ed_key)
 
+    def emit (self, event: str, data: dict, callback: Callable = None) -> None:
+        # the binary envelope is only sent once the server accepted it on the login
+        payload = wire.encode(data) if self.wire_format == wire.BINARY_WIRE else wire.to_json(data)
+
+        try:
+            with self._emit_lock:
+                # the callback runs once the server acknowledges the event
+                if callback is not None:
+                    sio.emit(event, payload, callback=callback)
+
+                else:
+                    sio.emit(event, payload)
+
+        except BadNamespaceError:
+            # not connected, the callers queue the request for when the connection is back
+            raise ConnectionRefusedError
+
     def logout (self) -> None:
+        session_cache.flush()
+        session_cache.clear()
         self._setdown_user()
 
         try:
@@ -89,7 +122,7 @@ class Api:
 
             sio.connect(
                 self.base_url,
-                auth={ "telephone": user.telephone },
+                auth={ "telephone": user.telephone, "wire": list(wire.WIRE_FORMATS) },
                 headers=self.headers_user
             )
 
@@ -110,14 +143,12 @@ class Api:
         self.id_key = crypto.generate_private_key("id_key")
         self.sgn_key = crypto.generate_private_key("sgn_key")
         self.ed_key = crypto.generate_private_key("ed_key", sgn_key=True)
+        keyring.unlock({ "id_key": self.id_key, "sgn_key": self.sgn_key, "ed_key": self.ed_key })
 
         id_key = crypto.public_key(self.id_key)
         sgn_key = crypto.public_key(self.sgn_key)
         ed_key = crypto.public_key(self.ed_key)
-        opkeys = [
-            { "id": idx, "key": crypto.public_key(crypto.generate_private_key(f"{idx}_opk")) }
-            for idx in range(1, 11)
-        ]
+        opkeys = opk_pool.generate(opk_pool.batch_size)
 
         try:
             user = User(
@@ -137,7 +168,8 @@ class Api:
                     "id_key": id_key,
                     "sgn_key": sgn_key,
                     "ed_key": ed_key,
-                    "opkeys": opkeys
+                    "opkeys": opkeys,
+                    "wire": list(wire.WIRE_FORMATS)
                 }, headers=self.headers_client
             )
 
@@ -154,6 +186,18 @@ class Api:
 
             return ConnectionResults.FAILED
 
+    def replenish_opkeys (self) -> int:
+        user = ussr.find_with_id(self.user_id)
+
+        # the whole batch of public keys is uploaded in a single event
+        return opk_pool.replenish(lambda opkeys: self.emit("opkeys", {
+            "Signed-Message": self.sign_message(),
+            "telephone": user.telephone,
+            "body": {
+                "opkeys": opkeys
+            }
+        }))
+
     def create_chat (
         self, name: str, users: list[str], description: str = None
     ) -> ConnectionResults:
@@ -167,8 +211,18 @@ class Api:
             )
             chsr.insert_chat(chat)
 
-            eph_key = crypto.generate_private_key(f"eph-{chat._id}-{self.user_id}")
-            dh_ratchet = crypto.generate_private_key(f"dhr-{chat._id}-{self.user_id}")
+            # the sender key of the owner, sent to each member once its pairwise session exists
+            if groups.is_group(chat):
+                session_cache.save_ratchets(
+                    groups.group_record(chat._id), groups.create_sender_key()
+                )
+
+            eph_key, eph_pbkey = crypto.key_pool.take_pair()
+            dh_ratchet, dh_pbkey = crypto.key_pool.take_pair()
+            crypto.save_private_keys({
+                f"eph-{chat._id}-{self.user_id}": eph_key,
+                f"dhr-{chat._id}-{self.user_id}": dh_ratchet
+            })
 
             data = {
                 "Signed-Message": self.sign_message(),
@@ -176,15 +230,17 @@ class Api:
                 "body": {
                     "owner": {
                         "telephone": owner.telephone,
-                        "chat_id": str(chat._id)
+                        "chat_id": str(chat._id),
+                        "device": device_directory.local_device()
                     },
                     "name": name,
                     "users": users,
-                    "dh_ratchet": crypto.public_key(dh_ratchet),
-                    "EK": crypto.public_key(eph_key)
+                    "dh_ratchet": dh_pbkey,
+                    "EK": eph_pbkey,
+                    "modes": list(crypto.CIPHER_MODES)
                 },
             }
-            sio.emit("create-chat", data=data)
+            self.emit("create-chat", data)
 
             return ConnectionResults.SUCESSFUL
 
@@ -199,15 +255,211 @@ class Api:
 
             return ConnectionResults.FAILED
 
+    def send_sender_key (
+        self, chat: Chat, telephone: str, member: str, chain: crypto.SymmetricRatchet,
+        sgn_key: crypto.PublicKey, member_chat_id: str
+    ) -> ConnectionResults:
+        # the sender key of a member travels on the pairwise session with one other member
+        try:
+            owner = ussr.find_with_id(self.user_id)
+            session_id = groups.session_id(chat, telephone)
+
+            ratchets, pbkey = session_cache.load_ratchets(session_id)
+            cipher, header = crypto.snd_msg(
+                ratchets, pbkey,
+                groups.pack_sender_key(chain, sgn_key, member_chat_id) + member.encode("utf-8"),
+                mode=chat.mode, chat_id=str(chat._id)
+            )
+
+            data = {
+                "Signed-Message": self.sign_message(),
+                "telephone": owner.telephone,
+                "body": {
+                    "sender": {
+                        "telephone": owner.telephone,
+                        "chat_id": str(chat._id)
+                    },
+                    "receiver": {
+                        "telephone": telephone,
+                        "chat_id": str(chat.back_ids.get(telephone, chat.back_id))
+                    },
+                    "cipher": cipher,
+                    "dh_ratchet": header.dh_ratchet,
+                    "counter": header.counter,
+                    "mode": header.mode
+                }
+            }
+
+            session_cache.save_ratchets(session_id, ratchets)
+
+            self.emit("sender-key", data)
+
+            return ConnectionResults.SUCESSFUL
+
+        except ConnectionRefusedError:
+            job_queue.add_job(self.user_id, 1, jobs.SenderKeyJob, data=data)
+
+            return ConnectionResults.RETRY
+
+        except Exception as exc:
+            print(exc)
+
+            return ConnectionResults.FAILED
+
+    def _group_message (self, owner: User, chat: Chat, bmsg: bytes) -> dict:
+        # encrypted once with the sender key, whatever the number of members
+        ratchets, _ = session_cache.load_ratchets(groups.group_record(chat._id))
+        cipher, header, signature = groups.snd_group_msg(
+            ratchets, bmsg, chat_id=groups.group_id(chat)
+        )
+
+        session_cache.save_ratchets(groups.group_record(chat._id), ratchets)
+
+        return {
+            "Signed-Message": self.sign_message(),
+            "telephone": owner.telephone,
+            "body": {
+                "sender": {
+                    "telephone": owner.telephone,
+                    "chat_id": str(chat._id)
+                },
+                "group_id": groups.group_id(chat),
+                "receivers": [
+                    { "telephone": telephone, "chat_id": str(back_id) }
+                    for telephone, back_id in chat.back_ids.items()
+                ],
+                "message_id": str(ObjectId()),
+                "cipher": cipher,
+                "dh_ratchet": header.dh_ratchet,
+                "counter": header.counter,
+                "mode": header.mode,
+                "signature": signature
+            }
+        }
+
+    def create_chats (
+        self, telephones: list[str], name: str = None, description: str = None
+    ) -> ConnectionResults:
+        # a chat with each contact, created with a single insert, key write and handshake
+        try:
+            owner = ussr.find_with_id(self.user_id)
+
+            chats = [
+                Chat(name=name or telephone, users=[ telephone ], desc=description)
+                for telephone in telephones
+            ]
+            chsr.insert_chats(chats)
+
+            eph_keys = { chat._id: crypto.key_pool.take_pair() for chat in chats }
+            dh_ratchets = { chat._id: crypto.key_pool.take_pair() for chat in chats }
+            crypto.save_private_keys({
+                f"{prefix}-{chat_id}-{self.user_id}": pvt_key
+                for prefix, key_pairs in (("eph", eph_keys), ("dhr", dh_ratchets))
+                for chat_id, (pvt_key, _) in key_pairs.items()
+            })
+
+            data = {
+                "Signed-Message": self.sign_message(),
+                "telephone": owner.telephone,
+                "body": {
+                    "owner": {
+                        "telephone": owner.telephone,
+                        "device": device_directory.local_device()
+                    },
+                    "chats": [
+                        {
+                            "chat_id": str(chat._id),
+                            "name": chat.name,
+                            "users": chat.users,
+                            "dh_ratchet": dh_ratchets[chat._id][1],
+                            "EK": eph_keys[chat._id][1]
+                        } for chat in chats
+                    ],
+                    "modes": list(crypto.CIPHER_MODES)
+                },
+            }
+            self.emit("create-chats", data)
+
+            return ConnectionResults.SUCESSFUL
+
+        except ConnectionRefusedError:
+            print("Retry creating the chatrooms")
+            job_queue.add_job(self.user_id, 1, jobs.CreateChatsJob, data=data)
+
+            return ConnectionResults.RETRY
+
+        except Exception as exc:
+            print(exc)
+
+            return ConnectionResults.FAILED
+
+    def _device_message (
+        self, owner: User, chat: Chat, bmsg: bytes, targets: dict[str, ObjectId]
+    ) -> dict:
+        def encrypt (device: str) -> dict:
+            session_id = devices.device_session(chat._id, device)
+
+            ratchets, pbkey = session_cache.load_ratchets(session_id)
+            cipher, header = crypto.snd_msg(
+                ratchets, pbkey, bmsg, mode=chat.mode, chat_id=str(chat._id)
+            )
+            session_cache.save_ratchets(session_id, ratchets)
+
+            return {
+                "device": device,
+                "chat_id": str(targets[device]),
+                "cipher": cipher,
+                "dh_ratchet": header.dh_ratchet,
+                "counter": header.counter,
+                "mode": header.mode
+            }
+
+        # a single envelope, the server hands each device its own cipher
+        return {
+            "Signed-Message": self.sign_message(),
+            "telephone": owner.telephone,
+            "body": {
+                "sender": {
+                    "telephone": owner.telephone,
+                    "chat_id": str(chat._id),
+                    "device": device_directory.local_device()
+                },
+                "receiver": {
+                    "telephone": chat.users[0],
+                    "chat_id": str(chat.back_id)
+                },
+                "message_id": str(ObjectId()),
+                "devices": device_directory.encrypt_for(list(targets), encrypt)
+            }
+        }
+
     def send_message (self, chat_id: int, msg: str, debug: bool = False) -> ConnectionResults:
+        # the job that sends the message again, on the same event, if it is refused
+        job_class = jobs.SendMessageJob
+
         try:
             owner = ussr.find_with_id(self.user_id)
             chat = chsr.find_with_id(chat_id)
 
-            ratchets, pbkey = crypto.load_ratchets(chat_id)
+            if groups.is_group(chat):
+                job_class = jobs.GroupMessageJob
+                data = self._group_message(owner, chat, bytes(msg, encoding="utf-8"))
+                self.emit("group-message", data)
+
+                return ConnectionResults.SUCESSFUL
+
+            # chats created before the devices were known keep a single session
+            targets = device_directory.targets(chat.users[0], chat.devices)
+            if len(targets) > 0:
+                data = self._device_message(owner, chat, bytes(msg, encoding="utf-8"), targets)
+                self.emit("message", data)
+
+                return ConnectionResults.SUCESSFUL
+
+            ratchets, pbkey = session_cache.load_ratchets(chat_id)
             bmsg = bytes(msg, encoding="utf-8")
-            cipher, new_ratchet_pbkey = crypto.snd_msg(
-                ratchets, pbkey, bmsg
+            cipher, header = crypto.snd_msg(
+                ratchets, pbkey, bmsg, mode=chat.mode, chat_id=str(chat._id)
             )
 
             if debug:
@@ -225,21 +477,24 @@ class Api:
                         "telephone": chat.users[0],
                         "chat_id": str(chat.back_id)
                     },
-                    "cipher": crypto.decode_b64(cipher),
-                    "dh_ratchet": new_ratchet_pbkey
+                    "message_id": str(ObjectId()),
+                    "cipher": cipher,
+                    "dh_ratchet": header.dh_ratchet,
+                    "counter": header.counter,
+                    "mode": header.mode
                 }
             }
-            sio.send(data)
 
-            ratchets.pop("snd_ratchet", None)
-            ratchets.pop("user_ratchet", None)
-            for ratchet_name, ratchet in ratchets.items():
-                crypto.save_ratchet(chat_id, ratchet_name, ratchet, tmp=True)
+            # the message counter lets the receiver follow the chain, even if a
+            # message is lost, so the ratchets no longer wait for the confirmation
+            session_cache.save_ratchets(chat_id, ratchets)
+
+            self.emit("message", data)
 
             return ConnectionResults.SUCESSFUL
 
         except ConnectionRefusedError:
-            job_queue.add_job(self.user_id, 2, jobs.SendMessageJob, data, chat._id)
+            job_queue.add_job(self.user_id, 2, job_class, data, chat._id)
 
             return ConnectionResults.RETRY
 
@@ -248,12 +503,99 @@ class Api:
 
             return ConnectionResults.FAILED
 
-    async def _job_handler (self) -> None:
-        while True:
-            if self.user_id != -1:
-                job_queue.resolve_jobs(self.user_id)
-                time.sleep(5)
+    def send_attachment (
+        self, chat_id: int, file_path: str, chunk_size: int = attachments.CHUNK_SIZE
+    ) -> ConnectionResults:
+        try:
+            owner = ussr.find_with_id(self.user_id)
+            chat = chsr.find_with_id(chat_id)
+            signed_message = self.sign_message()
+
+            # the chunks are sealed once, with a key of the session of a single device
+            device = next(iter(device_directory.targets(chat.users[0], chat.devices)), None)
+            session_id = devices.device_session(chat_id, device)
+
+            ratchets, pbkey = session_cache.load_ratchets(session_id)
+            key, init_vector, header = crypto.snd_key(
+                ratchets, pbkey, mode=chat.mode, chat_id=str(chat._id)
+            )
+
+            attachment_id = str(ObjectId())
+            file_name = bytes(os.path.basename(file_path), encoding="utf-8")
+            receiver = {
+                "telephone": chat.users[0],
+                "chat_id": str(chat.devices.get(device, chat.back_id))
+            }
+            sender = {
+                "telephone": owner.telephone,
+                "chat_id": str(chat._id)
+            }
+
+            if device is not None:
+                sender["device"] = device_directory.local_device()
+
+            data = {
+                "Signed-Message": signed_message,
+                "telephone": owner.telephone,
+                "body": {
+                    "sender": sender,
+                    "receiver": receiver,
+                    "attachment_id": attachment_id,
+                    "chunk_size": chunk_size,
+                    "cipher": crypto.encrypt(key, init_vector, file_name, header),
+                    "dh_ratchet": header.dh_ratchet,
+                    "counter": header.counter,
+                    "mode": header.mode
+                }
+            }
+
+            session_cache.save_ratchets(session_id, ratchets)
+
+            self.emit("attachment", data)
+
+            # the chunks are read, encrypted and sent one at a time, as binary frames
+            chunk_key = crypto.attachment_key(key, init_vector)
+            for index, chunk, final in attachments.read_chunks(file_path, chunk_size):
+                self.emit("attachment-chunk", {
+                    "Signed-Message": signed_message,
+                    "telephone": owner.telephone,
+                    "body": {
+                        "receiver": receiver,
+                        "attachment_id": attachment_id,
+                        "index": index,
+                        "final": final,
+                        "chunk": crypto.encrypt_chunk(
+                            chunk_key, attachment_id, index, chunk, final
+                        )
+                    }
+                })
+
+            return ConnectionResults.SUCESSFUL
+
+        except ConnectionRefusedError:
+            # the chunks are never kept on memory, so the whole attachment must be resent
+            print(f"Failed to send the attachment {file_path}, send it again")
+
+            return ConnectionResults.FAILED
+
+        except Exception as exc:
+            print(exc)
+
+            return ConnectionResults.FAILED
+
+    def job_handler (self, queue: jobs.JobQueue = None, stop: threading.Event = None) -> None:
+        queue = queue if queue is not None else job_queue
+        loop = asyncio.new_event_loop()
+
+        try:
+            while stop is None or not stop.is_set():
+                # idle until a job is added or due, or the connection comes back, on this
+                # daemon thread, so no worker of the loop is left blocked on the exit
+                queue.wait(self.user_id)
+
+                if self.user_id not in (None, -1):
+                    loop.run_until_complete(queue.run_jobs(self.user_id))
 
-    def job_handler (self) -> None:
-        asyncio.run(self._job_handler())
+        finally:
+            loop.close()
 
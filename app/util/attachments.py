@@ -0,0 +1,102 @@
+import dataclasses as dc
+import os
+import time
+from collections.abc import Iterator
+from pathlib import Path
+from typing import BinaryIO
+
+from app.util import crypto
+
+CHUNK_SIZE = 64 * 1024
+# seconds an attachment waits for its next chunk before it is dropped
+ATTACHMENT_TIMEOUT = 300.0
+
+attachments_path = crypto.base_path / "app/util/attachments"
+
+def read_chunks (
+    file_path: str | Path, chunk_size: int = CHUNK_SIZE
+) -> Iterator[tuple[int, bytes, bool]]:
+    # reads a single chunk ahead, only to know whether the current one is the last
+    with open(file_path, "rb") as attachment_file:
+        index = 0
+        chunk = attachment_file.read(chunk_size)
+
+        while True:
+            next_chunk = attachment_file.read(chunk_size)
+            yield index, chunk, len(next_chunk) == 0
+
+            if len(next_chunk) == 0:
+                return
+
+            index += 1
+            chunk = next_chunk
+
+def attachment_path (chat_id: str, attachment_id: str, file_name: str) -> Path:
+    # the file name comes from the other user, only its last component is kept
+    return attachments_path / f"{chat_id}" / f"{attachment_id}-{Path(file_name).name}"
+
+@dc.dataclass()
+class IncomingAttachment:
+    """
+        Attachment being received, each decrypted chunk is written straight to its
+        position on the file, so only a single chunk is kept on memory.\n
+        :attachment_id str:     id shared by all the chunks of the attachment\n
+        :key bytes:             the chunk key derived from the attachment message key\n
+        :file_path Path:        where the attachment is written\n
+        :chunk_size int:        size of every chunk but the last one\n
+        :updated float:         monotonic time of the last chunk received\n
+    """
+    attachment_id: str
+    key: bytes
+    file_path: Path
+    chunk_size: int = dc.field(default=CHUNK_SIZE)
+
+    received: set[int] = dc.field(init=False, default_factory=set)
+    final_index: int = dc.field(init=False, default=None)
+    file: BinaryIO = dc.field(init=False, default=None)
+    updated: float = dc.field(init=False, default_factory=time.monotonic)
+
+    def __post_init__ (self) -> None:
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.file_path, "wb")
+
+    @property
+    def complete (self) -> bool:
+        return self.final_index is not None and len(self.received) == self.final_index + 1
+
+    def write_chunk (self, index: int, enc_chunk: bytes, final: bool = False) -> bool:
+        chunk = crypto.decrypt_chunk(self.key, self.attachment_id, index, enc_chunk, final)
+
+        self.file.seek(index * self.chunk_size)
+        self.file.write(chunk)
+
+        self.received.add(index)
+        self.updated = time.monotonic()
+        if final:
+            self.final_index = index
+
+        if self.complete:
+            self.file.close()
+
+        return self.complete
+
+    def abort (self) -> None:
+        self.file.close()
+
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+def expire_attachments (
+    incoming: dict[str, IncomingAttachment], timeout: float = ATTACHMENT_TIMEOUT
+) -> int:
+    # the attachments whose sender stopped midway, their partial files are removed
+    now = time.monotonic()
+    expired = [
+        attachment_id for attachment_id, attachment in incoming.items()
+        if now - attachment.updated > timeout
+    ]
+
+    for attachment_id in expired:
+        incoming.pop(attachment_id).abort()
+
+    return len(expired)
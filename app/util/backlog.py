@@ -0,0 +1,106 @@
+import dataclasses as dc
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+DRAIN_QUIET = 0.5
+DRAIN_WORKERS = 8
+
+Message = dict[str, Any]
+ChatHandler = Callable[[str, list[Message]], Any]
+
+@dc.dataclass()
+class BacklogDrain:
+    """
+        Collects the messages replayed by the server after a login, grouped by chat,
+        and decrypts them once the burst is over. Different chats are handled in
+        parallel, while the messages of each chat are handled in arrival order.\n
+        :handler ChatHandler:       handles every message of a chat, returns its ack or None\n
+        :on_drained Callable:       receives the acks of every chat, at once\n
+        :quiet float:               seconds without messages that end the burst\n
+        :max_workers int:           number of chats handled at the same time\n
+    """
+    handler: ChatHandler
+    on_drained: Callable[[list[Any]], None]
+    quiet: float = dc.field(default=DRAIN_QUIET)
+    max_workers: int = dc.field(default=DRAIN_WORKERS)
+
+    pending: dict[str, list[Message]] = dc.field(init=False, default_factory=dict)
+    draining: bool = dc.field(init=False, default=False)
+    last_message: float = dc.field(init=False, default=0.0)
+
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+
+    def start (self) -> None:
+        with self._lock:
+            if self.draining:
+                return
+
+            self.draining = True
+            self.last_message = time.monotonic()
+
+        threading.Thread(target=self._drain_when_quiet, daemon=True).start()
+
+    def add (self, chat_id: str, message: Message) -> bool:
+        with self._lock:
+            if not self.draining:
+                return False
+
+            self.pending.setdefault(str(chat_id), []).append(message)
+            self.last_message = time.monotonic()
+
+            return True
+
+    def _drain_when_quiet (self) -> None:
+        while True:
+            with self._lock:
+                wait = self.quiet - (time.monotonic() - self.last_message)
+
+            if wait <= 0:
+                break
+
+            time.sleep(wait)
+
+        try:
+            self.drain()
+
+        except Exception as exc:
+            print(f"Failed to drain the message backlog: {exc}")
+
+    def drain (self) -> list[Any]:
+        acks = []
+
+        # threads instead of processes, the ratchet keys can not be pickled
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                with self._lock:
+                    batch, self.pending = self.pending, dict()
+
+                    # messages arriving from now on are handled as they come
+                    if len(batch) == 0:
+                        self.draining = False
+                        break
+
+                # a chat is never split between two workers, so its order is kept
+                futures = {
+                    chat_id: executor.submit(self.handler, chat_id, messages)
+                    for chat_id, messages in batch.items()
+                }
+
+                for chat_id, future in futures.items():
+                    # a chat that fails is left out, the others are still acknowledged
+                    try:
+                        ack = future.result()
+
+                    except Exception as exc:
+                        print(f"Failed to drain the backlog of the chat {chat_id}: {exc}")
+                        continue
+
+                    if ack is not None:
+                        acks.append(ack)
+
+        if len(acks) > 0:
+            self.on_drained(acks)
+
+        return acks
@@ -1,6 +1,13 @@
 import base64
+import copy
+import dataclasses as dc
 import os
 import shutil
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Iterable
 from pathlib import Path
 from typing import Union
 
@@ -14,32 +21,264 @@ from cryptography.hazmat.primitives.asymmetric.x25519 import (X25519PrivateKey,
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+from app.util.exc import (CipherModeMismatch, MessageKeyNotFound,
+                          TooManySkippedMessages, UnsupportedCipherMode)
+from app.util.keypool import KEY_POOL_REFILL_RATE, KEY_POOL_SIZE, KeyPool
+from app.util.keystore import (SQLITE_BACKEND, Field, Keystore, SqliteKeystore,
+                               open_keystore)
+
 base_path = Path(__file__).resolve().parent.parent.parent
 ratchets_path = base_path / "app/util/ratchets"
 keys_path = base_path / "app/util/encrypted_keys"
 
 dotenv.load_dotenv(base_path / ".env", override=False)
 
+keystore_path = Path(os.environ.get("KEYSTORE_PATH", base_path / "app/util/keystore"))
+
 ratchets_iter = [
     ("dh_ratchet", "private"), ("root_ratchet", "symmetric"), ("user_ratchet", "public")
 ]
 
+# keystore field types
+PRIVATE_FIELD = 1
+SIGNING_FIELD = 2
+SYMMETRIC_FIELD = 3
+PUBLIC_FIELD = 4
+SKIPPED_FIELD = 5
+COUNTER_FIELD = 6
+VERIFYING_FIELD = 7
+DEVICE_FIELD = 8
+JOB_FIELD = 9
+
+# message cipher modes, in order of preference
+GCM_MODE = "aes-gcm"
+CBC_MODE = "aes-cbc"
+CIPHER_MODES = (GCM_MODE, CBC_MODE)
+
+GCM_NONCE_SIZE = 12
+GCM_TAG_SIZE = 16
+# update_into may write up to a block more than its input
+BLOCK_SIZE = 16
+
+# most message keys a single received message may skip on the receiving chain
+MAX_SKIP = 1000
+# bounds of the skipped message keys kept for each chat
+SKIPPED_KEYS_CAP = 2000
+SKIPPED_KEYS_TTL = 7 * 24 * 60 * 60
+RETIRED_CHAINS_CAP = 4
+
+# most message keys a chain derives ahead of time
+MAX_LOOKAHEAD = 64
+
+# ratchet public key, chain state, chain count, stored at
+RETIRED_CHAIN = struct.Struct("!32s32sId")
+# ratchet public key, message counter, message key, initializing vector, stored at
+SKIPPED_KEY = struct.Struct("!32sI32s16sd")
+
+# the sessions of every chat live in a single database, unless the files backend is chosen
+keystore: Keystore = open_keystore(
+    keystore_path, os.environ.get("KEYSTORE_BACKEND", SQLITE_BACKEND)
+)
+
+# the dh ratchet rotations and the chat creation take their keys from here
+key_pool = KeyPool(
+    int(os.environ.get("KEY_POOL_SIZE", KEY_POOL_SIZE)),
+    float(os.environ.get("KEY_POOL_REFILL_RATE", KEY_POOL_REFILL_RATE))
+)
+
+def wipe (buffer: bytearray) -> None:
+    buffer[ : ] = bytes(len(buffer))
+
 class SymmetricRatchet:
-    def __init__ (self, key: bytes):
+    """
+        A kdf chain. The message chains may derive their next outputs ahead of time,
+        with fill, so next only pops a ready key on the hot path. The state and count
+        always refer to the keys already handed out.
+    """
+    def __init__ (self, key: bytes, count: int = 0):
         self.state = key
+        self.count = count
+        # outputs derived ahead of time, each the next state, key and initializing vector
+        self.lookahead: deque[bytearray] = deque()
+
+        self._lock = threading.Lock()
+
+    def __copy__ (self) -> "SymmetricRatchet":
+        with self._lock:
+            chain = SymmetricRatchet(self.state, self.count)
+            chain.lookahead.extend(bytearray(output) for output in self.lookahead)
+
+        return chain
+
+    def __deepcopy__ (self, memo: dict) -> "SymmetricRatchet":
+        return self.__copy__()
+
+    def move (self) -> "SymmetricRatchet":
+        # the same chain, taking the outputs derived ahead, so no copy of them is left here
+        with self._lock:
+            chain = SymmetricRatchet(self.state, self.count)
+            chain.lookahead, self.lookahead = self.lookahead, deque()
+
+        return chain
+
+    def _wipe_lookahead (self) -> None:
+        while len(self.lookahead) > 0:
+            wipe(self.lookahead.popleft())
+
+    def wipe_lookahead (self) -> None:
+        with self._lock:
+            self._wipe_lookahead()
+
+    def fill (self, size: int) -> int:
+        size = min(size, MAX_LOOKAHEAD)
+        derived = 0
+
+        while True:
+            with self._lock:
+                if len(self.lookahead) >= size:
+                    return derived
+
+                state = self.lookahead[-1][ : 32 ] if len(self.lookahead) > 0 else self.state
+                self.lookahead.append(bytearray(hkdf_derive_key(bytes(state), 80)))
+
+            derived += 1
 
     def next (self, inp: bytes = b"", init_vector: bytes = b"") -> bytes:
-        output = hkdf_derive_key(self.state + inp, 80)
-        self.state = output[ : 32 ]
+        with self._lock:
+            if inp == b"" and len(self.lookahead) > 0:
+                output = self.lookahead.popleft()
+                self.state = bytes(output[ : 32 ])
+                key, init_vector = bytes(output[ 32 : 64 ]), bytes(output[ 64 : ])
+                wipe(output)
+
+            else:
+                # an input forks the chain, the outputs derived ahead no longer follow it
+                self._wipe_lookahead()
+
+                output = hkdf_derive_key(self.state + inp, 80)
+                self.state = output[ : 32 ]
+                key, init_vector = output[ 32 : 64 ], output[ 64: ]
+
+            self.count += 1
+
+        return key, init_vector
+
+class SkippedKeys:
+    """
+        Message keys skipped on the receiving chains, indexed by the ratchet public key and
+        the message counter, so messages delivered late or out of order can be decrypted.
+        The receiving chains replaced by a dh rotation are retired here as well, since
+        messages sent on them may still arrive. A saved store is never changed in place,
+        a message adding or removing a key changes a copy, see stage_skipped_keys.
+    """
+    def __init__ (self):
+        self.keys: OrderedDict[tuple[str, int], tuple[bytes, bytes, float]] = OrderedDict()
+        self.chains: OrderedDict[str, tuple[SymmetricRatchet, float]] = OrderedDict()
+
+    def __len__ (self) -> int:
+        return len(self.keys)
+
+    def evict (self) -> None:
+        expired = time.time() - SKIPPED_KEYS_TTL
+
+        # both dicts are kept in insertion order, so the oldest entries come first
+        while len(self.keys) > 0 and (
+            len(self.keys) > SKIPPED_KEYS_CAP or next(iter(self.keys.values()))[2] < expired
+        ):
+            self.keys.popitem(last=False)
+
+        while len(self.chains) > 0 and (
+            len(self.chains) > RETIRED_CHAINS_CAP or next(iter(self.chains.values()))[1] < expired
+        ):
+            self.chains.popitem(last=False)
+
+    def copy (self) -> "SkippedKeys":
+        # the keys are immutable, only the retired chains move on
+        skipped_keys = SkippedKeys()
+        skipped_keys.keys = OrderedDict(self.keys)
+        skipped_keys.chains = OrderedDict(
+            (pbkey, (copy.copy(chain), stored_at))
+            for pbkey, (chain, stored_at) in self.chains.items()
+        )
+
+        return skipped_keys
+
+    def holds (self, pbkey: str, counter: int) -> bool:
+        return (pbkey, counter) in self.keys
 
-        # key, initializing vector
-        return output[ 32 : 64 ], output[ 64: ]
+    def pop (self, pbkey: str, counter: int) -> tuple[bytes, bytes]:
+        message_key = self.keys.pop((pbkey, counter), None)
+
+        return None if message_key is None else message_key[ : 2 ]
+
+    def retire (self, pbkey: str, chain: SymmetricRatchet) -> None:
+        # only late messages use a retired chain, it needs no keys derived ahead
+        chain.wipe_lookahead()
+        self.chains[pbkey] = (chain, time.time())
+        self.evict()
+
+    def retired (self, pbkey: str) -> SymmetricRatchet:
+        chain = self.chains.get(pbkey, None)
+
+        return None if chain is None else chain[0]
+
+    def skip (self, pbkey: str, chain: SymmetricRatchet, counter: int) -> None:
+        if counter - chain.count > MAX_SKIP:
+            raise TooManySkippedMessages(counter - chain.count)
+
+        now = time.time()
+        while chain.count < counter:
+            key, init_vector = chain.next()
+            self.keys[(pbkey, chain.count - 1)] = (key, init_vector, now)
+
+        self.evict()
+
+    def to_bytes (self) -> bytes:
+        packed = bytearray(struct.pack("!II", len(self.chains), len(self.keys)))
+
+        for pbkey, (chain, stored_at) in self.chains.items():
+            packed += RETIRED_CHAIN.pack(encode_b64(pbkey), chain.state, chain.count, stored_at)
+
+        for (pbkey, counter), (key, init_vector, stored_at) in self.keys.items():
+            packed += SKIPPED_KEY.pack(encode_b64(pbkey), counter, key, init_vector, stored_at)
+
+        return bytes(packed)
+
+    @classmethod
+    def from_bytes (cls, packed: bytes) -> "SkippedKeys":
+        skipped_keys = cls()
+        num_chains, num_keys = struct.unpack_from("!II", packed)
+        offset = 8
+
+        for pbkey, state, count, stored_at in RETIRED_CHAIN.iter_unpack(
+            packed[ offset : offset + num_chains * RETIRED_CHAIN.size ]
+        ):
+            skipped_keys.chains[decode_b64(pbkey)] = (SymmetricRatchet(state, count), stored_at)
+
+        offset += num_chains * RETIRED_CHAIN.size
+        for pbkey, counter, key, init_vector, stored_at in SKIPPED_KEY.iter_unpack(
+            packed[ offset : offset + num_keys * SKIPPED_KEY.size ]
+        ):
+            skipped_keys.keys[(decode_b64(pbkey), counter)] = (key, init_vector, stored_at)
+
+        return skipped_keys
 
 PrivateKey = Union[Ed25519PrivateKey, X25519PrivateKey]
 PublicKey = Union[Ed25519PublicKey, X25519PublicKey]
-Ratchet = Union[ SymmetricRatchet, PrivateKey ]
+Ratchet = Union[ SymmetricRatchet, PrivateKey, SkippedKeys ]
 Key = Union[PrivateKey, PublicKey, SymmetricRatchet]
 
+@dc.dataclass()
+class MessageHeader:
+    dh_ratchet: str
+    counter: int = dc.field(default=None)
+    mode: str = dc.field(default=CBC_MODE)
+    chat_id: str = dc.field(default=None)
+
+    def associated_data (self) -> bytes:
+        # authenticated along with the message on aead modes
+        return f"{self.chat_id}|{self.dh_ratchet}|{self.counter}|{self.mode}".encode("utf-8")
+
 def ensure_dir (file_path: str) -> None:
     directory = os.path.dirname(file_path)
 
@@ -100,9 +339,13 @@ def dh_ratchet_rotation_receive (
     ratchets["rcv_ratchet"] = SymmetricRatchet(shared_recv)
 
 def dh_ratchet_rotation_send (
-    ratchets: dict[str, Ratchet], pbkey: PublicKey
+    ratchets: dict[str, Ratchet], pbkey: PublicKey | str
 ) -> None:
-    ratchets["dh_ratchet"] = X25519PrivateKey.generate()
+    if isinstance(pbkey, str):
+        pbkey = load_public_key(pbkey)
+
+    # the public half comes from the pool as well, no message derives it again
+    ratchets["dh_ratchet"], ratchets["dh_public"] = key_pool.take_pair()
     dh_send = ratchets["dh_ratchet"].exchange(pbkey)
     shared_send = ratchets["root_ratchet"].next(dh_send)[0]
 
@@ -127,29 +370,233 @@ def create_chat_encryption (
 
     return init_root_ratchet(shared_key)
 
-def snd_msg (
-    ratchets: dict[str, Ratchet], pbkey: PublicKey, msg: bytes
-) -> tuple[bytes, PublicKey]:
-    dh_ratchet_rotation_send(ratchets, pbkey)
+def negotiate_mode (modes: list[str]) -> str:
+    # the first mode of this client also supported by the other side
+    for mode in CIPHER_MODES:
+        if mode in modes:
+            return mode
+
+    return CBC_MODE
+
+def gcm_encrypt (key: bytes, nonce: bytes, data: bytes, associated_data: bytes) -> bytearray:
+    encryptor = Cipher(algorithms.AES(key), modes.GCM(nonce)).encryptor()
+    encryptor.authenticate_additional_data(associated_data)
+
+    # the cipher and its tag are written into a single buffer, without padding
+    enc_data = bytearray(len(data) + BLOCK_SIZE - 1 + GCM_TAG_SIZE)
+    size = encryptor.update_into(data, enc_data)
+    encryptor.finalize()
+
+    enc_data[ size : size + GCM_TAG_SIZE ] = encryptor.tag
+    del enc_data[ size + GCM_TAG_SIZE : ]
+
+    return enc_data
+
+def gcm_decrypt (
+    key: bytes, nonce: bytes, enc_data: bytes, associated_data: bytes
+) -> bytearray:
+    enc_view = memoryview(enc_data)
+    decryptor = Cipher(
+        algorithms.AES(key), modes.GCM(nonce, bytes(enc_view[ -GCM_TAG_SIZE : ]))
+    ).decryptor()
+    decryptor.authenticate_additional_data(associated_data)
+
+    data = bytearray(len(enc_view) - GCM_TAG_SIZE + BLOCK_SIZE - 1)
+    size = decryptor.update_into(enc_view[ : -GCM_TAG_SIZE ], data)
+    # raises InvalidTag if the data or its associated data were tampered with
+    decryptor.finalize()
+
+    del data[ size : ]
+
+    return data
+
+def encrypt (
+    key: bytes, init_vector: bytes, msg: bytes, header: MessageHeader
+) -> bytes | bytearray:
+    if header.mode == CBC_MODE:
+        cipher = Cipher(algorithms.AES(key), modes.CBC(init_vector))
+        encryptor = cipher.encryptor()
+
+        return encryptor.update(pad(msg)) + encryptor.finalize()
+
+    elif header.mode != GCM_MODE:
+        raise UnsupportedCipherMode(header.mode)
+
+    return gcm_encrypt(key, init_vector[ : GCM_NONCE_SIZE ], msg, header.associated_data())
+
+def decrypt (
+    key: bytes, init_vector: bytes, enc_msg: bytes, header: MessageHeader
+) -> bytes | bytearray:
+    if header.mode == CBC_MODE:
+        cipher = Cipher(algorithms.AES(key), modes.CBC(init_vector))
+        decryptor = cipher.decryptor()
+
+        return unpad(decryptor.update(enc_msg) + decryptor.finalize())
+
+    elif header.mode != GCM_MODE:
+        raise UnsupportedCipherMode(header.mode)
+
+    return gcm_decrypt(key, init_vector[ : GCM_NONCE_SIZE ], enc_msg, header.associated_data())
+
+def copy_ratchet (ratchet: Ratchet | PublicKey | str) -> Ratchet | PublicKey | str:
+    # chains are mutated in place, the skipped keys are only changed on a copy of their own
+    if isinstance(ratchet, SymmetricRatchet):
+        return copy.copy(ratchet)
+
+    return ratchet
+
+def copy_ratchets (ratchets: dict[str, Ratchet]) -> dict[str, Ratchet]:
+    return { ratchet_name: copy_ratchet(ratchet) for ratchet_name, ratchet in ratchets.items() }
+
+def stage_skipped_keys (ratchets: dict[str, Ratchet], saved: SkippedKeys) -> SkippedKeys:
+    # the saved store is shared with the session cache, the first change a message makes
+    # copies it, so an unchanged store is neither copied nor written again
+    if ratchets.get("skipped_keys", None) is saved:
+        ratchets["skipped_keys"] = SkippedKeys() if saved is None else saved.copy()
+
+    return ratchets["skipped_keys"]
+
+def wipe_ratchets (ratchets: Iterable[Ratchet | PublicKey | str | None]) -> None:
+    # the keys derived ahead of time never outlive the chain holding them
+    for ratchet in ratchets:
+        if isinstance(ratchet, SymmetricRatchet):
+            ratchet.wipe_lookahead()
+
+def dh_public_key (ratchets: dict[str, Ratchet | PublicKey | str]) -> str:
+    # kept next to the dh ratchet since its last rotation, derived only for older sessions
+    pbkey = ratchets.get("dh_public", None)
+
+    if pbkey is None:
+        return public_key(ratchets["dh_ratchet"])
+
+    return pbkey if isinstance(pbkey, str) else public_key(pbkey)
+
+def snd_key (
+    ratchets: dict[str, Ratchet], pbkey: PublicKey, mode: str = CBC_MODE, chat_id: str = None
+) -> tuple[bytes, bytes, MessageHeader]:
+    # the dh ratchet only rotates on the first message after the turn changes
+    if ratchets.get("snd_ratchet", None) is None:
+        dh_ratchet_rotation_send(ratchets, pbkey)
+
+    header = MessageHeader(
+        dh_public_key(ratchets), ratchets["snd_ratchet"].count, mode, chat_id
+    )
     key, init_vector = ratchets["snd_ratchet"].next()
-    cipher = Cipher(algorithms.AES(key), modes.CBC(init_vector))
-    encryptor = cipher.encryptor()
-    enc_msg = encryptor.update(pad(msg)) + encryptor.finalize()
 
-    return enc_msg, public_key(ratchets["dh_ratchet"])
+    return key, init_vector, header
+
+def snd_msg (
+    ratchets: dict[str, Ratchet], pbkey: PublicKey, msg: bytes,
+    mode: str = CBC_MODE, chat_id: str = None
+) -> tuple[bytes | bytearray, MessageHeader]:
+    key, init_vector, header = snd_key(ratchets, pbkey, mode, chat_id)
+
+    return encrypt(key, init_vector, msg, header), header
+
+def rcv_chain (
+    ratchets: dict[str, Ratchet], pbkey: str, saved: SkippedKeys = None
+) -> SymmetricRatchet:
+    user_ratchet = ratchets.get("user_ratchet", None)
+    if user_ratchet is not None and not isinstance(user_ratchet, str):
+        user_ratchet = public_key(user_ratchet)
+
+    if "rcv_ratchet" not in ratchets or pbkey != user_ratchet:
+        # messages of the replaced chain may still arrive after the new one
+        if "rcv_ratchet" in ratchets and user_ratchet is not None:
+            stage_skipped_keys(ratchets, saved).retire(user_ratchet, ratchets["rcv_ratchet"])
+
+        dh_ratchet_rotation_receive(ratchets, load_public_key(pbkey))
+
+        # the next message sent starts a new sending chain, None deletes the saved one
+        ratchets["snd_ratchet"] = None
+        ratchets["user_ratchet"] = pbkey
+
+    return ratchets["rcv_ratchet"]
+
+def rcv_key (
+    ratchets: dict[str, Ratchet], header: MessageHeader, mode: str = None
+) -> tuple[bytes, bytes]:
+    # checked before any message key is consumed
+    if header.mode not in CIPHER_MODES:
+        raise UnsupportedCipherMode(header.mode)
+
+    # a header can not downgrade the mode negotiated for the chat
+    if mode is not None and header.mode != mode:
+        raise CipherModeMismatch(header.mode, mode)
+
+    saved = ratchets.get("skipped_keys", None)
+
+    if saved is not None and saved.holds(header.dh_ratchet, header.counter):
+        return stage_skipped_keys(ratchets, saved).pop(header.dh_ratchet, header.counter)
+
+    if saved is not None and saved.retired(header.dh_ratchet) is not None:
+        # a late message moves its retired chain on
+        rcv_ratchet = stage_skipped_keys(ratchets, saved).retired(header.dh_ratchet)
+
+    else:
+        rcv_ratchet = rcv_chain(ratchets, header.dh_ratchet, saved)
+
+    counter = rcv_ratchet.count if header.counter is None else header.counter
+    if counter < rcv_ratchet.count:
+        raise MessageKeyNotFound(counter)
+
+    if counter > rcv_ratchet.count:
+        stage_skipped_keys(ratchets, saved).skip(header.dh_ratchet, rcv_ratchet, counter)
+
+    return rcv_ratchet.next()
 
 def rcv_msg (
-    ratchets: dict[str, Ratchet], pbkey: bytes, enc_msg: bytes
-) -> bytes:
-    if isinstance(pbkey, str):
-        pbkey = load_public_key(pbkey)
+    ratchets: dict[str, Ratchet], header: MessageHeader | PublicKey | str, enc_msg: bytes,
+    mode: str = None
+) -> bytes | bytearray:
+    if not isinstance(header, MessageHeader):
+        header = MessageHeader(header if isinstance(header, str) else public_key(header))
 
-    dh_ratchet_rotation_receive(ratchets, pbkey)
-    key, init_vector = ratchets["rcv_ratchet"].next()
-    cipher = Cipher(algorithms.AES(key), modes.CBC(init_vector))
-    decryptor = cipher.decryptor()
+    # the ratchets only move on once the message is authenticated, a forged or corrupted
+    # message leaves them as they were
+    staged = copy_ratchets(ratchets)
 
-    return unpad(decryptor.update(enc_msg) + decryptor.finalize())
+    try:
+        key, init_vector = rcv_key(staged, header, mode)
+        msg = decrypt(key, init_vector, enc_msg, header)
+
+    except Exception as exc:
+        wipe_ratchets(staged.values())
+
+        raise exc
+
+    # the replaced chains still hold the keys the copies consumed
+    wipe_ratchets(
+        ratchet for ratchet_name, ratchet in ratchets.items()
+        if staged.get(ratchet_name, None) is not ratchet
+    )
+    ratchets.update(staged)
+
+    return msg
+
+def attachment_key (key: bytes, init_vector: bytes) -> bytes:
+    # the chunks of an attachment are sealed with a key derived from its message key
+    return hkdf_derive_key(key + init_vector + b"attachment", 32)
+
+def chunk_associated_data (attachment_id: str, index: int, final: bool) -> bytes:
+    # binds each chunk to its position, so chunks can't be reordered, swapped or dropped
+    return f"{attachment_id}|{index}|{int(final)}".encode("utf-8")
+
+def encrypt_chunk (
+    key: bytes, attachment_id: str, index: int, chunk: bytes, final: bool = False
+) -> bytearray:
+    return gcm_encrypt(
+        key, index.to_bytes(GCM_NONCE_SIZE, "big"), chunk,
+        chunk_associated_data(attachment_id, index, final)
+    )
+
+def decrypt_chunk (
+    key: bytes, attachment_id: str, index: int, enc_chunk: bytes, final: bool = False
+) -> bytearray:
+    return gcm_decrypt(
+        key, index.to_bytes(GCM_NONCE_SIZE, "big"), enc_chunk,
+        chunk_associated_data(attachment_id, index, final)
+    )
 
 def generate_private_key (name: str = None, sgn_key: bool = False) -> PrivateKey:
     pvt_key = X25519PrivateKey.generate() if not sgn_key else Ed25519PrivateKey.generate()
@@ -158,54 +605,103 @@ def generate_private_key (name: str = None, sgn_key: bool = False) -> PrivateKey
 
     return pvt_key
 
-def save_private_key (name: str, pvtkey: PrivateKey) -> None:
-    with open(keys_path / f"{name}.pem", "w") as pem_file:
-        encoded_pvtkey = pvtkey.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.BestAvailableEncryption(
-                encode_b64(os.environ["SECRET_KEY"])
-            )
+def encode_ratchet (ratchet: Key | str) -> Field:
+    if isinstance(ratchet, str):
+        ratchet = load_public_key(ratchet)
+
+    if isinstance(ratchet, SymmetricRatchet):
+        return SYMMETRIC_FIELD, ratchet.state + struct.pack("!I", ratchet.count)
+
+    elif isinstance(ratchet, SkippedKeys):
+        return SKIPPED_FIELD, ratchet.to_bytes()
+
+    elif isinstance(ratchet, (X25519PrivateKey, Ed25519PrivateKey)):
+        field_type = PRIVATE_FIELD if isinstance(ratchet, X25519PrivateKey) else SIGNING_FIELD
+
+        return field_type, ratchet.private_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PrivateFormat.Raw,
+            encryption_algorithm=serialization.NoEncryption()
         )
 
-        pem_file.write(f"{decode_b64(encoded_pvtkey)}")
+    field_type = VERIFYING_FIELD if isinstance(ratchet, Ed25519PublicKey) else PUBLIC_FIELD
+
+    return field_type, ratchet.public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    )
+
+def decode_ratchet (field: Field) -> Key:
+    field_type, value = field
+
+    if field_type == PRIVATE_FIELD:
+        return X25519PrivateKey.from_private_bytes(value)
+
+    elif field_type == SIGNING_FIELD:
+        return Ed25519PrivateKey.from_private_bytes(value)
+
+    elif field_type == SYMMETRIC_FIELD:
+        count = struct.unpack("!I", value[ 32 : ])[0] if len(value) > 32 else 0
+
+        return SymmetricRatchet(value[ : 32 ], count)
+
+    elif field_type == SKIPPED_FIELD:
+        return SkippedKeys.from_bytes(value)
+
+    elif field_type == VERIFYING_FIELD:
+        return Ed25519PublicKey.from_public_bytes(value)
+
+    return X25519PublicKey.from_public_bytes(value)
+
+def save_private_key (name: str, pvtkey: PrivateKey) -> None:
+    keystore.write_record("keys", name, { "key": encode_ratchet(pvtkey) })
+
+def save_private_keys (pvtkeys: dict[str, PrivateKey]) -> None:
+    keystore.write_records("keys", {
+        name: { "key": encode_ratchet(pvtkey) } for name, pvtkey in pvtkeys.items()
+    })
+
+def ratchets_record (chat_id: int, tmp: bool = False) -> str:
+    return f"tmp-{chat_id}" if tmp else f"{chat_id}"
+
+def save_ratchets (
+    chat_id: int, ratchets: dict[str, Ratchet | str | None], tmp: bool = False,
+    durable: bool = False
+) -> None:
+    # a None ratchet is removed from the chat record
+    keystore.update_record("ratchets", ratchets_record(chat_id, tmp), {
+        ratchet_name: None if ratchet is None else encode_ratchet(ratchet)
+        for ratchet_name, ratchet in ratchets.items()
+    }, durable=durable)
 
 def save_ratchet (
     chat_id: int, ratchet_name: str, ratchet: Ratchet | str, tmp: bool = False
 ) -> None:
-    if tmp:
-        ratchet_name = f"tmp-{ratchet_name}"
-
-    ensure_dir(ratchets_path / f"{chat_id}/{ratchet_name}" )
-    if isinstance(ratchet, X25519PrivateKey):
-        with open(ratchets_path / f"{chat_id}/{ratchet_name}.pem", "w") as pem_file:
-            encoded_ratchet = ratchet.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.BestAvailableEncryption(
-                    encode_b64(os.environ["SECRET_KEY"])
-                )
-            )
+    save_ratchets(chat_id, { ratchet_name: ratchet }, tmp=tmp)
 
-            pem_file.write(f"{decode_b64(encoded_ratchet)}")
+def delete_ratchet (chat_id: int, ratchet_name: str, tmp: bool = False) -> None:
+    save_ratchets(chat_id, { ratchet_name: None }, tmp=tmp)
 
-    elif isinstance(ratchet, SymmetricRatchet):
-        with open(ratchets_path / f"{chat_id}/{ratchet_name}", "w") as sym_file:
-            sym_file.write(f"{decode_b64(ratchet.state)}")
+def read_ratchets (chat_id: int, tmp: bool = False) -> dict[str, Ratchet | PublicKey]:
+    record = keystore.read_record("ratchets", ratchets_record(chat_id, tmp)) or dict()
 
-    elif isinstance(ratchet, str):
-        with open(ratchets_path / f"{chat_id}/{ratchet_name}", "w") as pbk_file:
-            pbk_file.write(f"{ratchet}")
+    return {
+        f"tmp-{ratchet_name}" if tmp else ratchet_name: decode_ratchet(field)
+        for ratchet_name, field in record.items()
+    }
 
-def delete_ratchet (chat_id: int, ratchet_name: str, tmp: bool = False) -> None:
-    file_name = f"tmp-{ratchet_name}" if tmp else ratchet_name
-    file_path = ratchets_path / f"{chat_id}/{file_name}"
+def load_ratchets (chat_id: int, tmp: bool = False) -> tuple[dict[str, Ratchet], bytes]:
+    ratchets = read_ratchets(chat_id, tmp)
+    pbkey = None if tmp else ratchets.pop("user_ratchet", None)
 
-    if ratchet_name == "dh_ratchet":
-        file_path = f"{file_path}.pem"
+    return ratchets, pbkey
 
-    if os.path.exists(file_path):
-        os.remove(file_path)
+def load_private_key (name: str) -> PrivateKey:
+    record = keystore.read_record("keys", name)
+    if record is None:
+        raise FileNotFoundError(f"Private key {name} not found")
+
+    return decode_ratchet(record["key"])
 
 def load_key_from_file (
     key_path: Path, key_name: str, method: str = "private", **kwargs
@@ -225,24 +721,40 @@ def load_key_from_file (
         with open(key_path / f"{key_name}") as sym_file:
             return load_public_key(sym_file.readline(), **kwargs)
 
-def load_ratchets (chat_id: int, tmp: bool = False) -> tuple[dict[str, Ratchet], bytes]:
-    ratchets = dict()
-    for ratchet_name, ratchet_method in ratchets_iter:
-        ratchet_name = f"tmp-{ratchet_name}" if tmp else ratchet_name
-
-        try:
-            ratchets[ratchet_name] = load_key_from_file(
-                ratchets_path / f"{chat_id}",
-                ratchet_name,
-                ratchet_method
-            )
+def migrate_legacy_keys () -> None:
+    # moves the records of the file keystore into the database
+    if isinstance(keystore, SqliteKeystore) and keystore.path.exists():
+        keystore.migrate_files()
 
-        except FileNotFoundError:
-            pass
+    # moves the per-key pem files of the previous layout into the keystore
+    if os.path.exists(keys_path):
+        for item in os.listdir(keys_path):
+            if item.endswith(".pem"):
+                key_name = item.removesuffix(".pem")
 
-    pbkey = None if tmp else ratchets.pop("user_ratchet")
+                save_private_key(key_name, load_key_from_file(keys_path, key_name))
+                os.remove(keys_path / item)
 
-    return ratchets, pbkey
+    if os.path.exists(ratchets_path):
+        for chat_id in os.listdir(ratchets_path):
+            for tmp in (False, True):
+                ratchets = dict()
+
+                for ratchet_name, ratchet_method in ratchets_iter:
+                    file_name = f"tmp-{ratchet_name}" if tmp else ratchet_name
+
+                    try:
+                        ratchets[ratchet_name] = load_key_from_file(
+                            ratchets_path / chat_id, file_name, ratchet_method
+                        )
+
+                    except FileNotFoundError:
+                        pass
+
+                if len(ratchets) > 0:
+                    save_ratchets(chat_id, ratchets, tmp=tmp)
+
+            shutil.rmtree(ratchets_path / chat_id)
 
 def public_key (key: PrivateKey | PublicKey) -> str:
     if isinstance(key, X25519PrivateKey):
@@ -267,17 +779,23 @@ def load_public_key (pbkey: str, sgn_key: bool = False) -> PublicKey:
 def sign_message (pvtkey: Ed25519PrivateKey, msg: bytes = b"It's me, Mario") -> str:
     return decode_b64(pvtkey.sign(msg)).replace("\r", "").replace("\n", "")
 
-def load_private_key (name: str) -> PrivateKey:
-    return load_key_from_file(keys_path, name)
-
 def clean_keys () -> None:
-    for item in os.listdir(keys_path):
-        if item.endswith(".pem"):
-            os.remove(keys_path / item)
+    keystore.clean()
+
+    if os.path.exists(keys_path):
+        for item in os.listdir(keys_path):
+            if item.endswith(".pem"):
+                os.remove(keys_path / item)
 
     shutil.rmtree(ratchets_path, ignore_errors=True)
 
 def clean_chat_keys (chat_id: int, user_id: int) -> None:
-    for item in os.listdir(keys_path):
-        if item.endswith(f"{chat_id}-{user_id}.pem"):
-            os.remove(keys_path / item)
\ No newline at end of file
+    for key_name in keystore.list_records("keys"):
+        if key_name.endswith(f"{chat_id}-{user_id}"):
+            keystore.delete_record("keys", key_name)
+
+def clean_chats_keys (chat_ids: list[int], user_id: int) -> None:
+    # the keys created along with each chat, removed at once without listing the others
+    keystore.delete_records("keys", [
+        f"{prefix}-{chat_id}-{user_id}" for chat_id in chat_ids for prefix in ("eph", "dhr")
+    ])
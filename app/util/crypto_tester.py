@@ -1,6 +1,5 @@
 from crypto import (PrivateKey, PublicKey, decode_b64, init_root_ratchet,
-                    load_public_key, rcv_msg, receiver_x3dh, sender_x3dh,
-                    snd_msg)
+                    rcv_msg, receiver_x3dh, sender_x3dh, snd_msg)
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 
 
@@ -68,12 +67,12 @@ while True:
         ratchets_sender = ratchets_bob
         ratchets_receiver = ratchets_alice
 
-    cipher, snd_pbkey = snd_msg(
+    cipher, header = snd_msg(
         ratchets_sender, ratchets_receiver["dh_ratchet"].public_key(), bytes(message, encoding="utf-8")
     )
     print(f"encrypted message: {decode_b64(cipher)}")
 
-    msg = rcv_msg(ratchets_receiver, load_public_key(snd_pbkey), cipher)
+    msg = rcv_msg(ratchets_receiver, header, cipher)
     print(f"decrypted_message: {str(msg)}")
 
     if sender == "alice":
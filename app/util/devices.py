@@ -0,0 +1,97 @@
+import dataclasses as dc
+import threading
+import uuid
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from app.util import crypto
+
+# devices of a recipient encrypted for at the same time
+DEVICE_WORKERS = 4
+
+LOCAL_DEVICE = "local"
+
+def device_session (session_id: str, device: str = None) -> str:
+    # a chat holds a ratchet for each device of the recipient, if it has more than one
+    return f"{session_id}@{device}" if device else str(session_id)
+
+@dc.dataclass()
+class DeviceDirectory:
+    """
+        The devices of every contact, cached on the keystore until the server tells a
+        device was added or removed, and the pool encrypting a message for all of them.\n
+        :max_workers int:   number of devices encrypted for at the same time\n
+    """
+    max_workers: int = dc.field(default=DEVICE_WORKERS)
+
+    devices: dict[str, list[str]] = dc.field(init=False, default_factory=dict)
+
+    _device_id: str = dc.field(init=False, default=None)
+    _executor: ThreadPoolExecutor = dc.field(init=False, default=None)
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+
+    def local_device (self) -> str:
+        # the id of this install, created once and kept on the keystore
+        with self._lock:
+            if self._device_id is None:
+                record = crypto.keystore.read_record("devices", LOCAL_DEVICE)
+
+                if record is None:
+                    record = { "id": (crypto.DEVICE_FIELD, uuid.uuid4().hex.encode("utf-8")) }
+                    crypto.keystore.write_record("devices", LOCAL_DEVICE, record)
+
+                self._device_id = record["id"][1].decode("utf-8")
+
+            return self._device_id
+
+    def load (self, telephone: str) -> list[str]:
+        # None when the devices of the contact are unknown, or were invalidated
+        with self._lock:
+            if telephone in self.devices:
+                return self.devices[telephone]
+
+        record = crypto.keystore.read_record("devices", f"user-{telephone}")
+        if record is None:
+            return None
+
+        with self._lock:
+            self.devices[telephone] = list(record)
+
+            return self.devices[telephone]
+
+    def store (self, telephone: str, devices: list[str]) -> None:
+        crypto.keystore.write_record("devices", f"user-{telephone}", {
+            device: (crypto.DEVICE_FIELD, b"") for device in devices
+        })
+
+        with self._lock:
+            self.devices[telephone] = list(devices)
+
+    def invalidate (self, telephone: str) -> None:
+        crypto.keystore.delete_record("devices", f"user-{telephone}")
+
+        with self._lock:
+            self.devices.pop(telephone, None)
+
+    def targets (self, telephone: str, sessions: dict[str, Any]) -> dict[str, Any]:
+        # the devices with a session, less the ones the server said were removed
+        devices = self.load(telephone)
+
+        return {
+            device: back_id for device, back_id in sessions.items()
+            if devices is None or device in devices
+        }
+
+    def encrypt_for (self, devices: list[str], encrypt: Callable[[str], dict]) -> list[dict]:
+        if len(devices) <= 1:
+            return [ encrypt(device) for device in devices ]
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="device"
+                )
+
+        # each device has its own ratchets, so they never wait on each other
+        return list(self._executor.map(encrypt, devices))
@@ -44,4 +44,52 @@ class JobResolutionConfigurationError (Exception):
     def __init__ (self) -> None:
         super().__init__(
             "It's not allowed to specity chat ID with job priority different than 2"
-        )
\ No newline at end of file
+        )
+
+class MessageKeyNotFound (Exception):
+    """
+        Raised when the message key of a received message was already used or discarded
+    """
+
+    def __init__ (self, counter: int = None) -> None:
+        super().__init__(f"Message key {counter} is not available on the receiving chain")
+
+class TooManySkippedMessages (Exception):
+    """
+        Raised when a received message would skip more keys than allowed on the chain
+    """
+
+    def __init__ (self, skipped: int = None) -> None:
+        super().__init__(f"Message would skip {skipped} keys of the receiving chain")
+
+class UnsupportedCipherMode (Exception):
+    """
+        Raised when a message is encrypted with a cipher mode this client does not support
+    """
+
+    def __init__ (self, mode: str = None) -> None:
+        super().__init__(f"Cipher mode {mode} is not supported")
+
+class CipherModeMismatch (Exception):
+    """
+        Raised when a message uses a cipher mode other than the one negotiated for its chat
+    """
+
+    def __init__ (self, mode: str = None, expected: str = None) -> None:
+        super().__init__(f"Cipher mode {mode} does not match the mode {expected} of the chat")
+
+class UnknownSenderKey (Exception):
+    """
+        Raised when a group message arrives from a member whose sender key was never received
+    """
+
+    def __init__ (self, telephone: str = None) -> None:
+        super().__init__(f"Sender key of the member {telephone} not found")
+
+class InvalidGroupSignature (Exception):
+    """
+        Raised when a group message is not signed by the sender key of the member sending it
+    """
+
+    def __init__ (self, telephone: str = None) -> None:
+        super().__init__(f"Group message of the member {telephone} has an invalid signature")
@@ -0,0 +1,137 @@
+import os
+import struct
+
+from bson import ObjectId
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
+from app.models.chat import Chat
+from app.util import crypto
+from app.util.crypto import MessageHeader, Ratchet, SymmetricRatchet
+from app.util.exc import (InvalidGroupSignature, MessageKeyNotFound,
+                          UnknownSenderKey)
+
+# chain state, chain count, signing public key and chat id of the member holding it
+SENDER_KEY = struct.Struct("!32sI32s12s")
+
+# ratchets of the sender chain of the user, on the group record
+SENDER_CHAIN = "snd_chain"
+SENDER_SIGNING = "snd_sgn"
+
+SenderKey = tuple[SymmetricRatchet, crypto.PublicKey]
+
+def is_group (chat: Chat) -> bool:
+    return len(chat.users) > 1
+
+def group_id (chat: Chat) -> str:
+    # every member of a group authenticates its messages with the chat id of the owner
+    return str(chat.back_id if chat.owner is not None else chat._id)
+
+def group_record (chat_id: str) -> str:
+    return f"group-{chat_id}"
+
+def session_id (chat: Chat, telephone: str) -> str:
+    # the pairwise sessions of a group are kept apart, one for each member
+    return f"{chat._id}-{telephone}" if is_group(chat) else str(chat._id)
+
+def create_sender_key () -> dict[str, Ratchet]:
+    return {
+        SENDER_CHAIN: SymmetricRatchet(os.urandom(32)),
+        SENDER_SIGNING: Ed25519PrivateKey.generate()
+    }
+
+def pack_sender_key (chain: SymmetricRatchet, sgn_key: crypto.PublicKey, chat_id: str) -> bytes:
+    return SENDER_KEY.pack(
+        chain.state, chain.count, crypto.encode_ratchet(sgn_key)[1], ObjectId(chat_id).binary
+    )
+
+def unpack_sender_key (packed: bytes) -> tuple[SymmetricRatchet, crypto.PublicKey, str]:
+    state, count, sgn_key, chat_id = SENDER_KEY.unpack(bytes(packed))
+
+    return (
+        SymmetricRatchet(state, count),
+        crypto.decode_ratchet((crypto.VERIFYING_FIELD, sgn_key)),
+        str(ObjectId(chat_id))
+    )
+
+def member_key (ratchets: dict[str, Ratchet], telephone: str) -> SenderKey:
+    chain = ratchets.get(f"chain-{telephone}", None)
+    sgn_key = ratchets.get(f"sgn-{telephone}", None)
+
+    if chain is None or sgn_key is None:
+        raise UnknownSenderKey(telephone)
+
+    return chain, sgn_key
+
+def add_member_key (
+    ratchets: dict[str, Ratchet], telephone: str, chain: SymmetricRatchet,
+    sgn_key: crypto.PublicKey
+) -> None:
+    ratchets[f"chain-{telephone}"] = chain
+    ratchets[f"sgn-{telephone}"] = sgn_key
+
+def member_keys (ratchets: dict[str, Ratchet]) -> dict[str, SenderKey]:
+    return {
+        ratchet_name.removeprefix("chain-"): member_key(
+            ratchets, ratchet_name.removeprefix("chain-")
+        )
+        for ratchet_name in ratchets
+        if ratchet_name.startswith("chain-")
+    }
+
+def snd_group_msg (
+    ratchets: dict[str, Ratchet], msg: bytes, mode: str = crypto.GCM_MODE, chat_id: str = None
+) -> tuple[bytes | bytearray, MessageHeader, bytes]:
+    # a single cipher for the whole group, the server fans it out to every member
+    sgn_key = ratchets[SENDER_SIGNING]
+    header = MessageHeader(
+        crypto.public_key(sgn_key), ratchets[SENDER_CHAIN].count, mode, chat_id
+    )
+    key, init_vector = ratchets[SENDER_CHAIN].next()
+
+    cipher = crypto.encrypt(key, init_vector, msg, header)
+
+    # the chain is known by every member, the signature proves which one sent it
+    return cipher, header, sgn_key.sign(header.associated_data() + bytes(cipher))
+
+def rcv_group_msg (
+    ratchets: dict[str, Ratchet], telephone: str, header: MessageHeader,
+    enc_msg: bytes, signature: bytes
+) -> bytes | bytearray:
+    # the chain only moves on once the message is decrypted
+    staged = {
+        ratchet_name: crypto.copy_ratchet(ratchets[ratchet_name])
+        for ratchet_name in (f"chain-{telephone}", "skipped_keys") if ratchet_name in ratchets
+    }
+    chain, sgn_key = member_key(ratchets | staged, telephone)
+
+    # checked before any message key of the chain is consumed
+    if header.dh_ratchet != crypto.public_key(sgn_key):
+        raise InvalidGroupSignature(telephone)
+
+    try:
+        sgn_key.verify(signature, header.associated_data() + bytes(enc_msg))
+
+    except InvalidSignature:
+        raise InvalidGroupSignature(telephone)
+
+    saved = staged.get("skipped_keys", None)
+
+    if saved is not None and saved.holds(header.dh_ratchet, header.counter):
+        message_key = crypto.stage_skipped_keys(staged, saved).pop(
+            header.dh_ratchet, header.counter
+        )
+
+    else:
+        if header.counter < chain.count:
+            raise MessageKeyNotFound(header.counter)
+
+        if header.counter > chain.count:
+            crypto.stage_skipped_keys(staged, saved).skip(header.dh_ratchet, chain, header.counter)
+
+        message_key = chain.next()
+
+    msg = crypto.decrypt(*message_key, enc_msg, header)
+    ratchets.update(staged)
+
+    return msg
@@ -1,17 +1,38 @@
+import asyncio
 import dataclasses as dc
+import heapq
+import itertools
+import json
+import random
+import threading
 import time
 from abc import ABC, ABCMeta, abstractmethod
-from typing import Union
-
-from flask_socketio import emit, send
+from collections import deque
+from collections.abc import Callable
+from typing import Any, ClassVar, Union
 
+from app.util.acks import ACK_BATCH, confirmation_key, merge_confirmations
 from app.util.exc import (JobResolutionConfigurationError, MissingChatId,
                           NotJobInstance, PriorityRangeError)
+from app.util.metrics import JobMetrics, JobStats
+from app.util.outbox import Outbox, StoredJob
 
 RequestData = dict[str, Union[str, dict[str, str]]]
+# refused attempts before a job is dropped, durable jobs are retried until the server
+# acknowledges them, however long the connection is down
 MAX_RETRIES = 5
+# valid priorities go from the min up to, not including, the max, lower runs first
 MIN_PRIORITY = 0
 MAX_PRIORITY = 3
+# jobs of this priority are kept in order for each chat
+CHAT_PRIORITY = 2
+# seconds a refused job waits before its first retry, doubled on every other one
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+# jobs of each priority solved at the same time, only jobs of the same priority run together
+JOB_CONCURRENCY = { 0: 1, 1: 4, 2: 8 }
+# seconds between the snapshots of the queue metrics, none are dumped when not positive
+JOB_METRICS_INTERVAL = 0.0
 
 @dc.dataclass(init=True)
 class Job (ABC):
@@ -20,132 +41,545 @@ class Job (ABC):
     data: RequestData = dc.field(init=True, default=None)
     retries: int = dc.field(init=True, default=0)
     priority: int = dc.field(init=True, default=0)
+    chat_id: str = dc.field(init=True, default=None)
+    next_attempt: float = dc.field(init=False, default=0.0)
+    enqueued: float = dc.field(init=False, default=0.0)
+    outbox_ids: list[str] = dc.field(init=False, default_factory=list)
+
+    # kept on the outbox while the queue has one
+    durable: ClassVar[bool] = False
 
     @abstractmethod
-    def solve (self) -> None:
+    def solve (self, ack: Callable = None) -> None:
         pass
 
+    def merge (self, job: "Job") -> bool:
+        # a job still waiting in the queue may take the data of a later one of its chat
+        return False
+
+    def stored (self) -> StoredJob:
+        return {
+            "job": type(self).__name__,
+            "user_id": self.user_id,
+            "priority": self.priority,
+            "chat": self.chat_id,
+            "data": self.data
+        }
+
     def increment_retries (self) -> int:
         self.retries += 1
 
         return self.retries
 
+    def backoff (self, now: float) -> float:
+        # exponential, with a full jitter so the refused jobs are not retried all at once
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (self.retries - 1))
+        self.next_attempt = now + random.uniform(0.0, delay)
+
+        return self.next_attempt
+
     def identify_job_type (self) -> None:
         print(type(self))
 
 class RefreshJob (Job):
-    def solve (self) -> None:
+    def solve (self, ack: Callable = None) -> None:
         from app import api
 
+        # the disconnection returns once it is done, the login follows right away
         api.logout()
-        time.sleep(0.5)
         api.login()
 
-class CreateChatJob (Job):
-    def solve (self) -> None:
-        emit("create-chat", self.data)
+class EmitJob (Job):
+    # sent again after a restart until the server acknowledges it
+    durable: ClassVar[bool] = True
+    event: ClassVar[str] = None
+
+    def solve (self, ack: Callable = None) -> None:
+        from app import api
+
+        # refused while not connected, emitted without waiting the ack of the jobs before
+        api.emit(self.event, self.data, callback=ack)
+
+class CreateChatJob (EmitJob):
+    event = "create-chat"
+
+class CreateChatsJob (EmitJob):
+    event = "create-chats"
+
+class ConfirmCreateChatJob (EmitJob):
+    event = "confirm-create-chat"
+
+class SendMessageJob (EmitJob):
+    event = "message"
+
+class GroupMessageJob (EmitJob):
+    event = "group-message"
+
+class SenderKeyJob (EmitJob):
+    event = "sender-key"
+
+class ConfirmMessageJob (EmitJob):
+    event = "confirm-message"
 
-class ConfirmCreateChatJob (Job):
-    def solve (self) -> None:
-        emit("confirm-create-chat", self.data)
+    def merge (self, job: Job) -> bool:
+        if type(job) is not ConfirmMessageJob:
+            return False
 
-class SendMessageJob (Job):
-    def solve (self) -> None:
-        send(self.data)
+        body, other = self.data["body"], job.data["body"]
 
-class ConfirmMessageJob (Job):
-    def solve (self) -> None:
-        emit("confirm-message", self.data)
+        if confirmation_key(body) != confirmation_key(other):
+            return False
 
-Jobs = Union[list[Job], dict[str, list[Job]]]
+        if len(body.get("acks", [])) + len(other.get("acks", [])) > ACK_BATCH:
+            return False
+
+        self.data = job.data | { "body": merge_confirmations(body, other) }
+
+        return True
+
+# the jobs restored from the outbox, by name
+JOB_CLASSES = {
+    job_class.__name__: job_class for job_class in (
+        CreateChatJob, CreateChatsJob, ConfirmCreateChatJob, SendMessageJob, GroupMessageJob,
+        SenderKeyJob, ConfirmMessageJob
+    )
+}
+
+# priority, due time, arrival order and the job
+ScheduledJob = tuple[int, float, int, Job]
+
+@dc.dataclass()
+class UserJobs:
+    """
+        The jobs of a single user, on a heap ordered by priority, due time and arrival.
+        Only the oldest job of each chat is on the heap, the others wait behind it, so
+        the chats of a priority take turns.\n
+        :heap list:     the jobs ready to be scheduled\n
+        :chats dict:    the jobs waiting behind the one of each chat on the heap\n
+        :tails dict:    the last job of each chat, while it is not being solved\n
+    """
+    heap: list[ScheduledJob] = dc.field(default_factory=list)
+    chats: dict[str, deque[Job]] = dc.field(default_factory=dict)
+    tails: dict[str, Job] = dc.field(default_factory=dict)
+
+    def __len__ (self) -> int:
+        return len(self.heap) + sum(len(waiting) for waiting in self.chats.values())
 
 @dc.dataclass(init=True)
 class JobQueue:
-    job_dict: dict[int, list[Jobs]] = dc.field(init=False, default_factory=dict)
+    """
+        Jobs waiting for the connection to come back, scheduled on a heap for each user.
+        A job only runs once due and once no job of a lower priority is waiting. The job
+        handler sleeps until the first job is due, or until it is woken up.\n
+        :min_priority int:      the most urgent priority\n
+        :max_priority int:      the first priority past the least urgent one\n
+        :chat_priority int:     priority of the jobs kept in order for each chat\n
+        :outbox Outbox:         keeps the jobs until the server acknowledges them\n
+        :concurrency dict:      most jobs of each priority run at the same time\n
+    """
+    min_priority: int = dc.field(default=MIN_PRIORITY)
+    max_priority: int = dc.field(default=MAX_PRIORITY)
+    chat_priority: int = dc.field(default=CHAT_PRIORITY)
+    outbox: Outbox = dc.field(default=None)
+    concurrency: dict[int, int] = dc.field(default_factory=lambda: dict(JOB_CONCURRENCY))
+
+    job_dict: dict[int, UserJobs] = dc.field(init=False, default_factory=dict)
+
+    job_metrics: JobMetrics = dc.field(init=False, default_factory=JobMetrics)
+
+    _seq: itertools.count = dc.field(init=False, default_factory=itertools.count)
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+    _wakeup: threading.Condition = dc.field(init=False, default=None)
+    _woken: bool = dc.field(init=False, default=False)
+
+    def __post_init__ (self) -> None:
+        self._wakeup = threading.Condition(self._lock)
+
+    def _check_priority (self, priority: int) -> None:
+        if not self.min_priority <= priority < self.max_priority:
+            raise PriorityRangeError
+
+    def _push (self, user_jobs: UserJobs, job: Job) -> None:
+        heapq.heappush(user_jobs.heap, (job.priority, job.next_attempt, next(self._seq), job))
+
+    def _schedule (self, user_jobs: UserJobs, job: Job) -> None:
+        if job.chat_id is not None:
+            # merged into the last job of the chat, it keeps the order of the chat
+            tail = user_jobs.tails.get(job.chat_id, None)
+
+            if tail is not None and tail.merge(job):
+                tail.outbox_ids.extend(job.outbox_ids)
+                return
+
+            user_jobs.tails[job.chat_id] = job
+
+            if job.chat_id in user_jobs.chats:
+                user_jobs.chats[job.chat_id].append(job)
+                return
+
+            user_jobs.chats[job.chat_id] = deque()
+
+        self._push(user_jobs, job)
+
+    def _done (self, user_jobs: UserJobs, job: Job) -> None:
+        # the next job of the chat goes behind the ones of the other chats
+        if job.chat_id is None:
+            return
+
+        waiting = user_jobs.chats[job.chat_id]
+        if len(waiting) > 0:
+            next_job = waiting.popleft()
+            next_job.next_attempt = time.monotonic()
+            self._push(user_jobs, next_job)
+
+        else:
+            user_jobs.chats.pop(job.chat_id)
 
     def add_job (
         self, user_id: int, priority: int,
         job_class: ABCMeta, data: RequestData = None, chat_id: int = None, retries: int = 0
     ) -> None:
-        if not isinstance(job_class(), Job):
+        if not isinstance(job_class, type) or not issubclass(job_class, Job):
             raise NotJobInstance
 
-        job = job_class(user_id, data, priority, retries)
+        self._check_priority(priority)
 
-        if self.job_dict.get(user_id, None) is None:
-            self.job_dict[user_id] = [ list(), list(), dict() ]
+        if priority == self.chat_priority and chat_id is None:
+            raise MissingChatId
 
-        if MIN_PRIORITY <= priority <= 1:
-            self.job_dict[user_id][priority].append(job)
+        job = job_class(
+            user_id=user_id, data=data, retries=retries, priority=priority,
+            chat_id=str(chat_id) if priority == self.chat_priority else None
+        )
 
-        elif priority == 2:
-            if chat_id is None:
-                raise MissingChatId
+        # stored before it is queued, so a job is never sent without being on the outbox
+        if self.outbox is not None and job.durable:
+            job.outbox_ids.append(self.outbox.store(job.stored()))
 
-            elif self.job_dict[user_id][priority].get(chat_id, None) is None:
-                self.job_dict[user_id][priority][chat_id] = []
+        job.next_attempt = job.enqueued = time.monotonic()
 
-            self.job_dict[user_id][priority][chat_id].append(job)
+        with self._lock:
+            self._schedule(self.job_dict.setdefault(user_id, UserJobs()), job)
+            self._notify()
 
-        else:
-            raise PriorityRangeError
+    def restore (self) -> int:
+        # the jobs left on the outbox by the last run, queued again in a single pass
+        if self.outbox is None:
+            return 0
 
-    def _resolve_jobs (self, jobs: list[Job]) -> list[Job]:
-        failed_jobs = []
+        now = time.monotonic()
+        unknown = []
+        restored = 0
 
-        for job in jobs:
-            try:
-                job.solve()
+        stored_jobs = self.outbox.load()
+
+        with self._lock:
+            for outbox_id, stored in stored_jobs:
+                job_class = JOB_CLASSES.get(stored["job"], None)
+
+                if job_class is None:
+                    unknown.append(outbox_id)
+                    continue
+
+                job = job_class(
+                    user_id=stored["user_id"], data=stored["data"], priority=stored["priority"],
+                    chat_id=stored["chat"]
+                )
+                job.outbox_ids.append(outbox_id)
+                job.next_attempt = job.enqueued = now
+
+                self._schedule(self.job_dict.setdefault(job.user_id, UserJobs()), job)
+                restored += 1
+
+            self._notify()
+
+        if len(unknown) > 0:
+            self.outbox.ack_many(unknown)
+
+        return restored
+
+    def _acknowledge (self, job: Job) -> Callable:
+        if self.outbox is None or len(job.outbox_ids) == 0:
+            return None
+
+        def acknowledge (*args) -> None:
+            self.outbox.ack_many(job.outbox_ids)
+
+        return acknowledge
+
+    def _notify (self) -> None:
+        self._woken = True
+        self._wakeup.notify_all()
+
+    def wake (self, user_id: int = None) -> None:
+        # on a reconnection the jobs waiting on their backoff are retried right away
+        with self._lock:
+            user_jobs = self.job_dict.get(user_id, None)
+
+            if user_jobs is not None:
+                now = time.monotonic()
+
+                for idx, (priority, due, seq, job) in enumerate(user_jobs.heap):
+                    job.next_attempt = min(due, now)
+                    user_jobs.heap[idx] = (priority, job.next_attempt, seq, job)
+
+                heapq.heapify(user_jobs.heap)
+
+            self._notify()
+
+    def next_due (self, user_id: int) -> float:
+        # the most urgent job holds back every other one, so it is the only one waited for
+        with self._lock:
+            user_jobs = self.job_dict.get(user_id, None)
+
+            if user_jobs is None or len(user_jobs.heap) == 0:
+                return None
+
+            return user_jobs.heap[0][1]
+
+    def wait (self, user_id: int, timeout: float = None) -> bool:
+        """
+            Sleeps until a job of the user is due, a job is added or the queue is woken up,
+            returning False if the timeout ran out first.\n
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self._wakeup:
+            while not self._woken:
+                user_jobs = self.job_dict.get(user_id, None)
+                now = time.monotonic()
 
-            except ConnectionRefusedError:
-                if job.increment_retries() < MAX_RETRIES:
-                    failed_jobs.append(job)
+                delay = None
+                if user_jobs is not None and len(user_jobs.heap) > 0:
+                    delay = user_jobs.heap[0][1] - now
+
+                    if delay <= 0:
+                        return True
+
+                if deadline is not None:
+                    if deadline <= now:
+                        return False
+
+                    delay = deadline - now if delay is None else min(delay, deadline - now)
+
+                self._wakeup.wait(delay)
+
+            self._woken = False
+
+            return True
+
+    def pending (self, user_id: int) -> int:
+        with self._lock:
+            return len(self.job_dict.get(user_id, ()))
+
+    def metrics (self) -> dict[str, dict[str, Any]]:
+        """
+            The depth and the age of the oldest job waiting, with the counters of the jobs
+            solved so far, for each job class and priority.\n
+        """
+        now = time.monotonic()
+        queued = dict()
+
+        with self._lock:
+            for user_jobs in self.job_dict.values():
+                waiting = itertools.chain(
+                    (entry[3] for entry in user_jobs.heap), *user_jobs.chats.values()
+                )
+
+                for job in waiting:
+                    key = (type(job).__name__, job.priority)
+                    depth, oldest = queued.get(key, (0, now))
+                    queued[key] = (depth + 1, min(oldest, job.enqueued))
+
+        stats = self.job_metrics.snapshot()
+        metrics = dict()
+
+        for name, priority in sorted(queued.keys() | stats.keys()):
+            depth, oldest = queued.get((name, priority), (0, now))
+
+            metrics[f"{name}/{priority}"] = {
+                "depth": depth,
+                "oldest_age": now - oldest
+            } | stats.get((name, priority), JobStats().snapshot())
+
+        return metrics
+
+    def metrics_handler (self, interval: float, dump: Callable = None) -> None:
+        # a json line for each snapshot, unless told where to send it
+        dump = dump if dump is not None else lambda metrics: print(json.dumps(metrics))
+
+        while True:
+            time.sleep(interval)
+
+            try:
+                dump(self.metrics())
 
             except Exception as exc:
-                print(f"Ill formed job of type {type(job)}")
-                print(exc)
+                print(f"Failed to dump the job queue metrics: {exc}")
 
-        return failed_jobs
+    def _next_job (
+        self, user_jobs: UserJobs, now: float, priority: int, chat_id: str,
+        skipped: list[ScheduledJob]
+    ) -> Job:
+        while len(user_jobs.heap) > 0 and user_jobs.heap[0][1] <= now:
+            entry = heapq.heappop(user_jobs.heap)
+            job = entry[3]
 
-    def resolve_jobs (self, user_id: int, priority: int = None, chat_id: int = None) -> None:
-        if priority is None and chat_id is not None:
-            raise JobResolutionConfigurationError
+            if (priority is None or job.priority == priority) and (
+                chat_id is None or job.chat_id == chat_id
+            ):
+                # being solved, the later jobs of the chat are no longer merged into it
+                if job.chat_id is not None and user_jobs.tails.get(job.chat_id, None) is job:
+                    user_jobs.tails.pop(job.chat_id)
 
-        elif self.job_dict.get(user_id, None) is None:
-            return
+                return job
+
+            skipped.append(entry)
+
+        return None
+
+    def _solve (self, job: Job) -> bool:
+        # true when refused by the connection and to be retried later
+        acknowledge = self._acknowledge(job)
+        key = (type(job).__name__, job.priority)
+        start = time.perf_counter()
+
+        try:
+            job.solve(acknowledge)
+            self.job_metrics.record(key, time.perf_counter() - start, "solved")
+
+            return False
+
+        except ConnectionRefusedError:
+            if job.increment_retries() < MAX_RETRIES or job.durable:
+                self.job_metrics.record(key, time.perf_counter() - start, "retries")
+
+                return True
+
+            self.job_metrics.record(key, time.perf_counter() - start, "drops")
+
+        except Exception as exc:
+            self.job_metrics.record(key, time.perf_counter() - start, "failures")
 
-        elif priority is None:
-            for curr_priority in range(MIN_PRIORITY, MAX_PRIORITY):
-                self.resolve_jobs(user_id, priority=curr_priority)
+            print(f"Ill formed job of type {type(job)}")
+            print(exc)
 
+        # only the server removes a job from the outbox, a failed one is tried again on the
+        # next start, as its ratchets were already saved
+        return False
+
+    def _finish (self, user_jobs: UserJobs, job: Job, retry: bool) -> None:
+        with self._lock:
+            if retry:
+                job.backoff(time.monotonic())
+                self._push(user_jobs, job)
+
+            else:
+                self._done(user_jobs, job)
+
+    def _release (self, user_id: int, user_jobs: UserJobs) -> None:
+        with self._lock:
+            if len(user_jobs) == 0 and self.job_dict.get(user_id, None) is user_jobs:
+                self.job_dict.pop(user_id)
+
+    def _take_jobs (self, user_jobs: UserJobs, running: list[Job]) -> list[Job]:
+        # the most urgent jobs due, while they share the priority of the ones running
+        taken = []
+        now = time.monotonic()
+
+        with self._lock:
+            while len(user_jobs.heap) > 0 and user_jobs.heap[0][1] <= now:
+                priority = user_jobs.heap[0][0]
+                started = [ job for job in running + taken if job.priority == priority ]
+
+                if len(started) < len(running) + len(taken):
+                    break
+
+                if len(started) >= self.concurrency.get(priority, 1):
+                    break
+
+                job = heapq.heappop(user_jobs.heap)[3]
+
+                if job.chat_id is not None and user_jobs.tails.get(job.chat_id, None) is job:
+                    user_jobs.tails.pop(job.chat_id)
+
+                taken.append(job)
+
+        return taken
+
+    async def run_jobs (self, user_id: int) -> None:
+        """
+            Solves the jobs of the user due, those of different chats at the same time. The
+            next job of a chat only starts once the one before it is done, and a more
+            urgent job waits for the running ones, then runs before any other.\n
+        """
+        with self._lock:
+            user_jobs = self.job_dict.get(user_id, None)
+
+        if user_jobs is None:
             return
 
-        if MIN_PRIORITY <= priority <= 1:
-            if priority > MIN_PRIORITY and len(self.job_dict[user_id][priority - 1]) > 0:
-                return
+        running: dict[asyncio.Task, Job] = dict()
+        refused = False
 
-            l = self._resolve_jobs(self.job_dict[user_id][priority])
-            self.job_dict[user_id][priority] = l
+        while True:
+            # once refused, the running jobs are waited for and the others left queued
+            if not refused:
+                for job in self._take_jobs(user_jobs, list(running.values())):
+                    running[asyncio.create_task(asyncio.to_thread(self._solve, job))] = job
 
-        elif priority == 2 and chat_id is not None:
-            if priority > MIN_PRIORITY and len(self.job_dict[user_id][priority - 1]) > 0:
-                return
+            if len(running) == 0:
+                break
 
-            failed_jobs = self._resolve_jobs(self.job_dict[user_id][priority].get(chat_id, []))
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
 
-            if len(failed_jobs) > 0:
-                self.job_dict[user_id][priority][chat_id] = failed_jobs
+            for task in done:
+                retry = task.result()
+                self._finish(user_jobs, running.pop(task), retry)
 
-        elif priority == 2 and chat_id is None:
-            for chat_id in self.job_dict[user_id][priority].keys():
-                self.resolve_jobs(user_id, 2, chat_id)
+                refused = refused or retry
 
-        else:
-            raise PriorityRangeError
+        self._release(user_id, user_jobs)
+
+    def resolve_jobs (self, user_id: int, priority: int = None, chat_id: int = None) -> None:
+        if chat_id is not None and priority != self.chat_priority:
+            raise JobResolutionConfigurationError
 
+        elif priority is not None:
+            self._check_priority(priority)
 
-        for curr_priority in range(MIN_PRIORITY, MAX_PRIORITY):
-            if len(self.job_dict[user_id][curr_priority]) > 0:
-                return
+        chat_id = str(chat_id) if chat_id is not None else None
+        skipped = []
+
+        with self._lock:
+            user_jobs = self.job_dict.get(user_id, None)
+
+        if user_jobs is None:
+            return
+
+        while True:
+            with self._lock:
+                # a job waits while a more urgent one is still pending, even if not due
+                if priority is not None and len(user_jobs.heap) > 0 and (
+                    user_jobs.heap[0][0] < priority
+                ):
+                    break
+
+                job = self._next_job(user_jobs, time.monotonic(), priority, chat_id, skipped)
+
+            if job is None:
+                break
+
+            if self._solve(job):
+                # keeps its place in the chat, and blocks the less urgent jobs meanwhile,
+                # the others would be refused too until the connection is back
+                self._finish(user_jobs, job, True)
+                break
+
+            self._finish(user_jobs, job, False)
+
+        with self._lock:
+            for entry in skipped:
+                heapq.heappush(user_jobs.heap, entry)
 
-        self.job_dict.pop(user_id, None)
\ No newline at end of file
+        self._release(user_id, user_jobs)
@@ -0,0 +1,187 @@
+import dataclasses as dc
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+from cryptography.exceptions import InvalidTag
+
+from app.util import crypto
+from app.util.keystore import Field, pack_record, sync_dir, unpack_record
+
+# seconds a commit waits for other transactions to share its fsync
+JOURNAL_WINDOW = 0.002
+
+# sealed transaction length
+FRAME_HEADER = struct.Struct("!I")
+# chat id length, tmp flag
+TRANSACTION_HEADER = struct.Struct("!H?")
+# marks a ratchet removed from the chat
+DELETED_FIELD = 0
+
+JOURNAL_AAD = b"journal"
+
+Changes = dict[str, Field | None]
+Transaction = tuple[str, bool, Changes]
+
+def pack_transaction (chat_id: str, tmp: bool, changes: Changes) -> bytes:
+    bchat_id = str(chat_id).encode("utf-8")
+
+    return TRANSACTION_HEADER.pack(len(bchat_id), tmp) + bchat_id + pack_record({
+        ratchet_name: (DELETED_FIELD, b"") if field is None else field
+        for ratchet_name, field in changes.items()
+    })
+
+def unpack_transaction (packed: bytes) -> Transaction:
+    chat_id_len, tmp = TRANSACTION_HEADER.unpack_from(packed)
+    offset = TRANSACTION_HEADER.size
+
+    chat_id = packed[ offset : offset + chat_id_len ].decode("utf-8")
+    record = unpack_record(packed[ offset + chat_id_len : ])
+
+    return chat_id, tmp, {
+        ratchet_name: None if field[0] == DELETED_FIELD else field
+        for ratchet_name, field in record.items()
+    }
+
+@dc.dataclass()
+class RatchetJournal:
+    """
+        Append-only log of the ratchet changes not yet written to the keystore. Each
+        transaction is a single sealed frame, so a torn write is never replayed, and
+        the transactions appended within a short window share a single fsync.\n
+        :path Path:         the directory holding the journal segments\n
+        :window float:      seconds a commit waits before syncing the journal\n
+    """
+    path: Path
+    window: float = dc.field(default=JOURNAL_WINDOW)
+
+    segment: int = dc.field(init=False, default=0)
+    appended: int = dc.field(init=False, default=0)
+    committed: int = dc.field(init=False, default=0)
+
+    _file: object = dc.field(init=False, default=None)
+    _committing: bool = dc.field(init=False, default=False)
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+    _committed: threading.Condition = dc.field(init=False, default=None)
+
+    def __post_init__ (self) -> None:
+        self._committed = threading.Condition(self._lock)
+
+    def _segment_path (self, segment: int) -> Path:
+        return self.path / f"{segment:08d}.log"
+
+    def segments (self) -> list[Path]:
+        try:
+            return sorted(self.path.glob("*.log"))
+
+        except FileNotFoundError:
+            return []
+
+    def _open (self) -> None:
+        if self._file is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            existing = self.segments()
+            if len(existing) > 0:
+                self.segment = max(self.segment, int(existing[-1].stem) + 1)
+
+            self._file = open(self._segment_path(self.segment), "ab")
+            sync_dir(self.path)
+
+    def append (self, chat_id: str, tmp: bool, changes: Changes) -> int:
+        sealed = crypto.keystore.seal(pack_transaction(chat_id, tmp, changes), JOURNAL_AAD)
+
+        with self._lock:
+            self._open()
+            self._file.write(FRAME_HEADER.pack(len(sealed)) + sealed)
+            self.appended += 1
+
+            return self.appended
+
+    def _sync (self) -> None:
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+        self.committed = self.appended
+        self._committed.notify_all()
+
+    def wait (self, transaction: int) -> None:
+        with self._committed:
+            while self.committed < transaction:
+                if self._committing:
+                    self._committed.wait()
+                    continue
+
+                # the first waiter commits for every transaction appended in the window
+                self._committing = True
+                self._committed.release()
+
+                try:
+                    time.sleep(self.window)
+
+                finally:
+                    self._committed.acquire()
+
+                try:
+                    self._sync()
+
+                finally:
+                    self._committing = False
+                    self._committed.notify_all()
+
+    def rotate (self) -> list[Path]:
+        """
+            Starts a new segment, returning the older ones, which only hold transactions
+            appended before the rotation.\n
+        """
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+
+                self._file = None
+                self.segment += 1
+
+            return self.segments()
+
+    def discard (self, segments: list[Path]) -> None:
+        for segment_path in segments:
+            segment_path.unlink(missing_ok=True)
+
+    def recover (self) -> list[Transaction]:
+        transactions = []
+
+        for segment_path in self.segments():
+            journal = segment_path.read_bytes()
+            offset = 0
+
+            while offset + FRAME_HEADER.size <= len(journal):
+                frame_len, = FRAME_HEADER.unpack_from(journal, offset)
+                offset += FRAME_HEADER.size
+                frame = journal[ offset : offset + frame_len ]
+
+                # the transaction written when the crash happened is dropped whole
+                if len(frame) < frame_len:
+                    break
+
+                try:
+                    transactions.append(
+                        unpack_transaction(crypto.keystore.unseal(frame, JOURNAL_AAD))
+                    )
+
+                except (InvalidTag, ValueError, struct.error):
+                    break
+
+                offset += frame_len
+
+        return transactions
+
+    def close (self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._sync()
+                self._file.close()
+                self._file = None
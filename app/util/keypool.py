@@ -0,0 +1,127 @@
+import base64
+import dataclasses as dc
+import threading
+import time
+from collections import deque
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+# key pairs kept ready, and the most the refill thread generates each second
+KEY_POOL_SIZE = 64
+KEY_POOL_REFILL_RATE = 2000
+# keys generated by the refill thread before it checks the pool again
+REFILL_BATCH = 16
+
+KeyPair = tuple[X25519PrivateKey, str]
+
+def generate_pair () -> KeyPair:
+    pvt_key = X25519PrivateKey.generate()
+    pbkey = base64.b64encode(pvt_key.public_key().public_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PublicFormat.Raw
+    )).decode("utf-8")
+
+    return pvt_key, pbkey
+
+@dc.dataclass()
+class KeyPool:
+    """
+        Fresh X25519 key pairs, generated ahead of time by a background thread so the
+        dh rotations and the chat creation only pop one. A key leaves the pool once and
+        is never handed out again.\n
+        :size int:              key pairs kept ready\n
+        :refill_rate float:     most key pairs generated each second by the refill thread\n
+    """
+    size: int = dc.field(default=KEY_POOL_SIZE)
+    refill_rate: float = dc.field(default=KEY_POOL_REFILL_RATE)
+
+    pairs: deque[KeyPair] = dc.field(init=False, default_factory=deque)
+    hits: int = dc.field(init=False, default=0)
+    misses: int = dc.field(init=False, default=0)
+
+    _reserved: int = dc.field(init=False, default=0)
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+    _wanted: threading.Event = dc.field(init=False, default_factory=threading.Event)
+
+    def __post_init__ (self) -> None:
+        # the refill thread fills the pool as soon as it starts
+        self._wanted.set()
+
+    @property
+    def hit_rate (self) -> float:
+        with self._lock:
+            taken = self.hits + self.misses
+
+            return self.hits / taken if taken > 0 else 0.0
+
+    def metrics (self) -> dict[str, float]:
+        with self._lock:
+            taken = self.hits + self.misses
+
+            return {
+                "available": len(self.pairs),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / taken if taken > 0 else 0.0
+            }
+
+    def take_pair (self) -> KeyPair:
+        with self._lock:
+            pair = self.pairs.popleft() if len(self.pairs) > 0 else None
+
+            if pair is not None:
+                self.hits += 1
+
+            else:
+                self.misses += 1
+
+        self._wanted.set()
+
+        # an empty pool never blocks the caller, the key is generated inline
+        return pair if pair is not None else generate_pair()
+
+    def take (self) -> X25519PrivateKey:
+        return self.take_pair()[0]
+
+    def fill (self, count: int = None) -> int:
+        # generated out of the lock, so the callers keep taking keys meanwhile, the keys
+        # being generated by another fill count as ready, so the pool never overfills
+        with self._lock:
+            missing = self.size - len(self.pairs) - self._reserved
+            missing = missing if count is None else min(missing, count)
+
+            if missing <= 0:
+                return 0
+
+            self._reserved += missing
+
+        pairs = []
+        try:
+            pairs = [ generate_pair() for _ in range(missing) ]
+
+        finally:
+            with self._lock:
+                self._reserved -= missing
+                self.pairs.extend(pairs)
+
+        return missing
+
+    def clear (self) -> None:
+        with self._lock:
+            self.pairs.clear()
+
+    def refill_handler (self) -> None:
+        while True:
+            # sleeps until a key is taken, then refills no faster than the refill rate
+            self._wanted.wait()
+            self._wanted.clear()
+
+            while True:
+                start = time.monotonic()
+                generated = self.fill(REFILL_BATCH)
+
+                if generated == 0:
+                    break
+
+                time.sleep(max(0.0, generated / self.refill_rate - (time.monotonic() - start)))
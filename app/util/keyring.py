@@ -0,0 +1,44 @@
+import dataclasses as dc
+import threading
+
+from app.util import crypto
+from app.util.crypto import PrivateKey
+
+# long term keys of the user, kept unlocked on memory while logged in
+IDENTITY_KEYS = ("id_key", "sgn_key", "ed_key")
+
+@dc.dataclass()
+class Keyring:
+    """
+        The identity, signed prekey and signing keys of the user, read from the keystore
+        once on login and dropped on logout.\n
+        :keys dict:     the unlocked keys, by name\n
+    """
+    keys: dict[str, PrivateKey] = dc.field(init=False, default_factory=dict)
+
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+
+    @property
+    def unlocked (self) -> bool:
+        return len(self.keys) > 0
+
+    def unlock (self, keys: dict[str, PrivateKey] = None) -> None:
+        if keys is None:
+            keys = { key_name: crypto.load_private_key(key_name) for key_name in IDENTITY_KEYS }
+
+        with self._lock:
+            self.keys = dict(keys)
+
+    def lock (self) -> None:
+        with self._lock:
+            self.keys = dict()
+
+    def load (self, key_name: str) -> PrivateKey:
+        with self._lock:
+            pvt_key = self.keys.get(key_name, None)
+
+        # any other key, or any key while locked, is still read from the keystore
+        if pvt_key is None:
+            pvt_key = crypto.load_private_key(key_name)
+
+        return pvt_key
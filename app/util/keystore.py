@@ -0,0 +1,332 @@
+import dataclasses as dc
+import os
+import shutil
+import sqlite3
+import struct
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+# name length, field type, value length
+FIELD_HEADER = struct.Struct("!BBI")
+NONCE_SIZE = 12
+SALT_SIZE = 16
+
+FILES_BACKEND = "files"
+SQLITE_BACKEND = "sqlite"
+DATABASE_NAME = "keystore.db"
+
+Field = tuple[int, bytes]
+Record = dict[str, Field]
+
+def pack_record (record: Record) -> bytes:
+    packed = bytearray()
+    for name, (field_type, value) in record.items():
+        bname = name.encode("utf-8")
+
+        packed += FIELD_HEADER.pack(len(bname), field_type, len(value))
+        packed += bname
+        packed += value
+
+    return bytes(packed)
+
+def unpack_record (packed: bytes) -> Record:
+    record = dict()
+    view = memoryview(packed)
+    offset = 0
+
+    while offset < len(view):
+        name_len, field_type, value_len = FIELD_HEADER.unpack_from(view, offset)
+        offset += FIELD_HEADER.size
+
+        name = bytes(view[ offset : offset + name_len ]).decode("utf-8")
+        offset += name_len
+
+        record[name] = (field_type, bytes(view[ offset : offset + value_len ]))
+        offset += value_len
+
+    return record
+
+def sync_dir (path: Path) -> None:
+    # a rename only survives a crash once its directory is synced
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+
+    finally:
+        os.close(dir_fd)
+
+@dc.dataclass()
+class Keystore:
+    """
+        Stores each chat session and each private key as a single binary record,
+        sealed with AES-GCM under a key derived only once from the SECRET_KEY.\n
+        :path Path:     the directory holding the records\n
+        :secret str:    name of the environment variable holding the password\n
+    """
+    path: Path
+    secret: str = dc.field(default="SECRET_KEY")
+
+    _seal_key: AESGCM = dc.field(init=False, default=None)
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+
+    def _cipher (self) -> AESGCM:
+        if self._seal_key is None:
+            salt_path = self.path / "salt"
+
+            if not salt_path.exists():
+                self.path.mkdir(parents=True, exist_ok=True)
+                salt_path.write_bytes(os.urandom(SALT_SIZE))
+
+            kdf = Scrypt(salt=salt_path.read_bytes(), length=32, n=2 ** 14, r=8, p=1)
+            self._seal_key = AESGCM(kdf.derive(os.environ[self.secret].encode("utf-8")))
+
+        return self._seal_key
+
+    def _record_path (self, kind: str, name: str) -> Path:
+        return self.path / kind / f"{name}.bin"
+
+    def seal (self, data: bytes, associated_data: bytes) -> bytes:
+        nonce = os.urandom(NONCE_SIZE)
+
+        return nonce + self._cipher().encrypt(nonce, data, associated_data)
+
+    def unseal (self, sealed: bytes, associated_data: bytes) -> bytes:
+        return self._cipher().decrypt(
+            sealed[ : NONCE_SIZE ], sealed[ NONCE_SIZE : ], associated_data
+        )
+
+    def read_record (self, kind: str, name: str) -> Record:
+        try:
+            sealed = self._record_path(kind, name).read_bytes()
+
+        except FileNotFoundError:
+            return None
+
+        return unpack_record(self.unseal(sealed, f"{kind}/{name}".encode("utf-8")))
+
+    def write_record (self, kind: str, name: str, record: Record, durable: bool = False) -> None:
+        record_path = self._record_path(kind, name)
+        record_path.parent.mkdir(parents=True, exist_ok=True)
+
+        sealed = self.seal(pack_record(record), f"{kind}/{name}".encode("utf-8"))
+
+        # the record is replaced at once, a crash never leaves it half written
+        tmp_path = record_path.with_suffix(".part")
+        with open(tmp_path, "wb") as record_file:
+            record_file.write(sealed)
+
+            if durable:
+                record_file.flush()
+                os.fsync(record_file.fileno())
+
+        os.replace(tmp_path, record_path)
+
+        if durable:
+            sync_dir(record_path.parent)
+
+    def write_records (self, kind: str, records: dict[str, Record], durable: bool = False) -> None:
+        for name, record in records.items():
+            self.write_record(kind, name, record, durable=durable)
+
+    def update_record (
+        self, kind: str, name: str, changes: dict[str, Field | None], durable: bool = False
+    ) -> None:
+        with self._lock:
+            record = self.read_record(kind, name) or dict()
+
+            for field_name, field in changes.items():
+                if field is None:
+                    record.pop(field_name, None)
+
+                else:
+                    record[field_name] = field
+
+            if len(record) > 0:
+                self.write_record(kind, name, record, durable=durable)
+
+            else:
+                self.delete_record(kind, name)
+
+    def delete_record (self, kind: str, name: str) -> None:
+        record_path = self._record_path(kind, name)
+
+        if record_path.exists():
+            os.remove(record_path)
+
+    def delete_records (self, kind: str, names: list[str]) -> None:
+        for name in names:
+            self.delete_record(kind, name)
+
+    def list_records (self, kind: str) -> list[str]:
+        try:
+            return [
+                item.removesuffix(".bin")
+                for item in os.listdir(self.path / kind)
+                if item.endswith(".bin")
+            ]
+
+        except FileNotFoundError:
+            return []
+
+    def export_records (self, kind: str) -> Iterator[tuple[str, Record]]:
+        for name in self.list_records(kind):
+            record = self.read_record(kind, name)
+
+            if record is not None:
+                yield name, record
+
+    def clean (self, kind: str = None) -> None:
+        if kind is not None:
+            shutil.rmtree(self.path / kind, ignore_errors=True)
+
+        else:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self._seal_key = None
+
+@dc.dataclass()
+class SqliteKeystore (Keystore):
+    """
+        Keeps every record in a single SQLite database in WAL mode, indexed by kind and
+        name, instead of one file per record. The records are sealed as on the files.\n
+        :path Path:     the directory holding the database\n
+        :secret str:    name of the environment variable holding the password\n
+    """
+    _conn: sqlite3.Connection = dc.field(init=False, default=None)
+    _db_lock: threading.RLock = dc.field(init=False, default_factory=threading.RLock)
+
+    def _db (self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+
+            self._conn = sqlite3.connect(
+                self.path / DATABASE_NAME, check_same_thread=False, isolation_level=None
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS records ("
+                " kind TEXT NOT NULL, name TEXT NOT NULL, sealed BLOB NOT NULL,"
+                " PRIMARY KEY (kind, name)"
+                ") WITHOUT ROWID"
+            )
+
+        return self._conn
+
+    def read_record (self, kind: str, name: str) -> Record:
+        with self._db_lock:
+            row = self._db().execute(
+                "SELECT sealed FROM records WHERE kind = ? AND name = ?", (kind, name)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return unpack_record(self.unseal(row[0], f"{kind}/{name}".encode("utf-8")))
+
+    def write_records (self, kind: str, records: dict[str, Record], durable: bool = False) -> None:
+        sealed = [
+            (kind, name, self.seal(pack_record(record), f"{kind}/{name}".encode("utf-8")))
+            for name, record in records.items()
+        ]
+
+        with self._db_lock:
+            conn = self._db()
+
+            # a durable write waits for the wal to reach the disk, the others only for the os
+            if durable:
+                conn.execute("PRAGMA synchronous=FULL")
+
+            try:
+                with conn:
+                    conn.execute("BEGIN")
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO records (kind, name, sealed) VALUES (?, ?, ?)",
+                        sealed
+                    )
+
+            finally:
+                if durable:
+                    conn.execute("PRAGMA synchronous=NORMAL")
+
+    def write_record (self, kind: str, name: str, record: Record, durable: bool = False) -> None:
+        self.write_records(kind, { name: record }, durable=durable)
+
+    def delete_record (self, kind: str, name: str) -> None:
+        with self._db_lock:
+            self._db().execute("DELETE FROM records WHERE kind = ? AND name = ?", (kind, name))
+
+    def delete_records (self, kind: str, names: list[str]) -> None:
+        with self._db_lock:
+            with self._db() as conn:
+                conn.execute("BEGIN")
+                conn.executemany(
+                    "DELETE FROM records WHERE kind = ? AND name = ?",
+                    [ (kind, name) for name in names ]
+                )
+
+    def list_records (self, kind: str) -> list[str]:
+        with self._db_lock:
+            return [
+                row[0] for row in self._db().execute(
+                    "SELECT name FROM records WHERE kind = ?", (kind,)
+                )
+            ]
+
+    def export_records (self, kind: str) -> Iterator[tuple[str, Record]]:
+        # a single scan of the index, every record of the kind already unsealed
+        with self._db_lock:
+            rows = self._db().execute(
+                "SELECT name, sealed FROM records WHERE kind = ?", (kind,)
+            ).fetchall()
+
+        for name, sealed in rows:
+            yield name, unpack_record(self.unseal(sealed, f"{kind}/{name}".encode("utf-8")))
+
+    def migrate_files (self) -> int:
+        # the sealed files of the file keystore are moved as they are, with the same salt
+        migrated = 0
+
+        for kind_path in [ item for item in self.path.iterdir() if item.is_dir() ]:
+            record_paths = list(kind_path.glob("*.bin"))
+            if len(record_paths) == 0:
+                continue
+
+            with self._db_lock:
+                with self._db() as conn:
+                    conn.execute("BEGIN")
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO records (kind, name, sealed) VALUES (?, ?, ?)",
+                        [
+                            (kind_path.name, record_path.stem, record_path.read_bytes())
+                            for record_path in record_paths
+                        ]
+                    )
+
+            for record_path in record_paths:
+                os.remove(record_path)
+
+            migrated += len(record_paths)
+
+        return migrated
+
+    def clean (self, kind: str = None) -> None:
+        with self._db_lock:
+            if kind is not None:
+                self._db().execute("DELETE FROM records WHERE kind = ?", (kind,))
+                return
+
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+            super().clean()
+
+def open_keystore (path: Path, backend: str = SQLITE_BACKEND) -> Keystore:
+    if backend == SQLITE_BACKEND:
+        return SqliteKeystore(path)
+
+    return Keystore(path)
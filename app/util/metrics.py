@@ -0,0 +1,92 @@
+import bisect
+import dataclasses as dc
+import threading
+from typing import Any
+
+# upper bounds, in seconds, of the buckets of the solve latency, the last one is unbounded
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+# job class and priority
+MetricsKey = tuple[str, int]
+
+@dc.dataclass()
+class Histogram:
+    """
+        Counts the observed values in fixed buckets, cheap enough to be updated on
+        every job solved.\n
+        :buckets tuple:     upper bound of each bucket, in ascending order\n
+    """
+    buckets: tuple[float, ...] = dc.field(default=LATENCY_BUCKETS)
+
+    counts: list[int] = dc.field(init=False, default=None)
+    count: int = dc.field(init=False, default=0)
+    total: float = dc.field(init=False, default=0.0)
+
+    def __post_init__ (self) -> None:
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe (self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot (self) -> dict[str, Any]:
+        return {
+            "buckets": {
+                **{ f"le_{bound}": count for bound, count in zip(self.buckets, self.counts) },
+                "inf": self.counts[-1]
+            },
+            "count": self.count,
+            "mean": self.total / self.count if self.count > 0 else 0.0
+        }
+
+@dc.dataclass()
+class JobStats:
+    """
+        What happened to the jobs of a single class and priority.\n
+        :solved int:        jobs solved\n
+        :retries int:       attempts refused by the connection\n
+        :drops int:         jobs not durable dropped after MAX_RETRIES refused attempts\n
+        :failures int:      jobs that failed on any other error\n
+        :latency Histogram: seconds each solve took, refused or not\n
+    """
+    solved: int = dc.field(default=0)
+    retries: int = dc.field(default=0)
+    drops: int = dc.field(default=0)
+    failures: int = dc.field(default=0)
+    latency: Histogram = dc.field(default_factory=Histogram)
+
+    def snapshot (self) -> dict[str, Any]:
+        return {
+            "solved": self.solved,
+            "retries": self.retries,
+            "drops": self.drops,
+            "failures": self.failures,
+            "latency": self.latency.snapshot()
+        }
+
+@dc.dataclass()
+class JobMetrics:
+    """
+        The counters of the job queue, for each job class and priority.\n
+        :stats dict:    the counters of each job class and priority\n
+    """
+    stats: dict[MetricsKey, JobStats] = dc.field(init=False, default_factory=dict)
+
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+
+    def record (self, key: MetricsKey, elapsed: float, outcome: str) -> None:
+        # the outcome is the counter incremented, solved, retries, drops or failures
+        with self._lock:
+            stats = self.stats.setdefault(key, JobStats())
+
+            stats.latency.observe(elapsed)
+            setattr(stats, outcome, getattr(stats, outcome) + 1)
+
+    def snapshot (self) -> dict[MetricsKey, dict[str, Any]]:
+        with self._lock:
+            return { key: stats.snapshot() for key, stats in self.stats.items() }
+
+    def reset (self) -> None:
+        with self._lock:
+            self.stats.clear()
@@ -104,6 +104,29 @@ class Mongo:
 
         return result_id
 
+    def insert_many (self, data: list[dict[str, Any]]) -> list[Any]:
+        """
+            Inserts every formated dict[str, Any] to the connected collection, in a single
+            round trip.
+            :param data:    the list of dict[str, Any]
+            :returns:       the object ids, in the order of the data
+        """
+        if len(data) == 0:
+            return []
+
+        return self.collection.insert_many(data, ordered=False).inserted_ids
+
+    def bulk_write (self, operations: list[Any]) -> bool:
+        """
+            Sends the write operations to the connected collection, in a single round trip.
+            :param operations:  the pymongo write operations, such as UpdateOne
+            :returns:           true if the writes have been acknoledged
+        """
+        if len(operations) == 0:
+            return True
+
+        return self.collection.bulk_write(operations, ordered=False).acknowledged
+
     def update_one (
         self, filter: dict[str, Any], update_data: dict[str, dict[str, Any]]
     ) -> bool:
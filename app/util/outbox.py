@@ -0,0 +1,110 @@
+import dataclasses as dc
+import itertools
+import threading
+import time
+from typing import Any
+
+from app.util import crypto, wire
+
+OUTBOX = "outbox"
+# seconds a job waits for the others enqueued meanwhile to share its write
+OUTBOX_WINDOW = 0.002
+
+StoredJob = dict[str, Any]
+
+def pack_job (job: StoredJob) -> bytes:
+    return wire.encode(job)
+
+def unpack_job (packed: bytes) -> StoredJob:
+    return wire.decode(packed)
+
+@dc.dataclass()
+class Outbox:
+    """
+        The jobs not yet acknowledged by the server, kept on the keystore so they are
+        sent again after a restart. The jobs stored within a short window share a single
+        write, and each one is only removed once the server acknowledges it.\n
+        :window float:      seconds a job waits before the buffered ones are written\n
+    """
+    window: float = dc.field(default=OUTBOX_WINDOW)
+
+    appended: int = dc.field(init=False, default=0)
+    committed: int = dc.field(init=False, default=0)
+
+    _ids: itertools.count = dc.field(init=False, default=None)
+    _buffer: dict[str, StoredJob] = dc.field(init=False, default_factory=dict)
+    _committing: bool = dc.field(init=False, default=False)
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+    _committed: threading.Condition = dc.field(init=False, default=None)
+
+    def __post_init__ (self) -> None:
+        self._committed = threading.Condition(self._lock)
+
+    def _next_name (self) -> str:
+        # the names sort as the jobs were enqueued, and go on from the ones left stored
+        if self._ids is None:
+            names = crypto.keystore.list_records(OUTBOX)
+            self._ids = itertools.count(max((int(name, 16) for name in names), default=-1) + 1)
+
+        return f"{next(self._ids):016x}"
+
+    def store (self, job: StoredJob) -> str:
+        with self._committed:
+            name = self._next_name()
+            self._buffer[name] = job
+            self.appended += 1
+            transaction = self.appended
+
+            while self.committed < transaction:
+                if self._committing:
+                    self._committed.wait()
+                    continue
+
+                # the first waiter writes every job buffered in the window
+                self._committing = True
+                self._committed.release()
+
+                try:
+                    time.sleep(self.window)
+
+                finally:
+                    self._committed.acquire()
+
+                buffer, self._buffer = self._buffer, dict()
+                appended = self.appended
+                self._committed.release()
+
+                try:
+                    crypto.keystore.write_records(OUTBOX, {
+                        job_name: { "job": (crypto.JOB_FIELD, pack_job(stored)) }
+                        for job_name, stored in buffer.items()
+                    })
+
+                finally:
+                    self._committed.acquire()
+                    self._committing = False
+                    self.committed = appended
+                    self._committed.notify_all()
+
+        return name
+
+    def ack (self, name: str) -> None:
+        with self._lock:
+            # acknowledged before its write, the job never reaches the keystore
+            if self._buffer.pop(name, None) is not None:
+                return
+
+        crypto.keystore.delete_record(OUTBOX, name)
+
+    def ack_many (self, names: list[str]) -> None:
+        with self._lock:
+            names = [ name for name in names if self._buffer.pop(name, None) is None ]
+
+        crypto.keystore.delete_records(OUTBOX, names)
+
+    def load (self) -> list[tuple[str, StoredJob]]:
+        # a single scan of the keystore, in the order the jobs were enqueued
+        return sorted(
+            (name, unpack_job(record["job"][1]))
+            for name, record in crypto.keystore.export_records(OUTBOX)
+        )
@@ -0,0 +1,145 @@
+import dataclasses as dc
+import struct
+import threading
+from collections.abc import Callable
+
+from app.util import crypto
+from app.util.crypto import PrivateKey
+from app.util.keystore import Record
+
+# one time prekeys generated at once, and the pool size that triggers a new batch
+OPK_BATCH = 200
+OPK_LOW_WATER = 50
+
+PREKEYS_RECORD = "opk"
+NEXT_ID = "next_id"
+# ids of the keys generated for an upload the server has not acknowledged yet
+PENDING_UPLOAD = "pending_upload"
+
+OpkeyUpload = list[dict[str, int | str]]
+
+@dc.dataclass()
+class PrekeyPool:
+    """
+        The one time prekeys of the user, all sealed in a single keystore record and
+        indexed by the id the server hands back once a key is used.\n
+        :batch_size int:    keys the pool is refilled up to\n
+        :low_water int:     number of keys left that triggers the refill\n
+    """
+    batch_size: int = dc.field(default=OPK_BATCH)
+    low_water: int = dc.field(default=OPK_LOW_WATER)
+
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+    _replenish_lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+
+    def _record (self) -> Record:
+        return crypto.keystore.read_record("prekeys", PREKEYS_RECORD) or dict()
+
+    def _next_id (self, record: Record) -> int:
+        if NEXT_ID in record:
+            return struct.unpack("!I", record[NEXT_ID][1])[0]
+
+        # the ids of the keys generated one file each, before the pool, are never reused
+        legacy_ids = [
+            int(key_name.removesuffix("_opk"))
+            for key_name in crypto.keystore.list_records("keys")
+            if key_name.endswith("_opk") and key_name.removesuffix("_opk").isdigit()
+        ]
+
+        return max(legacy_ids, default=0) + 1
+
+    def _pending_ids (self, record: Record) -> list[int]:
+        if PENDING_UPLOAD not in record:
+            return []
+
+        packed = record[PENDING_UPLOAD][1]
+
+        return list(struct.unpack(f"!{len(packed) // 4}I", packed))
+
+    def available (self) -> int:
+        # the keys the server never received can't be handed out
+        record = self._record()
+        pending = { str(key_id) for key_id in self._pending_ids(record) }
+
+        return len([
+            field_name for field_name in record
+            if field_name not in (NEXT_ID, PENDING_UPLOAD) and field_name not in pending
+        ])
+
+    def pending (self) -> OpkeyUpload:
+        record = self._record()
+
+        return [
+            { "id": key_id, "key": crypto.public_key(crypto.decode_ratchet(record[str(key_id)])) }
+            for key_id in self._pending_ids(record) if str(key_id) in record
+        ]
+
+    def generate (self, count: int, pending: bool = False) -> OpkeyUpload:
+        with self._lock:
+            record = self._record()
+            next_id = self._next_id(record)
+            keys = {
+                key_id: crypto.generate_private_key()
+                for key_id in range(next_id, next_id + count)
+            }
+
+            changes = { str(key_id): crypto.encode_ratchet(key) for key_id, key in keys.items() }
+            changes[NEXT_ID] = (crypto.COUNTER_FIELD, struct.pack("!I", next_id + count))
+
+            # kept apart from the available keys until the server acknowledges the upload
+            if pending:
+                key_ids = self._pending_ids(record) + list(keys)
+                changes[PENDING_UPLOAD] = (
+                    crypto.COUNTER_FIELD, struct.pack(f"!{len(key_ids)}I", *key_ids)
+                )
+
+            crypto.keystore.update_record("prekeys", PREKEYS_RECORD, changes)
+
+        return [ { "id": key_id, "key": crypto.public_key(key) } for key_id, key in keys.items() ]
+
+    def uploaded (self) -> None:
+        with self._lock:
+            crypto.keystore.update_record("prekeys", PREKEYS_RECORD, { PENDING_UPLOAD: None })
+
+    def load (self, key_id: int) -> PrivateKey:
+        field = self._record().get(str(key_id), None)
+        if field is None:
+            return crypto.load_private_key(f"{key_id}_opk")
+
+        return crypto.decode_ratchet(field)
+
+    def consume (self, key_ids: list[int]) -> None:
+        # a one time prekey the server handed out is never used again
+        with self._lock:
+            crypto.keystore.update_record(
+                "prekeys", PREKEYS_RECORD, { str(key_id): None for key_id in key_ids }
+            )
+
+        for key_id in key_ids:
+            crypto.keystore.delete_record("keys", f"{key_id}_opk")
+
+    def low (self) -> bool:
+        return self.available() < self.low_water
+
+    def replenish (self, upload: Callable[[OpkeyUpload], None]) -> int:
+        # a single refill runs at a time, the others find the pool already filled
+        if not self._replenish_lock.acquire(blocking=False):
+            return 0
+
+        try:
+            available = self.available()
+            if available >= self.low_water:
+                return 0
+
+            # the keys of a failed upload are sent again, along with the ones still missing
+            opkeys = self.pending()
+            opkeys += self.generate(max(self.batch_size - available - len(opkeys), 0), True)
+
+            # on a failure the batch stays marked, for the next refill to upload it
+            upload(opkeys)
+            self.uploaded()
+
+            return len(opkeys)
+
+        finally:
+            self._replenish_lock.release()
@@ -0,0 +1,279 @@
+import dataclasses as dc
+import threading
+import time
+from collections import OrderedDict
+
+from app.util import crypto
+from app.util.crypto import PublicKey, Ratchet, SkippedKeys, SymmetricRatchet
+from app.util.journal import RatchetJournal
+
+CACHE_SIZE = 256
+FLUSH_INTERVAL = 0.5
+# message keys each cached chain derives ahead of time, 0 disables it
+LOOKAHEAD = 16
+LOOKAHEAD_CHAINS = ("snd_ratchet", "rcv_ratchet")
+
+Session = dict[str, Ratchet | PublicKey]
+SessionKey = tuple[str, bool]
+PendingWrite = tuple[str, str, bool]
+
+# marks a ratchet that must be removed from the disk on the next flush
+DELETED = object()
+
+def _live_ratchet (ratchet: Ratchet | str) -> Ratchet | PublicKey:
+    # public ratchets are stored encoded, but are loaded from the disk as keys
+    if isinstance(ratchet, str):
+        return crypto.load_public_key(ratchet)
+
+    return crypto.copy_ratchet(ratchet)
+
+def _moved_ratchet (ratchet: Ratchet | PublicKey) -> Ratchet | PublicKey:
+    # the keys derived ahead go along with the chain, a single chain ever holds them
+    if isinstance(ratchet, SymmetricRatchet):
+        return ratchet.move()
+
+    return crypto.copy_ratchet(ratchet)
+
+def _stored_ratchet (ratchet: Ratchet | str) -> Ratchet | str:
+    # only the state and count of a chain are written, never the keys derived ahead
+    if isinstance(ratchet, SymmetricRatchet):
+        return SymmetricRatchet(ratchet.state, ratchet.count)
+
+    return crypto.copy_ratchet(ratchet)
+
+def _wipe_session (session: Session) -> None:
+    # the keys derived ahead of time never outlive the cached session
+    crypto.wipe_ratchets(session.values())
+
+@dc.dataclass()
+class SessionCache:
+    """
+        In-memory cache of the chat ratchets, keyed by chat id. Every change is kept
+        on memory and written to the disk in batches by the flush handler thread.\n
+        :max_size int:          number of chats kept on memory before evicting the LRU\n
+        :flush_interval float:  seconds between two write-behind flushes\n
+        :lookahead int:         message keys derived ahead of time between the flushes\n
+        :journal RatchetJournal: makes every change durable before the flush, if given\n
+    """
+    max_size: int = dc.field(default=CACHE_SIZE)
+    flush_interval: float = dc.field(default=FLUSH_INTERVAL)
+    lookahead: int = dc.field(default=LOOKAHEAD)
+    journal: RatchetJournal = dc.field(default=None)
+
+    sessions: OrderedDict[SessionKey, Session] = dc.field(
+        init=False, default_factory=OrderedDict
+    )
+    pending: dict[PendingWrite, Ratchet | str] = dc.field(init=False, default_factory=dict)
+
+    _lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+    _io_lock: threading.Lock = dc.field(init=False, default_factory=threading.Lock)
+
+    def _session (self, chat_id: int, tmp: bool) -> Session:
+        key = (str(chat_id), tmp)
+
+        with self._lock:
+            if key in self.sessions:
+                self.sessions.move_to_end(key)
+
+                return self.sessions[key]
+
+        # the io lock keeps the disk from being read while a batch is being written
+        with self._io_lock:
+            ratchets = crypto.read_ratchets(chat_id, tmp)
+
+            with self._lock:
+                if key not in self.sessions:
+                    # evicted sessions may still have changes waiting for the next flush
+                    for (pending_id, ratchet_name, pending_tmp), ratchet in self.pending.items():
+                        if pending_id != key[0] or pending_tmp != tmp:
+                            continue
+
+                        file_name = f"tmp-{ratchet_name}" if tmp else ratchet_name
+                        if ratchet is DELETED:
+                            ratchets.pop(file_name, None)
+
+                        else:
+                            ratchets[file_name] = _live_ratchet(ratchet)
+
+                    self.sessions[key] = ratchets
+
+                    while len(self.sessions) > self.max_size:
+                        _wipe_session(self.sessions.popitem(last=False)[1])
+
+                self.sessions.move_to_end(key)
+
+                return self.sessions[key]
+
+    def load_ratchets (
+        self, chat_id: int, tmp: bool = False
+    ) -> tuple[dict[str, Ratchet], bytes]:
+        session = self._session(chat_id, tmp)
+
+        # the chains take the keys derived ahead, given back to the session when saved
+        with self._lock:
+            ratchets = {
+                name: _moved_ratchet(ratchet) for name, ratchet in session.items()
+            }
+
+        pbkey = None if tmp else ratchets.pop("user_ratchet", None)
+
+        return ratchets, pbkey
+
+    def _stage (
+        self, chat_id: int, ratchets: dict[str, Ratchet | str | None], tmp: bool = False
+    ) -> int:
+        session = self._session(chat_id, tmp)
+
+        # skipped keys are never changed in place, the store of the session is unchanged
+        with self._lock:
+            ratchets = {
+                ratchet_name: ratchet for ratchet_name, ratchet in ratchets.items()
+                if not isinstance(ratchet, SkippedKeys)
+                or session.get(f"tmp-{ratchet_name}" if tmp else ratchet_name, None) is not ratchet
+            }
+
+        stored = {
+            ratchet_name: None if ratchet is None else _stored_ratchet(ratchet)
+            for ratchet_name, ratchet in ratchets.items()
+        }
+        changes = {
+            ratchet_name: None if ratchet is None else crypto.encode_ratchet(ratchet)
+            for ratchet_name, ratchet in stored.items()
+        } if self.journal is not None else None
+
+        with self._lock:
+            for ratchet_name, ratchet in ratchets.items():
+                file_name = f"tmp-{ratchet_name}" if tmp else ratchet_name
+
+                # the replaced chain may still hold keys already handed out
+                crypto.wipe_ratchets([ session.pop(file_name, None) ])
+
+                if ratchet is None:
+                    self.pending[(str(chat_id), ratchet_name, tmp)] = DELETED
+
+                else:
+                    session[file_name] = (
+                        crypto.load_public_key(ratchet) if isinstance(ratchet, str)
+                        else _moved_ratchet(ratchet)
+                    )
+                    self.pending[(str(chat_id), ratchet_name, tmp)] = stored[ratchet_name]
+
+            # appended under the cache lock, so the journal follows the order of the writes
+            return (
+                self.journal.append(chat_id, tmp, changes) if self.journal is not None else None
+            )
+
+    def save_ratchets (
+        self, chat_id: int, ratchets: dict[str, Ratchet | str | None], tmp: bool = False
+    ) -> None:
+        # the ratchets changed by a message are a single transaction, None deletes one,
+        # with a journal it only returns once the transaction is durable
+        transaction = self._stage(chat_id, ratchets, tmp)
+
+        if transaction is not None:
+            self.journal.wait(transaction)
+
+    def save_sessions (self, sessions: dict[int, dict[str, Ratchet | str | None]]) -> None:
+        # a transaction for each chat, all made durable by a single commit
+        transactions = [
+            self._stage(chat_id, ratchets) for chat_id, ratchets in sessions.items()
+        ]
+
+        if len(transactions) > 0 and transactions[-1] is not None:
+            self.journal.wait(max(transactions))
+
+    def save_ratchet (
+        self, chat_id: int, ratchet_name: str, ratchet: Ratchet | str, tmp: bool = False
+    ) -> None:
+        self.save_ratchets(chat_id, { ratchet_name: ratchet }, tmp=tmp)
+
+    def delete_ratchet (self, chat_id: int, ratchet_name: str, tmp: bool = False) -> None:
+        self.save_ratchets(chat_id, { ratchet_name: None }, tmp=tmp)
+
+    def flush (self) -> int:
+        # the io lock keeps an older batch from being written after a newer one
+        with self._io_lock:
+            with self._lock:
+                batch, self.pending = self.pending, dict()
+
+                # the journal segments hold the batch, and are dropped once it is written
+                segments = self.journal.rotate() if self.journal is not None else []
+
+            records = dict()
+            for (chat_id, ratchet_name, tmp), ratchet in batch.items():
+                records.setdefault((chat_id, tmp), dict())[ratchet_name] = (
+                    None if ratchet is DELETED else ratchet
+                )
+
+            try:
+                # a single record write for each chat changed since the last flush
+                for (chat_id, tmp), ratchets in records.items():
+                    crypto.save_ratchets(
+                        chat_id, ratchets, tmp=tmp, durable=self.journal is not None
+                    )
+
+            except Exception as exc:
+                # keeps the unwritten changes, unless a newer one arrived in the meantime
+                with self._lock:
+                    self.pending = batch | self.pending
+
+                raise exc
+
+            if self.journal is not None:
+                self.journal.discard(segments)
+
+        return len(batch)
+
+    def recover (self) -> int:
+        # called on startup, before any session is loaded, to write what a crash left
+        if self.journal is None:
+            return 0
+
+        with self._io_lock:
+            segments = self.journal.rotate()
+            transactions = self.journal.recover()
+
+            records = dict()
+            for chat_id, tmp, changes in transactions:
+                records.setdefault((chat_id, tmp), dict()).update(changes)
+
+            for (chat_id, tmp), changes in records.items():
+                crypto.keystore.update_record(
+                    "ratchets", crypto.ratchets_record(chat_id, tmp), changes, durable=True
+                )
+
+            self.journal.discard(segments)
+
+        return len(transactions)
+
+    def fill_lookahead (self) -> int:
+        with self._lock:
+            chains = [
+                ratchet
+                for session in self.sessions.values()
+                for ratchet_name, ratchet in session.items()
+                if ratchet_name in LOOKAHEAD_CHAINS and isinstance(ratchet, SymmetricRatchet)
+            ]
+
+        # derived out of the cache lock, each chain guards its own buffer
+        return sum(chain.fill(self.lookahead) for chain in chains)
+
+    def clear (self) -> None:
+        with self._lock:
+            for session in self.sessions.values():
+                _wipe_session(session)
+
+            self.sessions.clear()
+
+    def flush_handler (self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+
+            try:
+                self.flush()
+
+            except Exception as exc:
+                print(f"Failed to flush the ratchets to the disk: {exc}")
+
+            if self.lookahead > 0:
+                self.fill_lookahead()
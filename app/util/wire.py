@@ -0,0 +1,243 @@
+import base64
+import struct
+from typing import Any
+
+# formats of the payloads, in order of preference
+BINARY_WIRE = "binary"
+JSON_WIRE = "json"
+WIRE_FORMATS = (BINARY_WIRE, JSON_WIRE)
+
+WIRE_VERSION = 1
+
+# fields carrying base64 keys or signatures on json, sent as raw bytes on binary
+KEY_FIELDS = frozenset((
+    "dh_ratchet", "EK", "IK", "SPK", "OPK", "key", "Signed-Message", "signature"
+))
+
+NONE_TAG = 0
+FALSE_TAG = 1
+TRUE_TAG = 2
+INT_TAG = 3
+FLOAT_TAG = 4
+STR_TAG = 5
+BYTES_TAG = 6
+LIST_TAG = 7
+DICT_TAG = 8
+OBJECT_ID_TAG = 9
+
+INT = struct.Struct("!q")
+FLOAT = struct.Struct("!d")
+
+# field names of the payloads, each sent as a single byte
+FIELD_NAMES = (
+    "Signed-Message", "telephone", "body", "msg", "status", "data", "sender", "receiver",
+    "owner", "user", "chat_id", "message_id", "cipher", "dh_ratchet", "counter", "mode",
+    "modes", "acks", "name", "users", "description", "keys", "pb_keys", "used_keys",
+    "EK", "IK", "SPK", "OPK", "id", "key", "opkeys", "wire", "group_id", "receivers",
+    "signature", "device", "devices", "chats"
+)
+FIELD_IDS = { name: field_id for field_id, name in enumerate(FIELD_NAMES) }
+# any other field name follows this byte
+NAMED_FIELD = 0xff
+
+# fields holding the hex of a mongo object id, sent as its 12 bytes
+OBJECT_ID_FIELDS = frozenset(("chat_id", "message_id", "group_id"))
+OBJECT_ID_SIZE = 12
+
+def negotiate_wire (formats: list[str]) -> str:
+    for wire_format in WIRE_FORMATS:
+        if wire_format in formats:
+            return wire_format
+
+    return JSON_WIRE
+
+def _pack_size (size: int, packed: bytearray) -> None:
+    # unsigned varint, seven bits a byte
+    while size >= 0x80:
+        packed.append((size & 0x7f) | 0x80)
+        size >>= 7
+
+    packed.append(size)
+
+def _unpack_size (payload: bytes, offset: int) -> tuple[int, int]:
+    size = shift = 0
+
+    while True:
+        byte = payload[offset]
+        offset += 1
+
+        size |= (byte & 0x7f) << shift
+        shift += 7
+
+        if byte < 0x80:
+            return size, offset
+
+def _pack_field (name: str, value: Any, packed: bytearray) -> None:
+    field_id = FIELD_IDS.get(name, None)
+
+    if field_id is not None:
+        packed.append(field_id)
+
+    else:
+        encoded = str(name).encode("utf-8")
+        packed.append(NAMED_FIELD)
+        _pack_size(len(encoded), packed)
+        packed += encoded
+
+    if type(value) is str:
+        if name in KEY_FIELDS:
+            value = base64.b64decode(value)
+
+        elif name in OBJECT_ID_FIELDS and len(value) == 2 * OBJECT_ID_SIZE:
+            try:
+                raw_id = bytes.fromhex(value)
+
+                packed.append(OBJECT_ID_TAG)
+                packed += raw_id
+
+                return
+
+            except ValueError:
+                pass
+
+    _pack_value(value, packed)
+
+def _pack_value (value: Any, packed: bytearray) -> None:
+    value_type = type(value)
+
+    if value_type is str:
+        encoded = value.encode("utf-8")
+        packed.append(STR_TAG)
+        _pack_size(len(encoded), packed)
+        packed += encoded
+
+    elif value_type is dict:
+        packed.append(DICT_TAG)
+        _pack_size(len(value), packed)
+
+        for name, item in value.items():
+            _pack_field(name, item, packed)
+
+    elif value is None:
+        packed.append(NONE_TAG)
+
+    elif value_type is bool:
+        packed.append(TRUE_TAG if value else FALSE_TAG)
+
+    elif value_type is int:
+        packed.append(INT_TAG)
+        packed += INT.pack(value)
+
+    elif value_type is float:
+        packed.append(FLOAT_TAG)
+        packed += FLOAT.pack(value)
+
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        packed.append(BYTES_TAG)
+        _pack_size(len(value), packed)
+        packed += value
+
+    elif isinstance(value, (list, tuple)):
+        packed.append(LIST_TAG)
+        _pack_size(len(value), packed)
+
+        for item in value:
+            _pack_value(item, packed)
+
+    else:
+        raise TypeError(f"Value of type {value_type.__name__} can not be sent on the wire")
+
+def _unpack_value (payload: bytes, offset: int) -> tuple[Any, int]:
+    tag = payload[offset]
+    offset += 1
+
+    if tag == STR_TAG or tag == BYTES_TAG:
+        size, offset = _unpack_size(payload, offset)
+        value = payload[ offset : offset + size ]
+
+        return value.decode("utf-8") if tag == STR_TAG else value, offset + size
+
+    elif tag == DICT_TAG:
+        size, offset = _unpack_size(payload, offset)
+        items = dict()
+
+        for _ in range(size):
+            field_id = payload[offset]
+            offset += 1
+
+            if field_id == NAMED_FIELD:
+                name_size, offset = _unpack_size(payload, offset)
+                name = payload[ offset : offset + name_size ].decode("utf-8")
+                offset += name_size
+
+            else:
+                name = FIELD_NAMES[field_id]
+
+            item, offset = _unpack_value(payload, offset)
+
+            # the handlers keep working with the keys as they are on json
+            if name in KEY_FIELDS and type(item) is bytes:
+                item = base64.b64encode(item).decode("utf-8")
+
+            items[name] = item
+
+        return items, offset
+
+    elif tag == OBJECT_ID_TAG:
+        return payload[ offset : offset + OBJECT_ID_SIZE ].hex(), offset + OBJECT_ID_SIZE
+
+    elif tag == NONE_TAG:
+        return None, offset
+
+    elif tag == FALSE_TAG or tag == TRUE_TAG:
+        return tag == TRUE_TAG, offset
+
+    elif tag == INT_TAG:
+        return INT.unpack_from(payload, offset)[0], offset + INT.size
+
+    elif tag == FLOAT_TAG:
+        return FLOAT.unpack_from(payload, offset)[0], offset + FLOAT.size
+
+    elif tag == LIST_TAG:
+        size, offset = _unpack_size(payload, offset)
+        items = []
+
+        for _ in range(size):
+            item, offset = _unpack_value(payload, offset)
+            items.append(item)
+
+        return items, offset
+
+    raise ValueError(f"Unknown wire tag {tag}")
+
+def encode (data: dict) -> bytes:
+    packed = bytearray((WIRE_VERSION,))
+    _pack_value(data, packed)
+
+    return bytes(packed)
+
+def decode (payload: bytes) -> dict:
+    payload = bytes(payload)
+    if payload[0] != WIRE_VERSION:
+        raise ValueError(f"Unsupported wire version {payload[0]}")
+
+    return _unpack_value(payload, 1)[0]
+
+def to_json (value: Any) -> Any:
+    # the raw fields are sent as base64 when the server only understands json
+    if isinstance(value, dict):
+        return { name: to_json(item) for name, item in value.items() }
+
+    elif isinstance(value, (list, tuple)):
+        return [ to_json(item) for item in value ]
+
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.encodebytes(value).decode("utf-8").strip()
+
+    return value
+
+def payload (resp: dict | bytes) -> dict:
+    if isinstance(resp, (bytes, bytearray)):
+        return decode(resp)
+
+    return resp
@@ -0,0 +1,36 @@
+import statistics
+import time
+from collections.abc import Callable
+from typing import Any
+
+
+def measure (method: Callable[[], Any], runs: int = 200, warmup: int = 10) -> dict[str, float]:
+    """
+        Calls the method runs times and reports its throughput and latency percentiles.
+        :param method:  the operation being measured, called without arguments
+        :param runs:    number of measured calls
+        :param warmup:  number of calls made before measuring
+        :returns:       ops/sec and the p50/p99 latencies in microseconds
+    """
+    for _ in range(warmup):
+        method()
+
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        method()
+        latencies.append(time.perf_counter() - start)
+
+    percentiles = statistics.quantiles(latencies, n=100)
+
+    return {
+        "ops_sec": runs / sum(latencies),
+        "p50_us": percentiles[49] * 1e6,
+        "p99_us": percentiles[98] * 1e6
+    }
+
+def report (name: str, result: dict[str, float]) -> None:
+    print(
+        f"{name:<40} {result['ops_sec']:>12.1f} ops/s"
+        f" {result['p50_us']:>10.1f} us p50 {result['p99_us']:>10.1f} us p99"
+    )
@@ -0,0 +1,78 @@
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.crypto import SkippedKeys, SymmetricRatchet
+from app.util.keystore import FILES_BACKEND, SQLITE_BACKEND, Keystore, open_keystore
+from benchmarks import measure, report
+
+CHAT_SIZES = (1000, 10000, 100000)
+
+def chat_record () -> dict[str, crypto.Field]:
+    return {
+        "dh_ratchet": crypto.encode_ratchet(X25519PrivateKey.generate()),
+        "root_ratchet": crypto.encode_ratchet(SymmetricRatchet(b"\x01" * 32, 3)),
+        "snd_ratchet": crypto.encode_ratchet(SymmetricRatchet(b"\x02" * 32, 12)),
+        "rcv_ratchet": crypto.encode_ratchet(SymmetricRatchet(b"\x03" * 32, 9)),
+        "user_ratchet": crypto.encode_ratchet(X25519PrivateKey.generate().public_key()),
+        "skipped_keys": crypto.encode_ratchet(SkippedKeys())
+    }
+
+def populate (keystore: Keystore, chats: int) -> float:
+    record = chat_record()
+    start = time.perf_counter()
+
+    for offset in range(0, chats, 10000):
+        keystore.write_records("ratchets", {
+            f"chat-{idx}": record for idx in range(offset, min(offset + 10000, chats))
+        })
+
+    return time.perf_counter() - start
+
+def export (keystore: Keystore) -> int:
+    return sum(1 for _ in keystore.export_records("ratchets"))
+
+def main () -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the keystore backends")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(CHAT_SIZES))
+    parser.add_argument("--backends", nargs="+", default=[ SQLITE_BACKEND, FILES_BACKEND ])
+    args = parser.parse_args()
+
+    for chats in args.sizes:
+        for backend in args.backends:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                keystore = open_keystore(Path(tmp_dir), backend)
+                name = f"{backend} {chats}"
+
+                print(f"{name + ' populate':<40} {populate(keystore, chats):>12.2f} s")
+
+                names = [ f"chat-{random.randrange(chats)}" for _ in range(2000) ]
+                lookups = iter(names * 2)
+                report(f"{name} load", measure(
+                    lambda: keystore.read_record("ratchets", next(lookups)), 1000
+                ))
+
+                updates = iter(names)
+                changes = { "snd_ratchet": crypto.encode_ratchet(SymmetricRatchet(b"\x04" * 32)) }
+                report(f"{name} update", measure(
+                    lambda: keystore.update_record("ratchets", next(updates), changes), 1000
+                ))
+
+                start = time.perf_counter()
+                listed = len(keystore.list_records("ratchets"))
+                print(f"{name + ' list':<40} {time.perf_counter() - start:>12.3f} s {listed} chats")
+
+                start = time.perf_counter()
+                exported = export(keystore)
+                print(
+                    f"{name + ' export':<40} {time.perf_counter() - start:>12.3f} s"
+                    f" {exported} chats"
+                )
+
+if __name__ == "__main__":
+    main()
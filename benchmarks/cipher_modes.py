@@ -0,0 +1,28 @@
+import os
+
+from app.util import crypto
+from app.util.crypto import CBC_MODE, GCM_MODE, MessageHeader
+from benchmarks import measure, report
+
+PAYLOAD_SIZES = { "100 B": 100, "4 KiB": 4 * 1024, "1 MiB": 1024 * 1024 }
+
+def main () -> None:
+    key, init_vector = os.urandom(32), os.urandom(16)
+
+    for size_name, size in PAYLOAD_SIZES.items():
+        msg = os.urandom(size)
+        runs = 50 if size > 64 * 1024 else 2000
+
+        for mode in (CBC_MODE, GCM_MODE):
+            header = MessageHeader("dh-ratchet", 0, mode, "chat")
+            enc_msg = crypto.encrypt(key, init_vector, msg, header)
+
+            encryption = measure(lambda: crypto.encrypt(key, init_vector, msg, header), runs)
+            decryption = measure(lambda: crypto.decrypt(key, init_vector, enc_msg, header), runs)
+
+            for name, result in (("encrypt", encryption), ("decrypt", decryption)):
+                report(f"{mode} {name} {size_name}", result)
+                print(f"{'':<40} {result['ops_sec'] * size / 2 ** 20:>12.1f} MiB/s")
+
+if __name__ == "__main__":
+    main()
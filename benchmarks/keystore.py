@@ -0,0 +1,58 @@
+import os
+import tempfile
+from pathlib import Path
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.crypto import SymmetricRatchet
+from app.util.keystore import Keystore
+from benchmarks import measure, report
+
+
+def save_legacy_ratchets (chat_path: Path, ratchets: dict[str, crypto.Ratchet | str]) -> None:
+    # one pem or text file per ratchet, as save_ratchet wrote them before the keystore
+    chat_path.mkdir(parents=True, exist_ok=True)
+
+    with open(chat_path / "dh_ratchet.pem", "w") as pem_file:
+        encoded_ratchet = ratchets["dh_ratchet"].private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.BestAvailableEncryption(
+                crypto.encode_b64(os.environ["SECRET_KEY"])
+            )
+        )
+        pem_file.write(crypto.decode_b64(encoded_ratchet))
+
+    with open(chat_path / "root_ratchet", "w") as sym_file:
+        sym_file.write(crypto.decode_b64(ratchets["root_ratchet"].state))
+
+    with open(chat_path / "user_ratchet", "w") as pbk_file:
+        pbk_file.write(ratchets["user_ratchet"])
+
+def load_legacy_ratchets (chat_path: Path) -> dict[str, crypto.Ratchet]:
+    return {
+        ratchet_name: crypto.load_key_from_file(chat_path, ratchet_name, ratchet_method)
+        for ratchet_name, ratchet_method in crypto.ratchets_iter
+    }
+
+def main () -> None:
+    ratchets = {
+        "dh_ratchet": X25519PrivateKey.generate(),
+        "root_ratchet": SymmetricRatchet(os.urandom(32)),
+        "user_ratchet": crypto.public_key(X25519PrivateKey.generate())
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        chat_path = Path(tmp_dir) / "legacy/chat"
+        crypto.keystore = Keystore(Path(tmp_dir) / "keystore")
+
+        report("per-file pem save", measure(lambda: save_legacy_ratchets(chat_path, ratchets)))
+        report("per-file pem load", measure(lambda: load_legacy_ratchets(chat_path)))
+
+        report("keystore save", measure(lambda: crypto.save_ratchets("chat", ratchets)))
+        report("keystore load", measure(lambda: crypto.load_ratchets("chat")))
+
+if __name__ == "__main__":
+    main()
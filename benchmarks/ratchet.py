@@ -0,0 +1,270 @@
+import argparse
+import copy
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.journal import RatchetJournal
+from app.util.keypool import KeyPool
+from app.util.keystore import Keystore
+from app.util.sessions import SessionCache
+from benchmarks import measure, report
+from tests.crypto import Alice, Bob, Eve, create_chat_ratchets
+
+MSG = b"a message of an ordinary size, about the length of a sentence"
+
+Results = dict[str, dict[str, dict[str, float]]]
+
+class DiskStore:
+    # every operation goes straight to the keystore
+    def load_ratchets (self, chat_id: str) -> tuple[dict[str, crypto.Ratchet], Any]:
+        return crypto.load_ratchets(chat_id)
+
+    def save_ratchet (self, chat_id: str, ratchet_name: str, ratchet: crypto.Ratchet) -> None:
+        crypto.save_ratchet(chat_id, ratchet_name, ratchet)
+
+    def save_ratchets (self, chat_id: str, ratchets: dict[str, crypto.Ratchet]) -> None:
+        crypto.save_ratchets(chat_id, ratchets)
+
+def bench_primitives (runs: int) -> dict[str, dict[str, float]]:
+    alice, bob, eve = Alice(), Bob(), Eve()
+    ratchets_alice, ratchets_bob = create_chat_ratchets()
+    pbkey = ratchets_alice.pop("user_ratchet")
+
+    chain = crypto.SymmetricRatchet(bytes(32))
+    messages = iter([
+        crypto.snd_msg(ratchets_alice, pbkey, MSG) for _ in range(runs + 10)
+    ])
+
+    def rcv_msg () -> None:
+        cipher, header = next(messages)
+        crypto.rcv_msg(ratchets_bob, header, cipher)
+
+    # a message forged by eve, on a chain bob already follows
+    ratchets_eve = eve.ratchets() | {
+        "dh_ratchet": X25519PrivateKey.generate(),
+        "root_ratchet": crypto.SymmetricRatchet(bytes(32))
+    }
+    forged, forged_header = crypto.snd_msg(ratchets_eve, pbkey, MSG)
+
+    def rcv_forged () -> None:
+        forged_header.dh_ratchet = ratchets_bob["user_ratchet"]
+        forged_header.counter = ratchets_bob["rcv_ratchet"].count
+
+        try:
+            crypto.rcv_msg(ratchets_bob, forged_header, forged)
+
+        except (InvalidTag, ValueError):
+            pass
+
+    return {
+        "sender_x3dh": measure(
+            lambda: crypto.sender_x3dh(alice.private_keys(), bob.public_keys()), runs
+        ),
+        "receiver_x3dh": measure(
+            lambda: crypto.receiver_x3dh(alice.public_keys(), bob.private_keys()), runs
+        ),
+        "SymmetricRatchet.next": measure(chain.next, runs),
+        "snd_msg": measure(lambda: crypto.snd_msg(ratchets_alice, pbkey, MSG), runs),
+        "rcv_msg": measure(rcv_msg, runs),
+        "rcv_msg forged": measure(rcv_forged, runs)
+    }
+
+def bench_store (store: SessionCache | DiskStore, runs: int) -> dict[str, dict[str, float]]:
+    ratchets_alice, ratchets_bob = create_chat_ratchets()
+
+    store.save_ratchets("alice", ratchets_alice)
+    store.save_ratchets("bob", ratchets_bob)
+
+    # the whole path of the app, loading the chat, ratcheting and saving it back
+    sent = []
+
+    def snd_msg () -> None:
+        ratchets, pbkey = store.load_ratchets("alice")
+        sent.append(crypto.snd_msg(ratchets, pbkey, MSG))
+        store.save_ratchets("alice", ratchets)
+
+    results = { "snd_msg": measure(snd_msg, runs) }
+    messages = iter(sent)
+
+    def rcv_msg () -> None:
+        cipher, header = next(messages)
+        ratchets, pbkey = store.load_ratchets("bob")
+        ratchets["user_ratchet"] = pbkey
+
+        crypto.rcv_msg(ratchets, header, cipher)
+        store.save_ratchets("bob", ratchets)
+
+    results["rcv_msg"] = measure(rcv_msg, runs)
+    results["save_ratchet"] = measure(
+        lambda: store.save_ratchet("alice", "root_ratchet", ratchets_alice["root_ratchet"]), runs
+    )
+    results["load_ratchets"] = measure(lambda: store.load_ratchets("alice"), runs)
+
+    return results
+
+def bench_lookahead (runs: int) -> dict[str, dict[str, float]]:
+    ratchets_alice, _ = create_chat_ratchets()
+    pbkey = ratchets_alice.pop("user_ratchet")
+    crypto.snd_msg(ratchets_alice, pbkey, MSG)
+
+    # the chains are filled before measuring, as the flush handler does while idle
+    def filled (size: int) -> list[dict[str, crypto.Ratchet]]:
+        sessions = []
+        for _ in range(size):
+            ratchets = dict(ratchets_alice)
+            ratchets["snd_ratchet"] = copy.copy(ratchets_alice["snd_ratchet"])
+            ratchets["snd_ratchet"].fill(1)
+            sessions.append(ratchets)
+
+        return sessions
+
+    chains = iter([ ratchets["snd_ratchet"] for ratchets in filled(runs + 10) ])
+    sessions = iter(filled(runs + 10))
+
+    return {
+        "SymmetricRatchet.next": measure(lambda: next(chains).next(), runs),
+        "snd_msg": measure(lambda: crypto.snd_msg(next(sessions), pbkey, MSG), runs)
+    }
+
+def bench_key_pool (runs: int) -> dict[str, dict[str, float]]:
+    ratchets_alice, _ = create_chat_ratchets()
+    pbkey = ratchets_alice.pop("user_ratchet")
+
+    def rotate () -> None:
+        crypto.dh_ratchet_rotation_send(ratchets_alice, pbkey)
+
+    results = dict()
+    key_pool = crypto.key_pool
+
+    # the pool empty, every rotation generates its key inline, then filled ahead of time
+    for name, size in (("rotation cold", 0), ("rotation pooled", runs + 10)):
+        crypto.key_pool = KeyPool(size=size)
+        crypto.key_pool.fill()
+
+        results[name] = measure(rotate, runs)
+
+    crypto.key_pool = key_pool
+
+    return results
+
+def bench_group_commit (
+    commit: Callable[[str, dict[str, crypto.Ratchet]], None], runs: int, threads: int = 16
+) -> dict[str, float]:
+    # concurrent chats each commit the ratchets of their messages
+    latencies = []
+
+    def chat (chat_id: str) -> None:
+        ratchets, _ = create_chat_ratchets()
+
+        for _ in range(runs // threads):
+            start = time.perf_counter()
+            commit(chat_id, ratchets)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    workers = [
+        threading.Thread(target=chat, args=(f"chat-{idx}",)) for idx in range(threads)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    elapsed = time.perf_counter() - start
+    percentiles = statistics.quantiles(latencies, n=100)
+
+    return {
+        "ops_sec": len(latencies) / elapsed,
+        "p50_us": percentiles[49] * 1e6,
+        "p99_us": percentiles[98] * 1e6
+    }
+
+def run (runs: int) -> Results:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        crypto.keystore = Keystore(Path(tmp_dir))
+
+        return {
+            "primitives": bench_primitives(runs),
+            "lookahead": bench_lookahead(runs),
+            "key pool": bench_key_pool(runs),
+            "memory": bench_store(SessionCache(), runs),
+            "journal": bench_store(
+                SessionCache(journal=RatchetJournal(Path(tmp_dir) / "journal")), runs
+            ),
+            "disk": bench_store(DiskStore(), runs),
+            "durability": {
+                "fsync per message": bench_group_commit(
+                    lambda chat_id, ratchets: crypto.save_ratchets(
+                        chat_id, ratchets, durable=True
+                    ), runs
+                ),
+                "journal group commit": bench_group_commit(
+                    SessionCache(journal=RatchetJournal(Path(tmp_dir) / "group")).save_ratchets,
+                    runs
+                )
+            }
+        }
+
+def commit () -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare (results: Results, baseline: Results, report_method: Callable = print) -> None:
+    for mode, mode_results in results.items():
+        for name, result in mode_results.items():
+            base = baseline.get(mode, dict()).get(name, None)
+            if base is None:
+                continue
+
+            change = (result["ops_sec"] / base["ops_sec"] - 1) * 100
+            report_method(
+                f"{mode + ' ' + name:<40} {change:>+11.1f}% ops/s"
+                f" {base['p50_us']:>10.1f} -> {result['p50_us']:.1f} us p50"
+            )
+
+def main () -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the ratchet primitives")
+    parser.add_argument("--runs", type=int, default=500)
+    parser.add_argument("--output", type=Path, help="writes the results to a json file")
+    parser.add_argument("--compare", type=Path, help="compares with a previous json file")
+    args = parser.parse_args()
+
+    results = run(args.runs)
+
+    for mode, mode_results in results.items():
+        for name, result in mode_results.items():
+            report(f"{mode} {name}", result)
+
+    if args.output is not None:
+        args.output.write_text(json.dumps({
+            "commit": commit(),
+            "python": platform.python_version(),
+            "runs": args.runs,
+            "results": results
+        }, indent=4))
+
+    if args.compare is not None:
+        print()
+        compare(results, json.loads(args.compare.read_text())["results"])
+
+if __name__ == "__main__":
+    main()
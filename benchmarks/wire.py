@@ -0,0 +1,80 @@
+import json
+import os
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto, wire
+from benchmarks import measure, report
+
+
+def signed (body: dict) -> dict:
+    return {
+        "Signed-Message": crypto.sign_message(Ed25519PrivateKey.generate()),
+        "telephone": "5511999999999",
+        "body": body
+    }
+
+def pbkey () -> str:
+    return crypto.public_key(X25519PrivateKey.generate())
+
+def payloads () -> dict[str, dict]:
+    chat = { "telephone": "5511999999999", "chat_id": "6571a0c3e4b0f1a2b3c4d5e6" }
+
+    message = lambda size: signed({
+        "sender": chat,
+        "receiver": chat,
+        "message_id": "6571a0c3e4b0f1a2b3c4d5e8",
+        "cipher": os.urandom(size),
+        "dh_ratchet": pbkey(),
+        "counter": 12,
+        "mode": crypto.GCM_MODE
+    })
+
+    return {
+        "message 100 B": message(112),
+        "message 4 KiB": message(4 * 1024 + 16),
+        "confirm-message": signed({
+            "sender": chat, "receiver": chat, "dh_ratchet": pbkey(), "acks": [ "6571a0c3" ]
+        }),
+        "create-chat": signed({
+            "owner": chat,
+            "name": "chat name",
+            "users": [ "5511888888888" ],
+            "dh_ratchet": pbkey(),
+            "EK": pbkey(),
+            "modes": list(crypto.CIPHER_MODES)
+        }),
+        "confirm-create-chat": signed({
+            "owner": chat,
+            "mode": crypto.GCM_MODE,
+            "user": {
+                "name": "user name",
+                "telephone": "5511888888888",
+                "chat_id": "6571a0c3e4b0f1a2b3c4d5e7",
+                "keys": { "dh_ratchet": pbkey(), "OPK": pbkey(), "IK": pbkey(), "SPK": pbkey() }
+            }
+        })
+    }
+
+def json_round_trip (data: dict) -> None:
+    # socket.io serializes json payloads with the json module
+    received = json.loads(json.dumps(wire.to_json(data)))
+
+    if "cipher" in received["body"]:
+        crypto.encode_b64(received["body"]["cipher"])
+
+def main () -> None:
+    for name, data in payloads().items():
+        json_size = len(json.dumps(wire.to_json(data)).encode("utf-8"))
+        binary_size = len(wire.encode(data))
+
+        print(
+            f"{name:<40} {json_size:>8} B json {binary_size:>8} B binary"
+            f" {(1 - binary_size / json_size) * 100:>6.1f}% smaller"
+        )
+        report(f"{name} json", measure(lambda: json_round_trip(data), 2000))
+        report(f"{name} binary", measure(lambda: wire.decode(wire.encode(data)), 2000))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import threading
+
+from app.util.acks import AckBatcher, merge_confirmations
+
+
+def confirmation (chat_id: str, acks: list[int], device: str = None) -> dict:
+    return {
+        "sender": { "telephone": "alice", "chat_id": "sender", "device": device },
+        "receiver": { "telephone": "bob", "chat_id": chat_id },
+        "dh_ratchet": f"dh-{acks[-1]}",
+        "acks": acks
+    }
+
+class Recorder:
+    def __init__ (self) -> None:
+        self.sent: list[list[dict]] = []
+        self.event = threading.Event()
+
+    def send (self, confirmations: list[dict]) -> None:
+        self.sent.append(confirmations)
+        self.event.set()
+
+def test_merge_keeps_the_latest_ratchet () -> None:
+    merged = merge_confirmations(confirmation("chat", [0, 1]), confirmation("chat", [2]))
+
+    assert merged["acks"] == [0, 1, 2]
+    assert merged["dh_ratchet"] == "dh-2"
+
+def test_confirmations_are_merged_until_the_delay () -> None:
+    recorder = Recorder()
+    batcher = AckBatcher(recorder.send, delay=0.05)
+
+    for idx in range(10):
+        batcher.add(confirmation(f"chat-{idx % 2}", [idx]))
+
+    assert recorder.event.wait(timeout=1)
+
+    assert len(recorder.sent) == 1
+    assert sorted(
+        (sent["receiver"]["chat_id"], sent["acks"]) for sent in recorder.sent[0]
+    ) == [("chat-0", [0, 2, 4, 6, 8]), ("chat-1", [1, 3, 5, 7, 9])]
+
+def test_a_full_chat_is_sent_right_away () -> None:
+    recorder = Recorder()
+    batcher = AckBatcher(recorder.send, max_acks=4, delay=60)
+
+    for idx in range(6):
+        batcher.add(confirmation("chat", [idx]))
+
+    assert recorder.sent == [[ confirmation("chat", [0, 1, 2, 3]) ]]
+
+    batcher.flush()
+    assert recorder.sent[-1] == [ confirmation("chat", [4, 5]) ]
+
+def test_devices_are_confirmed_apart () -> None:
+    recorder = Recorder()
+    batcher = AckBatcher(recorder.send, delay=60)
+
+    batcher.add(confirmation("chat", [0], device="phone"))
+    batcher.add(confirmation("chat", [1], device="laptop"))
+    batcher.flush()
+
+    assert len(recorder.sent[0]) == 2
@@ -1,18 +1,31 @@
 import base64
+import os
+from pathlib import Path
 from unittest.mock import patch
 
 import pytest
 import socketio
 from bson import ObjectId
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 from socketio.exceptions import ConnectionError
 
+from app import keyring
+from app.models.chat import Chat
 from app.models.user import User
-from app.util import config
-from app.util.api import Api
+from app.util import config, crypto, devices, groups, wire
+from app.util.api import Api, ConnectionResults
+from app.util.jobs import JobQueue
+from app.util.keystore import Keystore
+from app.util.prekeys import OPK_BATCH
+from app.util.sessions import SessionCache
+from tests.crypto import create_chat_ratchets
 
 
+# the prekeys generated on signup never reach the keystore of the app
+pytestmark = pytest.mark.usefixtures("keystore")
+
 def test_headers_client () -> None:
     api = Api()
 
@@ -222,7 +235,8 @@ def test_api_signup_connect_parameters () -> None:
                 "opkeys": [ {
                     "id": idx,
                     "key": pub_key
-                } for idx in range(1, 11) ]
+                } for idx in range(1, OPK_BATCH + 1) ],
+                "wire": [ "binary", "json" ]
             },
             headers={ "Param-Auth": config.CHAT_SECRET }
         )
@@ -268,4 +282,244 @@ def test_api_signup_rollback () -> None:
         assert api.id_key is None
         assert api.sgn_key is None
         assert api.ed_key is None
-        mock_delete_user.assert_called_once()
\ No newline at end of file
+        mock_delete_user.assert_called_once()
+
+def test_login_unlocks_and_logout_locks_the_keyring () -> None:
+    config.USER_ID = ObjectId()
+
+    with (
+        patch("app.util.crypto.load_private_key") as mock_load_pvt_key,
+        patch("app.util.crypto.sign_message") as mock_sign_message,
+        patch("app.services.user.find_with_id") as mock_find_user,
+        patch.object(socketio.Client, "connect") as mock_connect,
+        patch.object(socketio.Client, "disconnect") as mock_disconnect
+    ):
+        mock_find_user.return_value = User("test", "test", "test")
+
+        api = Api(True)
+
+        assert keyring.unlocked
+        assert mock_load_pvt_key.call_count == 3
+
+        api.logout()
+
+        assert not keyring.unlocked
+
+def test_emit_sends_json_until_binary_is_accepted () -> None:
+    api = Api()
+
+    with patch.object(socketio.Client, "emit") as mock_emit:
+        api.emit("message", { "cipher": b"\x00\x01" })
+
+        mock_emit.assert_called_once_with("message", { "cipher": "AAE=" })
+
+def test_emit_sends_binary_envelope () -> None:
+    api = Api()
+    api.wire_format = wire.BINARY_WIRE
+
+    with patch.object(socketio.Client, "emit") as mock_emit:
+        api.emit("message", { "cipher": b"\x00\x01" })
+
+        event, payload = mock_emit.call_args.args
+
+        assert event == "message"
+        assert wire.decode(payload) == { "cipher": b"\x00\x01" }
+
+def test_group_message_is_encrypted_once () -> None:
+    api = Api()
+    api.ed_key = Ed25519PrivateKey.generate()
+
+    chat = Chat(
+        users=[ "bob", "carol" ], back_ids={ "bob": ObjectId(), "carol": ObjectId() }
+    )
+    # a cache of its own, never journaled nor flushed to the keystore of the app
+    session_cache = SessionCache()
+    session_cache.save_ratchets(groups.group_record(chat._id), groups.create_sender_key())
+
+    with (
+        patch("app.util.api.session_cache", session_cache),
+        patch("app.services.user.find_with_id") as mock_find_user,
+        patch("app.services.chat.find_with_id") as mock_find_chat,
+        patch.object(Api, "emit") as mock_emit
+    ):
+        mock_find_user.return_value = User("alice", "alice", "test")
+        mock_find_chat.return_value = chat
+
+        api.send_message(chat._id, "hi all")
+
+        event, data = mock_emit.call_args.args
+
+        assert mock_emit.call_count == 1
+        assert event == "group-message"
+        assert data["body"]["group_id"] == str(chat._id)
+        assert [ receiver["telephone"] for receiver in data["body"]["receivers"] ] == [
+            "bob", "carol"
+        ]
+
+def test_refused_group_message_is_retried_on_its_event () -> None:
+    api = Api()
+    api.user_id = ObjectId()
+    api.ed_key = Ed25519PrivateKey.generate()
+
+    chat = Chat(
+        users=[ "bob", "carol" ], back_ids={ "bob": ObjectId(), "carol": ObjectId() }
+    )
+    session_cache = SessionCache()
+    session_cache.save_ratchets(groups.group_record(chat._id), groups.create_sender_key())
+    queue = JobQueue()
+
+    with (
+        patch("app.util.api.session_cache", session_cache),
+        patch("app.util.api.job_queue", queue),
+        patch("app.services.user.find_with_id") as mock_find_user,
+        patch("app.services.chat.find_with_id") as mock_find_chat,
+        patch.object(Api, "emit", side_effect=ConnectionRefusedError)
+    ):
+        mock_find_user.return_value = User("alice", "alice", "test")
+        mock_find_chat.return_value = chat
+
+        assert api.send_message(chat._id, "hi all") == ConnectionResults.RETRY
+
+    with patch.object(Api, "emit") as mock_emit:
+        queue.resolve_jobs(api.user_id)
+
+    event, data = mock_emit.call_args.args
+
+    assert event == "group-message"
+    assert data["body"]["group_id"] == str(chat._id)
+
+def test_message_is_encrypted_for_every_device () -> None:
+    api = Api()
+    api.ed_key = Ed25519PrivateKey.generate()
+
+    chat = Chat(
+        users=[ "bob" ], devices={ "phone": ObjectId(), "laptop": ObjectId() },
+        mode=crypto.GCM_MODE
+    )
+    session_cache = SessionCache()
+    receivers = dict()
+
+    for device in chat.devices:
+        ratchets_alice, ratchets_bob = create_chat_ratchets()
+        session_cache.save_ratchets(devices.device_session(chat._id, device), ratchets_alice)
+        receivers[device] = ratchets_bob
+
+    with (
+        patch("app.util.api.session_cache", session_cache),
+        patch("app.services.user.find_with_id") as mock_find_user,
+        patch("app.services.chat.find_with_id") as mock_find_chat,
+        patch.object(Api, "emit") as mock_emit
+    ):
+        mock_find_user.return_value = User("alice", "alice", "test")
+        mock_find_chat.return_value = chat
+
+        api.send_message(chat._id, "hi bob")
+
+        event, data = mock_emit.call_args.args
+
+        assert mock_emit.call_count == 1
+        assert event == "message"
+
+        for envelope in data["body"]["devices"]:
+            ratchets = receivers[envelope["device"]]
+            header = crypto.MessageHeader(
+                envelope["dh_ratchet"], envelope["counter"], envelope["mode"], str(chat._id)
+            )
+
+            assert envelope["chat_id"] == str(chat.devices[envelope["device"]])
+            # the cipher reaches the wire as it was encrypted, without a copy
+            assert type(envelope["cipher"]) is bytearray
+            assert crypto.rcv_msg(ratchets, header, envelope["cipher"]) == b"hi bob"
+
+def test_create_chats_sends_a_single_handshake (keystore: Keystore) -> None:
+    api = Api()
+    api.user_id = ObjectId()
+    api.ed_key = Ed25519PrivateKey.generate()
+    telephones = [ f"contact-{idx}" for idx in range(25) ]
+
+    with (
+        patch("app.services.user.find_with_id") as mock_find_user,
+        patch("app.services.chat.insert_chats") as mock_insert_chats,
+        patch.object(Api, "emit") as mock_emit
+    ):
+        mock_find_user.return_value = User("bot", "bot", "test")
+
+        api.create_chats(telephones)
+
+        mock_insert_chats.assert_called_once()
+        event, data = mock_emit.call_args.args
+
+        assert mock_emit.call_count == 1
+        assert event == "create-chats"
+        assert [ chat["users"] for chat in data["body"]["chats"] ] == [
+            [ telephone ] for telephone in telephones
+        ]
+
+    # the ephemeral and dh ratchet keys of every chat
+    assert len(keystore.list_records("keys")) == 50
+
+def test_attachment_is_sent_through_emit (tmp_path: Path) -> None:
+    api = Api()
+    api.ed_key = Ed25519PrivateKey.generate()
+
+    chat = Chat(users=[ "bob" ])
+    session_cache = SessionCache()
+    ratchets_alice, ratchets_bob = create_chat_ratchets()
+    session_cache.save_ratchets(devices.device_session(chat._id), ratchets_alice)
+
+    file_path = tmp_path / "photo.bin"
+    file_path.write_bytes(os.urandom(3000))
+
+    with (
+        patch("app.util.api.session_cache", session_cache),
+        patch("app.services.user.find_with_id") as mock_find_user,
+        patch("app.services.chat.find_with_id") as mock_find_chat,
+        patch.object(Api, "emit") as mock_emit
+    ):
+        mock_find_user.return_value = User("alice", "alice", "test")
+        mock_find_chat.return_value = chat
+
+        assert api.send_attachment(chat._id, file_path, 1024) == ConnectionResults.SUCESSFUL
+
+    (event, data), *chunks = [ call.args for call in mock_emit.call_args_list ]
+    body = data["body"]
+    header = crypto.MessageHeader(body["dh_ratchet"], body["counter"], body["mode"], str(chat._id))
+
+    # the header cipher is left raw, for the wire format chosen by emit
+    assert event == "attachment"
+    assert isinstance(body["cipher"], bytes)
+
+    key, init_vector = crypto.rcv_key(ratchets_bob, header)
+    assert crypto.decrypt(key, init_vector, body["cipher"], header) == b"photo.bin"
+
+    chunk_key = crypto.attachment_key(key, init_vector)
+    assert [ event for event, _ in chunks ] == ["attachment-chunk"] * 3
+    assert b"".join(
+        crypto.decrypt_chunk(
+            chunk_key, body["attachment_id"], chunk["body"]["index"], chunk["body"]["chunk"],
+            chunk["body"]["final"]
+        )
+        for _, chunk in chunks
+    ) == file_path.read_bytes()
+
+def test_attachment_fails_when_disconnected (tmp_path: Path) -> None:
+    api = Api()
+    api.ed_key = Ed25519PrivateKey.generate()
+
+    chat = Chat(users=[ "bob" ])
+    session_cache = SessionCache()
+    session_cache.save_ratchets(devices.device_session(chat._id), create_chat_ratchets()[0])
+
+    file_path = tmp_path / "photo.bin"
+    file_path.write_bytes(os.urandom(100))
+
+    with (
+        patch("app.util.api.session_cache", session_cache),
+        patch("app.services.user.find_with_id") as mock_find_user,
+        patch("app.services.chat.find_with_id") as mock_find_chat,
+        patch.object(socketio.Client, "emit", side_effect=socketio.exceptions.BadNamespaceError)
+    ):
+        mock_find_user.return_value = User("alice", "alice", "test")
+        mock_find_chat.return_value = chat
+
+        assert api.send_attachment(chat._id, file_path) == ConnectionResults.FAILED
@@ -0,0 +1,99 @@
+import os
+from pathlib import Path
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from app.util import crypto
+from app.util.attachments import (IncomingAttachment, attachment_path, expire_attachments,
+                                  read_chunks)
+
+CHUNK_SIZE = 1024
+
+
+@pytest.fixture
+def attachment (tmp_path: Path) -> Path:
+    file_path = tmp_path / "attachment.bin"
+    file_path.write_bytes(os.urandom(10 * CHUNK_SIZE + 100))
+
+    yield file_path
+
+def encrypted_chunks (key: bytes, file_path: Path) -> list[tuple[int, bytearray, bool]]:
+    return [
+        (index, crypto.encrypt_chunk(key, "attachment", index, chunk, final), final)
+        for index, chunk, final in read_chunks(file_path, CHUNK_SIZE)
+    ]
+
+@pytest.mark.parametrize("size, expected", [ (0, 1), (CHUNK_SIZE, 1), (CHUNK_SIZE + 1, 2) ])
+def test_read_chunks_flags_last_chunk (tmp_path: Path, size: int, expected: int) -> None:
+    file_path = tmp_path / "attachment.bin"
+    file_path.write_bytes(os.urandom(size))
+
+    chunks = list(read_chunks(file_path, CHUNK_SIZE))
+
+    assert len(chunks) == expected
+    assert [ final for _, _, final in chunks ] == [ False ] * (expected - 1) + [ True ]
+    assert b"".join(chunk for _, chunk, _ in chunks) == file_path.read_bytes()
+
+def test_attachment_is_reassembled (tmp_path: Path, attachment: Path) -> None:
+    key = crypto.attachment_key(os.urandom(32), os.urandom(16))
+    incoming = IncomingAttachment("attachment", key, tmp_path / "received.bin", CHUNK_SIZE)
+
+    completed = [
+        incoming.write_chunk(index, enc_chunk, final)
+        for index, enc_chunk, final in encrypted_chunks(key, attachment)
+    ]
+
+    assert completed[-1] and not any(completed[ : -1 ])
+    assert (tmp_path / "received.bin").read_bytes() == attachment.read_bytes()
+
+def test_attachment_chunks_out_of_order (tmp_path: Path, attachment: Path) -> None:
+    key = crypto.attachment_key(os.urandom(32), os.urandom(16))
+    incoming = IncomingAttachment("attachment", key, tmp_path / "received.bin", CHUNK_SIZE)
+
+    for index, enc_chunk, final in reversed(encrypted_chunks(key, attachment)):
+        incoming.write_chunk(index, enc_chunk, final)
+
+    assert incoming.complete
+    assert (tmp_path / "received.bin").read_bytes() == attachment.read_bytes()
+
+def test_truncated_attachment_is_rejected (tmp_path: Path, attachment: Path) -> None:
+    key = crypto.attachment_key(os.urandom(32), os.urandom(16))
+    incoming = IncomingAttachment("attachment", key, tmp_path / "received.bin", CHUNK_SIZE)
+    index, enc_chunk, _ = encrypted_chunks(key, attachment)[0]
+
+    with pytest.raises(InvalidTag):
+        incoming.write_chunk(index, enc_chunk, final=True)
+
+    incoming.abort()
+
+    assert not (tmp_path / "received.bin").exists()
+
+def test_swapped_chunks_are_rejected (tmp_path: Path, attachment: Path) -> None:
+    key = crypto.attachment_key(os.urandom(32), os.urandom(16))
+    incoming = IncomingAttachment("attachment", key, tmp_path / "received.bin", CHUNK_SIZE)
+    _, enc_chunk, _ = encrypted_chunks(key, attachment)[1]
+
+    with pytest.raises(InvalidTag):
+        incoming.write_chunk(0, enc_chunk)
+
+def test_stalled_attachments_expire (tmp_path: Path, attachment: Path) -> None:
+    key = crypto.attachment_key(os.urandom(32), os.urandom(16))
+    incoming = {
+        name: IncomingAttachment("attachment", key, tmp_path / name, CHUNK_SIZE)
+        for name in ("stalled.bin", "receiving.bin")
+    }
+    incoming["stalled.bin"].updated -= 60
+
+    index, enc_chunk, final = encrypted_chunks(key, attachment)[0]
+    incoming["receiving.bin"].write_chunk(index, enc_chunk, final)
+
+    assert expire_attachments(incoming, timeout=30) == 1
+    assert list(incoming) == ["receiving.bin"]
+    assert not (tmp_path / "stalled.bin").exists()
+
+def test_attachment_path_drops_directories () -> None:
+    path = attachment_path("chat", "attachment", "../../.env")
+
+    assert path.name == "attachment-.env"
+    assert path.parent.name == "chat"
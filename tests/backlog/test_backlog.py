@@ -0,0 +1,108 @@
+import threading
+import time
+
+from app.util.backlog import BacklogDrain
+
+
+class Recorder:
+    def __init__ (self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.handled: dict[str, list[int]] = dict()
+        self.threads: set[str] = set()
+        self.drained: list[list] = []
+
+    def handler (self, chat_id: str, messages: list[dict]) -> dict:
+        time.sleep(self.delay)
+        self.threads.add(threading.current_thread().name)
+        self.handled.setdefault(chat_id, []).extend(msg["counter"] for msg in messages)
+
+        return {"chat_id": chat_id, "acks": [msg["counter"] for msg in messages]}
+
+    def on_drained (self, acks: list) -> None:
+        self.drained.append(acks)
+
+def test_add_is_refused_outside_of_a_drain () -> None:
+    recorder = Recorder()
+    backlog = BacklogDrain(recorder.handler, recorder.on_drained)
+
+    assert not backlog.add("chat", {"counter": 0})
+
+def test_drain_keeps_the_order_of_each_chat () -> None:
+    recorder = Recorder()
+    backlog = BacklogDrain(recorder.handler, recorder.on_drained, quiet=60)
+    backlog.draining = True
+
+    for counter in range(100):
+        backlog.add(f"chat-{counter % 7}", {"counter": counter})
+
+    backlog.drain()
+
+    for chat_id, counters in recorder.handled.items():
+        assert counters == sorted(counters)
+
+    assert sum(len(counters) for counters in recorder.handled.values()) == 100
+    assert not backlog.draining
+
+def test_drain_acknowledges_every_chat_at_once () -> None:
+    recorder = Recorder()
+    backlog = BacklogDrain(recorder.handler, recorder.on_drained, quiet=60)
+    backlog.draining = True
+
+    for counter in range(10):
+        backlog.add(f"chat-{counter % 5}", {"counter": counter})
+
+    acks = backlog.drain()
+
+    assert len(recorder.drained) == 1
+    assert recorder.drained[0] == acks
+    assert sorted(ack["chat_id"] for ack in acks) == [f"chat-{i}" for i in range(5)]
+
+def test_drain_handles_chats_in_parallel () -> None:
+    recorder = Recorder(delay=0.2)
+    backlog = BacklogDrain(recorder.handler, recorder.on_drained, quiet=60, max_workers=8)
+    backlog.draining = True
+
+    for counter in range(8):
+        backlog.add(f"chat-{counter}", {"counter": counter})
+
+    start = time.monotonic()
+    backlog.drain()
+
+    assert time.monotonic() - start < 0.2 * 4
+    assert len(recorder.threads) > 1
+
+def test_start_drains_after_the_burst () -> None:
+    recorder = Recorder()
+    backlog = BacklogDrain(recorder.handler, recorder.on_drained, quiet=0.05)
+    backlog.start()
+
+    assert backlog.add("chat", {"counter": 0})
+    assert backlog.add("chat", {"counter": 1})
+
+    deadline = time.monotonic() + 2
+    while backlog.draining and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert recorder.handled == {"chat": [0, 1]}
+    assert not backlog.add("chat", {"counter": 2})
+
+def test_a_failing_chat_does_not_stop_the_others () -> None:
+    recorder = Recorder()
+
+    def handler (chat_id: str, messages: list[dict]) -> dict:
+        if chat_id == "chat-1":
+            raise KeyError(chat_id)
+
+        return None if chat_id == "chat-2" else recorder.handler(chat_id, messages)
+
+    backlog = BacklogDrain(handler, recorder.on_drained, quiet=60)
+    backlog.draining = True
+
+    for counter in range(8):
+        backlog.add(f"chat-{counter % 4}", {"counter": counter})
+
+    acks = backlog.drain()
+
+    assert sorted(ack["chat_id"] for ack in acks) == ["chat-0", "chat-3"]
+    assert recorder.drained == [acks]
+    assert not backlog.draining
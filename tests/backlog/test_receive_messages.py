@@ -0,0 +1,71 @@
+from unittest.mock import patch
+
+import pytest
+from bson import ObjectId
+
+from app.models.chat import Chat
+from app.modules.user import events
+from app.util import crypto
+from app.util.keystore import Keystore
+from app.util.sessions import SessionCache
+from tests.crypto import create_chat_ratchets
+
+
+@pytest.fixture
+def session_cache (keystore: Keystore) -> SessionCache:
+    session_cache = SessionCache()
+
+    with (
+        patch("app.modules.user.events.session_cache", session_cache),
+        patch("app.services.chat.find_with_id") as mock_find_chat
+    ):
+        mock_find_chat.return_value = Chat(users=[ "alice" ], mode=crypto.GCM_MODE)
+
+        yield session_cache
+
+def message (ratchets: dict, msg: bytes, mode: str = crypto.GCM_MODE) -> dict:
+    cipher, header = crypto.snd_msg(ratchets, ratchets["user_ratchet"], msg, mode, "alice-chat")
+
+    return {
+        "sender": { "telephone": "alice", "chat_id": header.chat_id },
+        "receiver": { "telephone": "bob", "chat_id": "chat" },
+        "message_id": str(ObjectId()),
+        "cipher": bytes(cipher),
+        "dh_ratchet": header.dh_ratchet,
+        "counter": header.counter,
+        "mode": header.mode
+    }
+
+@pytest.fixture
+def chat (session_cache: SessionCache) -> dict:
+    ratchets_alice, ratchets_bob = create_chat_ratchets()
+    session_cache.save_ratchets("chat", ratchets_bob)
+
+    yield ratchets_alice
+
+def test_unknown_session_is_not_confirmed (session_cache: SessionCache) -> None:
+    assert events.receive_messages("unknown", [ { "cipher": b"" } ]) is None
+
+def test_nothing_is_saved_nor_confirmed_when_every_message_fails (
+    session_cache: SessionCache, chat: dict
+) -> None:
+    data = message(chat, b"hi bob")
+    data["cipher"] = data["cipher"][ : -1 ] + bytes([ data["cipher"][-1] ^ 1 ])
+    pending = dict(session_cache.pending)
+
+    assert events.receive_messages("chat", [ data ]) is None
+    assert session_cache.pending == pending
+
+def test_received_messages_are_confirmed (session_cache: SessionCache, chat: dict) -> None:
+    messages = [ message(chat, f"message {idx}".encode("utf-8")) for idx in range(3) ]
+
+    confirmation = events.receive_messages("chat", messages)
+
+    assert confirmation["acks"] == [ data["message_id"] for data in messages ]
+
+def test_downgraded_messages_are_not_confirmed (session_cache: SessionCache, chat: dict) -> None:
+    data = message(chat, b"hi bob", crypto.CBC_MODE)
+    pending = dict(session_cache.pending)
+
+    assert events.receive_messages("chat", [ data ]) is None
+    assert session_cache.pending == pending
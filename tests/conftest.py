@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+
+def pytest_configure (config: pytest.Config) -> None:
+    # the app opens its keystore on import, so it is moved out of the source tree before that
+    os.environ["KEYSTORE_PATH"] = tempfile.mkdtemp(prefix="keystore-")
+
+def pytest_unconfigure (config: pytest.Config) -> None:
+    shutil.rmtree(os.environ.pop("KEYSTORE_PATH"), ignore_errors=True)
+
+@pytest.fixture
+def keystore (tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> "Keystore":
+    # imported here, the app must not be imported before the keystore path is set
+    from app.util import crypto
+    from app.util.keystore import Keystore
+
+    keystore = Keystore(tmp_path / "keystore")
+    monkeypatch.setattr(crypto, "keystore", keystore)
+
+    yield keystore
+
+@pytest.fixture
+def sqlite_keystore (tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> "SqliteKeystore":
+    from app.util import crypto
+    from app.util.keystore import SqliteKeystore
+
+    keystore = SqliteKeystore(tmp_path / "keystore")
+    monkeypatch.setattr(crypto, "keystore", keystore)
+
+    yield keystore
+
+    keystore.clean()
@@ -3,7 +3,7 @@ import dataclasses as dc
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
 
-from app.util.crypto import PrivateKey, PublicKey, SymmetricRatchet
+from app.util.crypto import PrivateKey, PublicKey, SymmetricRatchet, create_chat_encryption
 
 
 @dc.dataclass()
@@ -61,4 +61,22 @@ class Eve (Keyzeds):
     SGN_KEY: Ed25519PrivateKey = dc.field(default_factory=Ed25519PrivateKey.generate)
 
     def __post_init__ (self) -> None:
-        self.ratchet.dh_ratchet = X25519PrivateKey.generate()
\ No newline at end of file
+        self.ratchet.dh_ratchet = X25519PrivateKey.generate()
+
+def create_chat_ratchets () -> tuple[dict, dict]:
+    # alice's ratchets, ready to send to bob, and bob's, waiting for her first message
+    alice = Alice()
+    bob = Bob()
+
+    alice.ratchet.root_ratchet = create_chat_encryption(
+        alice.private_keys(), bob.public_keys(), True
+    )
+    bob.ratchet.root_ratchet = create_chat_encryption(
+        bob.private_keys(), alice.public_keys(), False
+    )
+
+    ratchets_alice = alice.ratchets() | {
+        "user_ratchet": bob.ratchet.dh_ratchet.public_key()
+    }
+
+    return ratchets_alice, bob.ratchets()
\ No newline at end of file
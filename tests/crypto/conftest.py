@@ -0,0 +1,8 @@
+import pytest
+
+from . import create_chat_ratchets
+
+
+@pytest.fixture
+def chat_ratchets () -> tuple[dict, dict]:
+    yield create_chat_ratchets()
@@ -0,0 +1,100 @@
+import dataclasses as dc
+
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from app.util import crypto
+from app.util.crypto import (CBC_MODE, GCM_MODE, create_chat_encryption,
+                             negotiate_mode, rcv_msg, snd_msg)
+from app.util.exc import CipherModeMismatch, UnsupportedCipherMode
+
+from . import Alice, Bob, Eve
+
+
+def send (ratchets: dict, msg: bytes) -> tuple[bytearray, crypto.MessageHeader]:
+    return snd_msg(ratchets, ratchets["user_ratchet"], msg, mode=GCM_MODE, chat_id="chat")
+
+@pytest.mark.parametrize(
+    "expected", [ b"", b"teste", b"dezesseis caract", bytes(range(256)) * 20 ]
+)
+def test_bob_can_decode_alice_aead_message (
+    expected: bytes, chat_ratchets: tuple[dict, dict]
+) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    cipher, header = send(ratchets_alice, expected)
+
+    assert len(cipher) == len(expected) + crypto.GCM_TAG_SIZE
+    assert rcv_msg(ratchets_bob, header, cipher) == expected
+
+def test_tampered_cipher_is_rejected (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    cipher, header = send(ratchets_alice, b"teste")
+    cipher[0] ^= 1
+
+    with pytest.raises(InvalidTag):
+        rcv_msg(ratchets_bob, header, cipher)
+
+@pytest.mark.parametrize("field, value", [ ("chat_id", "other chat"), ("counter", 0) ])
+def test_tampered_header_is_rejected (
+    field: str, value: str | int, chat_ratchets: tuple[dict, dict]
+) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    # the skipped key is still available, so only the header tells both messages apart
+    send(ratchets_alice, b"skipped")
+    cipher, header = send(ratchets_alice, b"teste")
+
+    with pytest.raises(InvalidTag):
+        rcv_msg(ratchets_bob, dc.replace(header, **{ field: value }), cipher)
+
+def test_eve_cant_fake_alice_aead_message () -> None:
+    alice = Alice()
+    bob = Bob()
+    eve = Eve()
+
+    bob.ratchet.root_ratchet = create_chat_encryption(
+        bob.private_keys(), alice.public_keys(), False
+    )
+    eve.ratchet.root_ratchet = create_chat_encryption(
+        eve.private_keys(), bob.public_keys(), True
+    )
+    ratchets_eve = eve.ratchets() | { "user_ratchet": bob.ratchet.dh_ratchet.public_key() }
+
+    cipher, header = send(ratchets_eve, b"teste")
+
+    with pytest.raises(InvalidTag):
+        rcv_msg(bob.ratchets(), header, cipher)
+
+def test_unsupported_mode_is_rejected (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    cipher, header = send(ratchets_alice, b"teste")
+
+    with pytest.raises(UnsupportedCipherMode):
+        rcv_msg(ratchets_bob, dc.replace(header, mode="rot13"), cipher)
+
+    assert rcv_msg(ratchets_bob, header, cipher) == b"teste"
+
+def test_downgraded_mode_is_rejected (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    cipher, header = snd_msg(
+        ratchets_alice, ratchets_alice["user_ratchet"], b"teste", mode=CBC_MODE, chat_id="chat"
+    )
+
+    with pytest.raises(CipherModeMismatch):
+        rcv_msg(ratchets_bob, header, cipher, GCM_MODE)
+
+    assert rcv_msg(ratchets_bob, header, cipher, CBC_MODE) == b"teste"
+
+@pytest.mark.parametrize(
+    "modes, expected", [
+        ([ CBC_MODE, GCM_MODE ], GCM_MODE),
+        ([ CBC_MODE ], CBC_MODE),
+        ([ "chacha20-poly1305" ], CBC_MODE)
+    ]
+)
+def test_negotiate_mode (modes: list[str], expected: str) -> None:
+    assert negotiate_mode(modes) == expected
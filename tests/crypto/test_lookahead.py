@@ -0,0 +1,119 @@
+import copy
+
+import pytest
+
+from app.util import crypto
+from app.util.crypto import SymmetricRatchet, rcv_msg, snd_msg
+from app.util.keypool import KeyPool
+
+
+def test_lookahead_keys_follow_the_chain () -> None:
+    chain, ahead = SymmetricRatchet(b"\x01" * 32), SymmetricRatchet(b"\x01" * 32)
+    ahead.fill(8)
+
+    for _ in range(10):
+        assert ahead.next() == chain.next()
+
+    assert (ahead.state, ahead.count) == (chain.state, chain.count)
+
+def test_fill_does_not_advance_the_chain () -> None:
+    chain = SymmetricRatchet(b"\x01" * 32, 3)
+    state = chain.state
+
+    assert chain.fill(4) == 4
+    assert chain.fill(4) == 0
+    assert (chain.state, chain.count) == (state, 3)
+    assert crypto.decode_ratchet(crypto.encode_ratchet(chain)).state == state
+
+def test_lookahead_is_bounded () -> None:
+    chain = SymmetricRatchet(b"\x01" * 32)
+    chain.fill(crypto.MAX_LOOKAHEAD * 2)
+
+    assert len(chain.lookahead) == crypto.MAX_LOOKAHEAD
+
+def test_consumed_keys_are_wiped () -> None:
+    chain = SymmetricRatchet(b"\x01" * 32)
+    chain.fill(2)
+    output = chain.lookahead[0]
+
+    key, _ = chain.next()
+
+    assert key != bytes(32)
+    assert output == bytes(80)
+    assert len(chain.lookahead) == 1
+
+def test_input_discards_the_lookahead () -> None:
+    chain = SymmetricRatchet(b"\x01" * 32)
+    chain.fill(2)
+    outputs = list(chain.lookahead)
+
+    chain.next(b"\x02" * 32)
+
+    assert len(chain.lookahead) == 0
+    assert all(output == bytes(80) for output in outputs)
+
+def test_copies_do_not_share_the_lookahead () -> None:
+    chain = SymmetricRatchet(b"\x01" * 32)
+    chain.fill(2)
+
+    copied = copy.copy(chain)
+    copied.next()
+
+    assert len(chain.lookahead) == 2
+    assert chain.lookahead[0] != bytes(80)
+
+def test_messages_sent_from_the_lookahead_are_received (
+    chat_ratchets: tuple[dict, dict]
+) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+    pbkey = ratchets_alice["user_ratchet"]
+
+    cipher, header = snd_msg(ratchets_alice, pbkey, b"first")
+    assert rcv_msg(ratchets_bob, header, cipher) == b"first"
+
+    ratchets_alice["snd_ratchet"].fill(4)
+    ratchets_bob["rcv_ratchet"].fill(4)
+
+    for idx in range(6):
+        cipher, header = snd_msg(ratchets_alice, pbkey, f"message {idx}".encode("utf-8"))
+
+        assert rcv_msg(ratchets_bob, header, cipher) == f"message {idx}".encode("utf-8")
+
+def test_received_key_is_not_left_in_memory (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+    pbkey = ratchets_alice["user_ratchet"]
+
+    cipher, header = snd_msg(ratchets_alice, pbkey, b"first")
+    rcv_msg(ratchets_bob, header, cipher)
+
+    replaced = ratchets_bob["rcv_ratchet"]
+    replaced.fill(4)
+
+    key, init_vector, header = crypto.snd_key(ratchets_alice, pbkey)
+    cipher = crypto.encrypt(key, init_vector, b"second", header)
+    assert rcv_msg(ratchets_bob, header, cipher) == b"second"
+
+    # the copy that decrypted the message replaced the chain, wiping its buffer
+    assert len(replaced.lookahead) == 0
+    assert not any(key in bytes(output) for output in ratchets_bob["rcv_ratchet"].lookahead)
+    assert len(ratchets_bob["rcv_ratchet"].lookahead) == 3
+
+def test_rotation_keeps_the_public_key_of_the_pool (
+    chat_ratchets: tuple[dict, dict], monkeypatch: pytest.MonkeyPatch
+) -> None:
+    ratchets_alice, _ = chat_ratchets
+    monkeypatch.setattr(crypto, "key_pool", KeyPool(size=2))
+    crypto.key_pool.fill()
+    pvt_key, pbkey = crypto.key_pool.pairs[0]
+
+    derived = []
+    public_key = crypto.public_key
+    monkeypatch.setattr(crypto, "public_key", lambda key: derived.append(key) or public_key(key))
+
+    headers = [
+        crypto.snd_key(ratchets_alice, ratchets_alice["user_ratchet"])[2] for _ in range(3)
+    ]
+
+    assert ratchets_alice["dh_ratchet"] is pvt_key
+    assert [ header.dh_ratchet for header in headers ] == [ pbkey ] * 3
+    assert not any(key is pvt_key for key in derived)
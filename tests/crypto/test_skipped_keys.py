@@ -0,0 +1,154 @@
+import dataclasses as dc
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.crypto import SkippedKeys, SymmetricRatchet, rcv_msg, snd_msg
+from app.util.exc import MessageKeyNotFound
+
+
+def send (ratchets: dict, msg: bytes) -> tuple[bytes, crypto.MessageHeader]:
+    return snd_msg(ratchets, ratchets["user_ratchet"], msg)
+
+def test_messages_out_of_order_are_decoded (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    messages = [ send(ratchets_alice, f"message {idx}".encode("utf-8")) for idx in range(5) ]
+
+    for idx in (3, 0, 4, 2, 1):
+        cipher, header = messages[idx]
+
+        assert rcv_msg(ratchets_bob, header, cipher) == f"message {idx}".encode("utf-8")
+
+    assert len(ratchets_bob["skipped_keys"]) == 0
+
+def test_late_message_of_previous_chain_is_decoded (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    late_cipher, late_header = send(ratchets_alice, b"late message")
+    cipher, header = send(ratchets_alice, b"first message")
+    rcv_msg(ratchets_bob, header, cipher)
+
+    # bob answers, so alice's next message comes on a new chain
+    cipher, header = send(ratchets_bob, b"answer")
+    rcv_msg(ratchets_alice, header, cipher)
+    cipher, header = send(ratchets_alice, b"new chain")
+
+    assert header.dh_ratchet != late_header.dh_ratchet
+    assert rcv_msg(ratchets_bob, header, cipher) == b"new chain"
+    assert rcv_msg(ratchets_bob, late_header, late_cipher) == b"late message"
+
+def test_message_after_previous_chain_end_is_decoded (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    cipher, header = send(ratchets_alice, b"first message")
+    rcv_msg(ratchets_bob, header, cipher)
+    late_cipher, late_header = send(ratchets_alice, b"late message")
+
+    cipher, header = send(ratchets_bob, b"answer")
+    rcv_msg(ratchets_alice, header, cipher)
+    cipher, header = send(ratchets_alice, b"new chain")
+    rcv_msg(ratchets_bob, header, cipher)
+
+    assert rcv_msg(ratchets_bob, late_header, late_cipher) == b"late message"
+
+def test_skipped_key_used_only_once (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    late_cipher, late_header = send(ratchets_alice, b"late message")
+    cipher, header = send(ratchets_alice, b"message")
+    rcv_msg(ratchets_bob, header, cipher)
+    rcv_msg(ratchets_bob, late_header, late_cipher)
+
+    with pytest.raises(MessageKeyNotFound):
+        rcv_msg(ratchets_bob, late_header, late_cipher)
+
+def test_tampered_message_leaves_the_ratchets (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    messages = [
+        snd_msg(ratchets_alice, ratchets_alice["user_ratchet"], b"message", crypto.GCM_MODE)
+        for _ in range(3)
+    ]
+    cipher, header = messages[2]
+    cipher[0] ^= 1
+
+    with pytest.raises(InvalidTag):
+        rcv_msg(ratchets_bob, header, cipher)
+
+    # no chain was created nor key skipped for the forged message
+    assert "rcv_ratchet" not in ratchets_bob
+    assert len(ratchets_bob.get("skipped_keys", SkippedKeys())) == 0
+
+    for cipher, header in messages[ : 2 ]:
+        assert rcv_msg(ratchets_bob, header, cipher) == b"message"
+
+def test_unknown_dh_ratchet_leaves_the_ratchets (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    cipher, header = snd_msg(ratchets_alice, ratchets_alice["user_ratchet"], b"message",
+        crypto.GCM_MODE)
+    rcv_msg(ratchets_bob, header, cipher)
+    root_state = ratchets_bob["root_ratchet"].state
+
+    forged = dc.replace(header, dh_ratchet=crypto.public_key(X25519PrivateKey.generate()))
+    with pytest.raises(InvalidTag):
+        rcv_msg(ratchets_bob, forged, cipher)
+
+    # the root ratchet did not rotate, and the chain of alice goes on
+    assert ratchets_bob["root_ratchet"].state == root_state
+    assert ratchets_bob["user_ratchet"] == header.dh_ratchet
+
+    cipher, header = snd_msg(ratchets_alice, ratchets_alice["user_ratchet"], b"next",
+        crypto.GCM_MODE)
+    assert rcv_msg(ratchets_bob, header, cipher) == b"next"
+
+def test_skipped_keys_capped (monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(crypto, "SKIPPED_KEYS_CAP", 10)
+
+    skipped_keys = SkippedKeys()
+    skipped_keys.skip("pbkey", SymmetricRatchet(b"\x01" * 32), 25)
+
+    assert len(skipped_keys) == 10
+    assert skipped_keys.pop("pbkey", 0) is None
+    assert skipped_keys.pop("pbkey", 24) is not None
+
+def test_skipped_keys_expire (monkeypatch: pytest.MonkeyPatch) -> None:
+    skipped_keys = SkippedKeys()
+    skipped_keys.skip("pbkey", SymmetricRatchet(b"\x01" * 32), 5)
+
+    monkeypatch.setattr(crypto, "SKIPPED_KEYS_TTL", -1)
+    skipped_keys.evict()
+
+    assert len(skipped_keys) == 0
+
+def test_skipped_keys_roundtrip_through_keystore (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    late_cipher, late_header = send(ratchets_alice, b"late message")
+    cipher, header = send(ratchets_alice, b"message")
+    rcv_msg(ratchets_bob, header, cipher)
+
+    field = crypto.encode_ratchet(ratchets_bob["skipped_keys"])
+    ratchets_bob["skipped_keys"] = crypto.decode_ratchet(field)
+
+    assert rcv_msg(ratchets_bob, late_header, late_cipher) == b"late message"
+
+def test_store_is_only_copied_when_a_key_changes (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    messages = [ send(ratchets_alice, f"message {idx}".encode("utf-8")) for idx in range(3) ]
+    rcv_msg(ratchets_bob, messages[1][1], messages[1][0])
+    skipped_keys = ratchets_bob["skipped_keys"]
+
+    # in order, no key is added nor removed
+    rcv_msg(ratchets_bob, messages[2][1], messages[2][0])
+
+    assert ratchets_bob["skipped_keys"] is skipped_keys
+
+    rcv_msg(ratchets_bob, messages[0][1], messages[0][0])
+
+    assert ratchets_bob["skipped_keys"] is not skipped_keys
+    assert len(ratchets_bob["skipped_keys"]) == 0 and len(skipped_keys) == 1
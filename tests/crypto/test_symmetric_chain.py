@@ -0,0 +1,83 @@
+from unittest.mock import patch
+
+import pytest
+
+from app.util import crypto
+from app.util.crypto import rcv_msg, snd_msg
+from app.util.exc import MessageKeyNotFound, TooManySkippedMessages
+
+
+def send (ratchets: dict, msg: bytes) -> tuple[bytes, crypto.MessageHeader]:
+    return snd_msg(ratchets, ratchets["user_ratchet"], msg)
+
+def test_consecutive_messages_keep_dh_ratchet (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, _ = chat_ratchets
+
+    headers = [ send(ratchets_alice, b"burst")[1] for _ in range(10) ]
+
+    assert len({ header.dh_ratchet for header in headers }) == 1
+    assert [ header.counter for header in headers ] == list(range(10))
+
+def test_consecutive_messages_rotate_dh_ratchet_once (
+    chat_ratchets: tuple[dict, dict]
+) -> None:
+    ratchets_alice, _ = chat_ratchets
+
+    with patch(
+        "app.util.crypto.dh_ratchet_rotation_send", wraps=crypto.dh_ratchet_rotation_send
+    ) as rotation:
+        for _ in range(10):
+            send(ratchets_alice, b"burst")
+
+        rotation.assert_called_once()
+
+def test_bob_decodes_burst_of_messages (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    for idx in range(10):
+        cipher, header = send(ratchets_alice, f"message {idx}".encode("utf-8"))
+
+        assert rcv_msg(ratchets_bob, header, cipher) == f"message {idx}".encode("utf-8")
+
+def test_conversation_turns_rotate_dh_ratchet (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+    dh_ratchets = set()
+
+    for turn in range(4):
+        sender, receiver = (
+            (ratchets_alice, ratchets_bob) if turn % 2 == 0 else (ratchets_bob, ratchets_alice)
+        )
+
+        for idx in range(3):
+            cipher, header = send(sender, f"turn {turn} {idx}".encode("utf-8"))
+            dh_ratchets.add(header.dh_ratchet)
+
+            assert rcv_msg(receiver, header, cipher) == f"turn {turn} {idx}".encode("utf-8")
+
+    assert len(dh_ratchets) == 4
+
+def test_lost_message_does_not_break_chain (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    send(ratchets_alice, b"lost message")
+    cipher, header = send(ratchets_alice, b"delivered message")
+
+    assert rcv_msg(ratchets_bob, header, cipher) == b"delivered message"
+
+def test_used_message_key_raises (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    cipher, header = send(ratchets_alice, b"message")
+    rcv_msg(ratchets_bob, header, cipher)
+
+    with pytest.raises(MessageKeyNotFound):
+        rcv_msg(ratchets_bob, header, cipher)
+
+def test_skipping_too_many_messages_raises (chat_ratchets: tuple[dict, dict]) -> None:
+    ratchets_alice, ratchets_bob = chat_ratchets
+
+    cipher, header = send(ratchets_alice, b"message")
+    header.counter = crypto.MAX_SKIP + 1
+
+    with pytest.raises(TooManySkippedMessages):
+        rcv_msg(ratchets_bob, header, cipher)
@@ -0,0 +1,50 @@
+import threading
+
+from app.util.devices import DeviceDirectory, device_session
+from app.util.keystore import Keystore
+
+
+def test_device_session () -> None:
+    assert device_session("chat") == "chat"
+    assert device_session("chat", "phone") == "chat@phone"
+
+def test_local_device_is_kept_on_the_keystore (keystore: Keystore) -> None:
+    device_id = DeviceDirectory().local_device()
+
+    assert DeviceDirectory().local_device() == device_id
+
+def test_devices_are_cached_until_invalidated (keystore: Keystore) -> None:
+    directory = DeviceDirectory()
+    assert directory.load("bob") is None
+
+    directory.store("bob", [ "phone", "laptop" ])
+
+    # a new directory reads the devices from the keystore
+    assert sorted(DeviceDirectory().load("bob")) == [ "laptop", "phone" ]
+
+    directory.invalidate("bob")
+
+    assert directory.load("bob") is None
+    assert DeviceDirectory().load("bob") is None
+
+def test_targets_leave_out_removed_devices (keystore: Keystore) -> None:
+    directory = DeviceDirectory()
+    sessions = { "phone": "chat-1", "laptop": "chat-2" }
+
+    assert directory.targets("bob", sessions) == sessions
+
+    directory.store("bob", [ "phone", "tablet" ])
+
+    assert directory.targets("bob", sessions) == { "phone": "chat-1" }
+
+def test_encrypt_for_runs_on_the_pool (keystore: Keystore) -> None:
+    threads = set()
+
+    def encrypt (device: str) -> dict:
+        threads.add(threading.current_thread().name)
+        return { "device": device }
+
+    envelopes = DeviceDirectory(max_workers=2).encrypt_for([ "a", "b", "c" ], encrypt)
+
+    assert [ envelope["device"] for envelope in envelopes ] == [ "a", "b", "c" ]
+    assert all(name.startswith("device") for name in threads)
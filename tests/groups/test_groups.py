@@ -0,0 +1,118 @@
+import pytest
+from bson import ObjectId
+from cryptography.exceptions import InvalidTag
+
+from app.models.chat import Chat
+from app.util import crypto, groups
+from app.util.exc import InvalidGroupSignature, UnknownSenderKey
+
+MEMBERS = ("alice", "bob", "carol")
+
+
+@pytest.fixture
+def group () -> dict[str, dict]:
+    # the ratchets of each member, after every sender key was distributed
+    ratchets = { member: groups.create_sender_key() for member in MEMBERS }
+    chat_ids = { member: str(ObjectId()) for member in MEMBERS }
+
+    for member, sender_key in ratchets.items():
+        packed = groups.pack_sender_key(
+            sender_key[groups.SENDER_CHAIN], sender_key[groups.SENDER_SIGNING].public_key(),
+            chat_ids[member]
+        )
+
+        for other in MEMBERS:
+            if other != member:
+                chain, sgn_key, _ = groups.unpack_sender_key(packed)
+                groups.add_member_key(ratchets[other], member, chain, sgn_key)
+
+    yield ratchets
+
+def test_sender_key_round_trip () -> None:
+    sender_key = groups.create_sender_key()
+    sender_key[groups.SENDER_CHAIN].next()
+    chat_id = str(ObjectId())
+
+    chain, sgn_key, member_chat_id = groups.unpack_sender_key(groups.pack_sender_key(
+        sender_key[groups.SENDER_CHAIN], sender_key[groups.SENDER_SIGNING].public_key(), chat_id
+    ))
+
+    assert chain.state == sender_key[groups.SENDER_CHAIN].state
+    assert chain.count == 1
+    assert crypto.public_key(sgn_key) == crypto.public_key(sender_key[groups.SENDER_SIGNING])
+    assert member_chat_id == chat_id
+
+def test_single_cipher_decrypted_by_every_member (group: dict[str, dict]) -> None:
+    cipher, header, signature = groups.snd_group_msg(group["alice"], b"hi all", chat_id="g")
+
+    for member in ("bob", "carol"):
+        assert groups.rcv_group_msg(group[member], "alice", header, cipher, signature) == b"hi all"
+
+def test_messages_out_of_order (group: dict[str, dict]) -> None:
+    sent = [ groups.snd_group_msg(group["bob"], f"msg {idx}".encode()) for idx in range(3) ]
+
+    for idx in (2, 0, 1):
+        cipher, header, signature = sent[idx]
+
+        assert groups.rcv_group_msg(
+            group["carol"], "bob", header, cipher, signature
+        ) == f"msg {idx}".encode()
+
+def test_member_can_not_impersonate_another (group: dict[str, dict]) -> None:
+    # carol knows the chain of alice, but not her signing key
+    chain = group["carol"]["chain-alice"]
+    forged = {
+        groups.SENDER_CHAIN: crypto.SymmetricRatchet(chain.state, chain.count),
+        groups.SENDER_SIGNING: group["carol"][groups.SENDER_SIGNING]
+    }
+    cipher, header, signature = groups.snd_group_msg(forged, b"forged")
+
+    with pytest.raises(InvalidGroupSignature):
+        groups.rcv_group_msg(group["bob"], "alice", header, cipher, signature)
+
+    # the forged message consumed no key of the chain
+    assert group["bob"]["chain-alice"].count == 0
+
+def test_tampered_cipher_is_rejected (group: dict[str, dict]) -> None:
+    cipher, header, signature = groups.snd_group_msg(group["alice"], b"hi all")
+    cipher[0] ^= 1
+
+    with pytest.raises(InvalidGroupSignature):
+        groups.rcv_group_msg(group["bob"], "alice", header, cipher, signature)
+
+def test_undecryptable_message_consumes_no_key (group: dict[str, dict]) -> None:
+    # signed by alice, but not sealed with the key of its counter, which skips the first one
+    groups.snd_group_msg(group["alice"], b"lost")
+    _, header, _ = groups.snd_group_msg(group["alice"], b"forged")
+    cipher = bytes(48)
+    signature = group["alice"][groups.SENDER_SIGNING].sign(header.associated_data() + cipher)
+
+    with pytest.raises(InvalidTag):
+        groups.rcv_group_msg(group["bob"], "alice", header, cipher, signature)
+
+    assert group["bob"]["chain-alice"].count == 0
+    assert len(group["bob"].get("skipped_keys", [])) == 0
+
+def test_unknown_member (group: dict[str, dict]) -> None:
+    cipher, header, signature = groups.snd_group_msg(groups.create_sender_key(), b"hi")
+
+    with pytest.raises(UnknownSenderKey):
+        groups.rcv_group_msg(group["bob"], "dave", header, cipher, signature)
+
+def test_sender_keys_survive_the_keystore (group: dict[str, dict]) -> None:
+    stored = {
+        ratchet_name: crypto.decode_ratchet(crypto.encode_ratchet(ratchet))
+        for ratchet_name, ratchet in group["bob"].items()
+    }
+    cipher, header, signature = groups.snd_group_msg(group["alice"], b"hi all")
+
+    assert groups.rcv_group_msg(stored, "alice", header, cipher, signature) == b"hi all"
+    assert set(groups.member_keys(stored)) == { "alice", "carol" }
+
+def test_pairwise_sessions_of_a_group () -> None:
+    chat = Chat(users=[ "bob" ])
+    group_chat = Chat(users=[ "bob", "carol" ])
+
+    assert groups.session_id(chat, "bob") == str(chat._id)
+    assert groups.session_id(group_chat, "bob") == f"{group_chat._id}-bob"
+    assert groups.group_id(group_chat) == str(group_chat._id)
@@ -0,0 +1,320 @@
+import asyncio
+import threading
+import time
+from collections.abc import Callable
+from unittest.mock import patch
+
+import pytest
+
+from app.util import jobs
+from app.util.exc import (JobResolutionConfigurationError, MissingChatId,
+                          NotJobInstance, PriorityRangeError)
+from app.util.jobs import Job, JobQueue
+
+solved = []
+
+class RecordJob (Job):
+    def solve (self, ack: Callable = None) -> None:
+        solved.append(self.data)
+
+class RefusedJob (Job):
+    def solve (self, ack: Callable = None) -> None:
+        solved.append(self.data)
+        raise ConnectionRefusedError
+
+class FailingJob (Job):
+    def solve (self, ack: Callable = None) -> None:
+        raise ValueError
+
+@pytest.fixture(autouse=True)
+def clear_solved () -> None:
+    solved.clear()
+
+def test_jobs_run_by_priority () -> None:
+    queue = JobQueue()
+
+    queue.add_job("user", 2, RecordJob, data="message", chat_id="chat")
+    queue.add_job("user", 1, RecordJob, data="chat")
+    queue.add_job("user", 0, RecordJob, data="refresh")
+    queue.resolve_jobs("user")
+
+    assert solved == ["refresh", "chat", "message"]
+    assert "user" not in queue.job_dict
+
+def test_messages_keep_their_order_in_each_chat () -> None:
+    queue = JobQueue()
+
+    for idx in range(3):
+        queue.add_job("user", 2, RecordJob, data=f"a{idx}", chat_id="a")
+
+    for idx in range(2):
+        queue.add_job("user", 2, RecordJob, data=f"b{idx}", chat_id="b")
+
+    queue.resolve_jobs("user")
+
+    # the chats take turns, each one in order
+    assert solved == ["a0", "b0", "a1", "b1", "a2"]
+
+def test_resolve_a_single_chat () -> None:
+    queue = JobQueue()
+
+    queue.add_job("user", 2, RecordJob, data="a0", chat_id="a")
+    queue.add_job("user", 2, RecordJob, data="b0", chat_id="b")
+    queue.add_job("user", 2, RecordJob, data="a1", chat_id="a")
+    queue.resolve_jobs("user", 2, "a")
+
+    assert solved == ["a0", "a1"]
+    assert queue.pending("user") == 1
+
+def test_less_urgent_jobs_wait_for_the_pending_ones () -> None:
+    queue = JobQueue()
+
+    queue.add_job("user", 0, RefusedJob, data="refresh")
+    queue.add_job("user", 1, RecordJob, data="chat")
+    queue.resolve_jobs("user")
+
+    # the refused job is retried later, and keeps the chat creation behind it
+    assert solved == ["refresh"]
+    assert queue.pending("user") == 2
+
+    queue.resolve_jobs("user", 1)
+    assert solved == ["refresh"]
+
+def test_refused_jobs_are_dropped_after_the_retries () -> None:
+    queue = JobQueue()
+
+    queue.add_job("user", 2, RefusedJob, data="message", chat_id="chat")
+    queue.add_job("user", 2, RecordJob, data="next", chat_id="chat")
+
+    for _ in range(jobs.MAX_RETRIES):
+        queue.wake("user")
+        queue.resolve_jobs("user")
+
+    assert solved == ["message"] * jobs.MAX_RETRIES + ["next"]
+    assert queue.pending("user") == 0
+
+def test_backoff_grows_with_the_retries (monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(jobs.random, "uniform", lambda low, high: high)
+    job = RecordJob()
+
+    delays = []
+    for _ in range(10):
+        job.increment_retries()
+        delays.append(job.backoff(0.0))
+
+    assert delays[:3] == [jobs.RETRY_BASE_DELAY * 2 ** idx for idx in range(3)]
+    assert delays[-1] == jobs.RETRY_MAX_DELAY
+
+def test_wait_sleeps_until_the_first_job_is_due () -> None:
+    queue = JobQueue()
+
+    assert not queue.wait("user", timeout=0.01)
+
+    queue.add_job("user", 0, RefusedJob, data="refresh")
+    assert queue.wait("user", timeout=0.01)
+
+    refused = time.monotonic()
+    queue.resolve_jobs("user")
+    due = queue.next_due("user")
+    assert due >= refused
+
+    # the reconnection makes the refused job due right away
+    waiter = threading.Thread(target=queue.wait, args=("user",))
+    waiter.start()
+    queue.wake("user")
+    waiter.join(timeout=1)
+
+    assert not waiter.is_alive()
+    assert queue.next_due("user") <= due
+
+def test_configurable_priority_range () -> None:
+    queue = JobQueue(min_priority=0, max_priority=5, chat_priority=4)
+
+    queue.add_job("user", 4, RecordJob, data="message", chat_id="chat")
+    queue.add_job("user", 3, RecordJob, data="low")
+    queue.resolve_jobs("user")
+
+    assert solved == ["low", "message"]
+
+    with pytest.raises(PriorityRangeError):
+        queue.add_job("user", 5, RecordJob)
+
+def test_invalid_jobs () -> None:
+    queue = JobQueue()
+
+    with pytest.raises(NotJobInstance):
+        queue.add_job("user", 1, dict)
+
+    with pytest.raises(PriorityRangeError):
+        queue.add_job("user", 3, RecordJob)
+
+    with pytest.raises(MissingChatId):
+        queue.add_job("user", 2, RecordJob)
+
+    with pytest.raises(JobResolutionConfigurationError):
+        queue.resolve_jobs("user", 1, "chat")
+
+def confirmation (acks: list[int]) -> dict:
+    return {
+        "Signed-Message": f"signed-{acks[-1]}",
+        "body": {
+            "sender": { "telephone": "alice", "chat_id": "sender" },
+            "receiver": { "telephone": "bob", "chat_id": "chat" },
+            "dh_ratchet": f"dh-{acks[-1]}",
+            "acks": acks
+        }
+    }
+
+def test_pending_confirmations_are_merged () -> None:
+    queue = JobQueue()
+
+    for idx in range(3):
+        queue.add_job("user", 2, jobs.ConfirmMessageJob, data=confirmation([idx]), chat_id="chat")
+
+    queue.add_job("user", 2, RecordJob, data="message", chat_id="chat")
+    queue.add_job("user", 2, jobs.ConfirmMessageJob, data=confirmation([3]), chat_id="chat")
+
+    # a confirmation is never merged past a job queued after it
+    assert queue.pending("user") == 3
+
+    sent = []
+    with patch("app.api.emit", side_effect=lambda *args, **kwargs: sent.append(args[1])):
+        queue.resolve_jobs("user")
+
+    assert sent == [ confirmation([0, 1, 2]), confirmation([3]) ]
+    assert solved == ["message"]
+
+def test_metrics_of_each_job_class () -> None:
+    queue = JobQueue()
+
+    queue.add_job("user", 1, RecordJob, data="chat")
+    queue.add_job("user", 2, RecordJob, data="message", chat_id="chat")
+    queue.add_job("user", 2, RecordJob, data="next", chat_id="chat")
+
+    metrics = queue.metrics()
+    assert metrics["RecordJob/2"]["depth"] == 2
+    assert metrics["RecordJob/2"]["oldest_age"] >= 0
+    assert metrics["RecordJob/1"]["solved"] == 0
+
+    queue.resolve_jobs("user")
+    queue.add_job("user", 0, RefusedJob, data="refresh")
+    queue.resolve_jobs("user")
+
+    metrics = queue.metrics()
+    assert metrics["RecordJob/2"] | { "depth": 0, "solved": 2 } == metrics["RecordJob/2"]
+    assert metrics["RecordJob/2"]["latency"]["count"] == 2
+    assert metrics["RefusedJob/0"]["depth"] == 1
+    assert metrics["RefusedJob/0"]["retries"] == 1
+
+def test_drops_and_failures_are_counted () -> None:
+    queue = JobQueue()
+
+    queue.add_job("user", 0, RefusedJob, data="refresh", retries=jobs.MAX_RETRIES - 1)
+    queue.resolve_jobs("user")
+    queue.add_job("user", 1, FailingJob)
+    queue.resolve_jobs("user")
+
+    metrics = queue.metrics()
+    assert metrics["RefusedJob/0"]["drops"] == 1
+    assert metrics["RefusedJob/0"]["depth"] == 0
+    assert metrics["FailingJob/1"]["failures"] == 1
+
+def test_metrics_handler_dumps_snapshots (monkeypatch: pytest.MonkeyPatch) -> None:
+    queue = JobQueue()
+    queue.add_job("user", 1, RecordJob, data="chat")
+
+    dumped = []
+    def dump (metrics: dict) -> None:
+        dumped.append(metrics)
+
+        if len(dumped) == 2:
+            raise SystemExit
+
+    with pytest.raises(SystemExit):
+        queue.metrics_handler(0.001, dump)
+
+    assert dumped[0]["RecordJob/1"]["depth"] == 1
+
+class SlowJob (Job):
+    # records the jobs solved at the same time as each one
+    active = []
+    overlaps = dict()
+    lock = threading.Lock()
+
+    def solve (self, ack: Callable = None) -> None:
+        with SlowJob.lock:
+            SlowJob.active.append(self.data)
+            SlowJob.overlaps[self.data] = list(SlowJob.active)
+
+        time.sleep(0.05)
+
+        with SlowJob.lock:
+            SlowJob.active.remove(self.data)
+            solved.append(self.data)
+
+@pytest.fixture
+def slow_jobs () -> None:
+    SlowJob.active.clear()
+    SlowJob.overlaps.clear()
+
+def test_chats_are_solved_at_the_same_time (slow_jobs: None) -> None:
+    queue = JobQueue()
+
+    for chat in range(4):
+        queue.add_job("user", 2, SlowJob, data=f"chat-{chat}", chat_id=f"chat-{chat}")
+
+    start = time.perf_counter()
+    asyncio.run(queue.run_jobs("user"))
+
+    assert time.perf_counter() - start < 4 * 0.05
+    assert max(len(overlap) for overlap in SlowJob.overlaps.values()) > 1
+    assert queue.pending("user") == 0
+
+def test_concurrency_is_capped_for_each_priority (slow_jobs: None) -> None:
+    queue = JobQueue(concurrency={ 0: 1, 1: 1, 2: 2 })
+
+    for chat in range(6):
+        queue.add_job("user", 2, SlowJob, data=f"message-{chat}", chat_id=f"chat-{chat}")
+
+    for idx in range(2):
+        queue.add_job("user", 1, SlowJob, data=f"chat-{idx}")
+
+    asyncio.run(queue.run_jobs("user"))
+
+    assert solved[:2] == ["chat-0", "chat-1"]
+    assert all(len(SlowJob.overlaps[f"chat-{idx}"]) == 1 for idx in range(2))
+    assert max(len(SlowJob.overlaps[f"message-{chat}"]) for chat in range(6)) == 2
+
+def test_refresh_is_a_barrier (slow_jobs: None) -> None:
+    queue = JobQueue()
+
+    for chat in range(3):
+        queue.add_job("user", 2, SlowJob, data=f"message-{chat}", chat_id=f"chat-{chat}")
+
+    queue.add_job("user", 0, SlowJob, data="refresh")
+
+    asyncio.run(queue.run_jobs("user"))
+
+    # nothing runs along the refresh, and every other job waits for it
+    assert solved[0] == "refresh"
+    assert SlowJob.overlaps["refresh"] == ["refresh"]
+
+def test_messages_keep_their_order_when_concurrent () -> None:
+    queue = JobQueue()
+
+    for idx in range(30):
+        chat = f"chat-{idx % 3}"
+        queue.add_job("user", 2, jobs.SendMessageJob, data={ "chat": chat, "counter": idx },
+            chat_id=chat)
+
+    sent = []
+    def emit (event: str, data: dict, callback: Callable = None) -> None:
+        time.sleep(0.001)
+        sent.append(data)
+
+    with patch("app.api.emit", side_effect=emit):
+        asyncio.run(queue.run_jobs("user"))
+
+    for chat in range(3):
+        counters = [ data["counter"] for data in sent if data["chat"] == f"chat-{chat}" ]
+        assert counters == list(range(chat, 30, 3))
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections.abc import Iterator
+from unittest.mock import patch
+
+import pytest
+import socketio
+from werkzeug.serving import make_server
+
+from app import api, sio
+from app.util import jobs
+from app.util.jobs import JobQueue
+
+MESSAGES = 20
+
+class StandInServer:
+    # receives the messages of the client and acknowledges each one
+    def __init__ (self) -> None:
+        self.server = socketio.Server(async_mode="threading", async_handlers=False)
+        self.received = []
+        self.delivered = threading.Event()
+
+        @self.server.on("message")
+        def message (sid: str, data: dict) -> str:
+            self.received.append((time.perf_counter(), data))
+
+            if len(self.received) == MESSAGES:
+                self.delivered.set()
+
+            return "ok"
+
+        self.http = make_server("127.0.0.1", 0, socketio.WSGIApp(self.server), threaded=True)
+        self.url = f"http://127.0.0.1:{self.http.server_port}"
+
+@pytest.fixture
+def server () -> Iterator[StandInServer]:
+    server = StandInServer()
+    worker = threading.Thread(target=server.http.serve_forever, daemon=True)
+    worker.start()
+
+    yield server
+
+    server.http.shutdown()
+
+def test_queue_is_sent_once_reconnected (
+    server: StandInServer, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    # without the connect event, nothing would be sent again for a whole minute
+    monkeypatch.setattr(jobs, "RETRY_BASE_DELAY", 60.0)
+    queue = JobQueue()
+    stop = threading.Event()
+
+    with (
+        patch("app.modules.auth.events.job_queue", queue),
+        patch.object(api, "user_id", "user"),
+        patch.object(api, "logout")
+    ):
+        for idx in range(MESSAGES):
+            queue.add_job("user", 2, jobs.SendMessageJob, data={ "counter": idx }, chat_id="chat")
+
+        handler = threading.Thread(target=api.job_handler, args=(queue, stop), daemon=True)
+        handler.start()
+
+        # refused while offline, the first job is backing off
+        time.sleep(0.05)
+        assert len(server.received) == 0
+
+        reconnected = time.perf_counter()
+        sio.connect(server.url, transports=["websocket"])
+
+        try:
+            assert server.delivered.wait(timeout=5)
+
+        finally:
+            sio.disconnect()
+            stop.set()
+            queue.wake()
+
+    first_delivery = server.received[0][0] - reconnected
+
+    assert [ data["counter"] for _, data in server.received ] == list(range(MESSAGES))
+    assert first_delivery < 1.0
@@ -0,0 +1,99 @@
+import threading
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto, journal
+from app.util.crypto import SymmetricRatchet
+from app.util.journal import RatchetJournal
+from app.util.keystore import Keystore
+from app.util.sessions import SessionCache
+
+
+@pytest.fixture
+def ratchets () -> dict[str, crypto.Ratchet | str]:
+    return {
+        "dh_ratchet": X25519PrivateKey.generate(),
+        "root_ratchet": SymmetricRatchet(b"\x01" * 32, 4),
+        "user_ratchet": crypto.public_key(X25519PrivateKey.generate())
+    }
+
+def test_committed_transactions_are_recovered (keystore: Keystore, tmp_path: Path) -> None:
+    ratchet_journal = RatchetJournal(tmp_path / "journal")
+
+    ratchet_journal.wait(ratchet_journal.append("chat", False, {
+        "root_ratchet": crypto.encode_ratchet(SymmetricRatchet(b"\x01" * 32, 4)),
+        "snd_ratchet": None
+    }))
+
+    assert RatchetJournal(tmp_path / "journal").recover() == [ ("chat", False, {
+        "root_ratchet": crypto.encode_ratchet(SymmetricRatchet(b"\x01" * 32, 4)),
+        "snd_ratchet": None
+    }) ]
+
+def test_torn_transaction_is_dropped (keystore: Keystore, tmp_path: Path) -> None:
+    ratchet_journal = RatchetJournal(tmp_path / "journal")
+    ratchet_journal.append("first", False, { "snd_ratchet": None })
+    ratchet_journal.append("second", False, { "snd_ratchet": None })
+    ratchet_journal.close()
+
+    segment_path = ratchet_journal.segments()[0]
+    segment_path.write_bytes(segment_path.read_bytes()[ : -5 ])
+
+    assert [ chat_id for chat_id, _, _ in ratchet_journal.recover() ] == [ "first" ]
+
+def test_commits_share_a_single_fsync (keystore: Keystore, tmp_path: Path) -> None:
+    ratchet_journal = RatchetJournal(tmp_path / "journal", window=0.05)
+
+    def commit (idx: int) -> None:
+        ratchet_journal.wait(ratchet_journal.append(f"chat-{idx}", False, { "snd_ratchet": None }))
+
+    with patch("app.util.journal.os.fsync", wraps=journal.os.fsync) as mock_fsync:
+        threads = [ threading.Thread(target=commit, args=(idx,)) for idx in range(20) ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert mock_fsync.call_count < 20
+
+    assert ratchet_journal.committed == 20
+    assert len(ratchet_journal.recover()) == 20
+
+def test_cache_recovers_changes_lost_before_the_flush (
+    keystore: Keystore, tmp_path: Path, ratchets: dict
+) -> None:
+    cache = SessionCache(journal=RatchetJournal(tmp_path / "journal"))
+    cache.save_ratchets("chat", ratchets)
+
+    # the process dies before the write-behind flush
+    assert keystore.read_record("ratchets", "chat") is None
+
+    recovered = SessionCache(journal=RatchetJournal(tmp_path / "journal"))
+    assert recovered.recover() == 1
+
+    loaded, pbkey = crypto.load_ratchets("chat")
+
+    assert crypto.public_key(pbkey) == ratchets["user_ratchet"]
+    assert loaded["root_ratchet"].state == ratchets["root_ratchet"].state
+    assert loaded["root_ratchet"].count == 4
+    assert len(recovered.journal.segments()) == 0
+
+def test_flush_discards_the_written_segments (
+    keystore: Keystore, tmp_path: Path, ratchets: dict
+) -> None:
+    cache = SessionCache(journal=RatchetJournal(tmp_path / "journal"))
+    cache.save_ratchets("chat", ratchets)
+    cache.flush()
+
+    assert len(cache.journal.segments()) == 0
+    assert keystore.read_record("ratchets", "chat") is not None
+
+    cache.delete_ratchet("chat", "root_ratchet")
+
+    assert len(cache.journal.segments()) == 1
+    assert cache.journal.recover() == [ ("chat", False, { "root_ratchet": None }) ]
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from app.util import crypto, keypool
+from app.util.keypool import KeyPool
+
+
+def test_fill_keeps_the_pool_size () -> None:
+    pool = KeyPool(size=8)
+
+    assert pool.fill() == 8
+    assert pool.fill() == 0
+    assert pool.metrics()["available"] == 8
+
+def test_public_keys_are_precomputed () -> None:
+    pool = KeyPool(size=2)
+    pool.fill()
+
+    pvt_key, pbkey = pool.take_pair()
+
+    assert pbkey == crypto.public_key(pvt_key)
+
+def test_every_key_is_handed_out_once () -> None:
+    pool = KeyPool(size=32)
+    pool.fill()
+
+    taken = []
+    def take () -> None:
+        for _ in range(16):
+            taken.append(pool.take_pair()[1])
+
+    workers = [ threading.Thread(target=take) for _ in range(4) ]
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    assert len(set(taken)) == 64
+
+def test_hit_rate_counts_the_empty_pool () -> None:
+    pool = KeyPool(size=3)
+    pool.fill()
+
+    for _ in range(4):
+        pool.take()
+
+    assert pool.hits == 3
+    assert pool.misses == 1
+    assert pool.hit_rate == 0.75
+
+def test_refill_handler_refills_after_a_take () -> None:
+    pool = KeyPool(size=4, refill_rate=1e6)
+    threading.Thread(target=pool.refill_handler, daemon=True).start()
+
+    deadline = time.monotonic() + 5
+    while pool.metrics()["available"] < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    pool.take()
+
+    while pool.metrics()["available"] < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert pool.metrics()["available"] == 4
+
+def test_concurrent_fills_do_not_overfill (monkeypatch: pytest.MonkeyPatch) -> None:
+    # slow enough for every fill to run while the others are generating
+    generate_pair = keypool.generate_pair
+    monkeypatch.setattr(keypool, "generate_pair", lambda: time.sleep(0.01) or generate_pair())
+    pool = KeyPool(size=16)
+    barrier = threading.Barrier(8)
+
+    def fill () -> None:
+        barrier.wait()
+        pool.fill()
+
+    workers = [ threading.Thread(target=fill) for _ in range(8) ]
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    assert pool.metrics()["available"] == 16
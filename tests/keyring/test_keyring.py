@@ -0,0 +1,57 @@
+from unittest.mock import patch
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.keyring import Keyring
+from app.util.keystore import Keystore
+
+
+@pytest.fixture
+def keystore (keystore: Keystore) -> Keystore:
+    # the keystore of every test, holding the keys of the user
+    crypto.generate_private_key("id_key")
+    crypto.generate_private_key("sgn_key")
+    crypto.generate_private_key("ed_key", sgn_key=True)
+
+    yield keystore
+
+def test_unlocked_keys_are_read_once (keystore: Keystore) -> None:
+    keyring = Keyring()
+    keyring.unlock()
+
+    with patch("app.util.crypto.load_private_key") as mock_load_pvt_key:
+        for _ in range(10):
+            keyring.load("id_key")
+            keyring.load("sgn_key")
+            keyring.load("ed_key")
+
+        mock_load_pvt_key.assert_not_called()
+
+def test_load_returns_the_same_key_object (keystore: Keystore) -> None:
+    keyring = Keyring()
+    keyring.unlock()
+
+    assert keyring.load("id_key") is keyring.load("id_key")
+
+def test_lock_drops_the_keys (keystore: Keystore) -> None:
+    keyring = Keyring()
+    keyring.unlock()
+    keyring.lock()
+
+    assert not keyring.unlocked
+
+    with patch("app.util.crypto.load_private_key") as mock_load_pvt_key:
+        keyring.load("id_key")
+
+        mock_load_pvt_key.assert_called_once_with("id_key")
+
+def test_other_keys_are_read_from_the_keystore (keystore: Keystore) -> None:
+    crypto.generate_private_key("dhr-chat-user")
+
+    keyring = Keyring()
+    keyring.unlock()
+
+    assert isinstance(keyring.load("dhr-chat-user"), X25519PrivateKey)
+    assert "dhr-chat-user" not in keyring.keys
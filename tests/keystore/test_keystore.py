@@ -0,0 +1,117 @@
+import os
+from pathlib import Path
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.crypto import SymmetricRatchet
+from app.util.keystore import Keystore, pack_record, unpack_record
+
+
+def raw_private_bytes (key: crypto.PrivateKey) -> bytes:
+    return key.private_bytes(
+        encoding=serialization.Encoding.Raw,
+        format=serialization.PrivateFormat.Raw,
+        encryption_algorithm=serialization.NoEncryption()
+    )
+
+def write_legacy_pem (path: Path, name: str, key: crypto.PrivateKey) -> None:
+    path.mkdir(parents=True, exist_ok=True)
+
+    with open(path / f"{name}.pem", "w") as pem_file:
+        encoded_key = key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.BestAvailableEncryption(
+                crypto.encode_b64(os.environ["SECRET_KEY"])
+            )
+        )
+
+        pem_file.write(crypto.decode_b64(encoded_key))
+
+def test_pack_record_roundtrip () -> None:
+    record = { "dh_ratchet": (1, b"\x00" * 32), "root_ratchet": (3, b"\xff" * 32) }
+
+    assert unpack_record(pack_record(record)) == record
+
+def test_record_is_sealed_on_disk (keystore: Keystore) -> None:
+    keystore.write_record("keys", "id_key", { "key": (1, b"secret-key-bytes") })
+
+    assert b"secret-key-bytes" not in (keystore.path / "keys/id_key.bin").read_bytes()
+    assert keystore.read_record("keys", "id_key") == { "key": (1, b"secret-key-bytes") }
+
+def test_record_bound_to_its_name (keystore: Keystore) -> None:
+    keystore.write_record("ratchets", "chat", { "root_ratchet": (3, b"\x01" * 32) })
+    os.replace(keystore.path / "ratchets/chat.bin", keystore.path / "ratchets/other.bin")
+
+    with pytest.raises(InvalidTag):
+        keystore.read_record("ratchets", "other")
+
+def test_private_keys_roundtrip (keystore: Keystore) -> None:
+    id_key = crypto.generate_private_key("id_key")
+    ed_key = crypto.generate_private_key("ed_key", sgn_key=True)
+
+    assert raw_private_bytes(crypto.load_private_key("id_key")) == raw_private_bytes(id_key)
+    assert isinstance(crypto.load_private_key("ed_key"), Ed25519PrivateKey)
+    assert raw_private_bytes(crypto.load_private_key("ed_key")) == raw_private_bytes(ed_key)
+
+def test_missing_private_key_raises (keystore: Keystore) -> None:
+    with pytest.raises(FileNotFoundError):
+        crypto.load_private_key("id_key")
+
+def test_ratchets_stored_in_one_record (keystore: Keystore) -> None:
+    dh_ratchet = X25519PrivateKey.generate()
+    user_ratchet = crypto.public_key(X25519PrivateKey.generate())
+
+    crypto.save_ratchet("chat", "dh_ratchet", dh_ratchet)
+    crypto.save_ratchet("chat", "root_ratchet", SymmetricRatchet(b"\x02" * 32))
+    crypto.save_ratchet("chat", "user_ratchet", user_ratchet)
+
+    assert keystore.list_records("ratchets") == [ "chat" ]
+
+    ratchets, pbkey = crypto.load_ratchets("chat")
+
+    assert crypto.public_key(pbkey) == user_ratchet
+    assert crypto.public_key(ratchets["dh_ratchet"]) == crypto.public_key(dh_ratchet)
+    assert ratchets["root_ratchet"].state == b"\x02" * 32
+
+def test_tmp_ratchets_are_prefixed (keystore: Keystore) -> None:
+    crypto.save_ratchet("chat", "root_ratchet", SymmetricRatchet(b"\x02" * 32), tmp=True)
+    ratchets, pbkey = crypto.load_ratchets("chat", tmp=True)
+
+    assert pbkey is None
+    assert list(ratchets.keys()) == [ "tmp-root_ratchet" ]
+
+    crypto.delete_ratchet("chat", "root_ratchet", tmp=True)
+
+    assert keystore.list_records("ratchets") == []
+
+def test_migrate_legacy_keys (
+    keystore: Keystore, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(crypto, "keys_path", tmp_path / "encrypted_keys")
+    monkeypatch.setattr(crypto, "ratchets_path", tmp_path / "ratchets")
+
+    id_key = X25519PrivateKey.generate()
+    dh_ratchet = X25519PrivateKey.generate()
+    user_ratchet = crypto.public_key(X25519PrivateKey.generate())
+
+    write_legacy_pem(tmp_path / "encrypted_keys", "id_key", id_key)
+    write_legacy_pem(tmp_path / "ratchets/chat", "dh_ratchet", dh_ratchet)
+    (tmp_path / "ratchets/chat/root_ratchet").write_text(crypto.decode_b64(b"\x03" * 32))
+    (tmp_path / "ratchets/chat/user_ratchet").write_text(user_ratchet)
+
+    crypto.migrate_legacy_keys()
+
+    ratchets, pbkey = crypto.load_ratchets("chat")
+
+    assert raw_private_bytes(crypto.load_private_key("id_key")) == raw_private_bytes(id_key)
+    assert crypto.public_key(ratchets["dh_ratchet"]) == crypto.public_key(dh_ratchet)
+    assert ratchets["root_ratchet"].state == b"\x03" * 32
+    assert crypto.public_key(pbkey) == user_ratchet
+    assert os.listdir(tmp_path / "encrypted_keys") == []
+    assert not (tmp_path / "ratchets/chat").exists()
@@ -0,0 +1,94 @@
+import sqlite3
+from pathlib import Path
+
+import pytest
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.crypto import SymmetricRatchet
+from app.util.keystore import DATABASE_NAME, Keystore, SqliteKeystore, open_keystore
+
+
+def test_open_keystore_picks_the_backend (tmp_path: Path) -> None:
+    assert isinstance(open_keystore(tmp_path), SqliteKeystore)
+    assert type(open_keystore(tmp_path, "files")) is Keystore
+
+def test_every_chat_lives_in_a_single_file (sqlite_keystore: SqliteKeystore) -> None:
+    for idx in range(50):
+        crypto.save_ratchets(f"chat-{idx}", {
+            "dh_ratchet": X25519PrivateKey.generate(),
+            "root_ratchet": SymmetricRatchet(b"\x01" * 32, idx)
+        })
+
+    assert not (sqlite_keystore.path / "ratchets").exists()
+    assert (sqlite_keystore.path / DATABASE_NAME).exists()
+    assert len(sqlite_keystore.list_records("ratchets")) == 50
+
+    ratchets = crypto.read_ratchets("chat-7")
+    assert ratchets["root_ratchet"].count == 7
+
+def test_update_and_delete_ratchets (sqlite_keystore: SqliteKeystore) -> None:
+    crypto.save_ratchets("chat", { "root_ratchet": SymmetricRatchet(b"\x01" * 32) })
+    crypto.save_ratchet("chat", "snd_ratchet", SymmetricRatchet(b"\x02" * 32), tmp=True)
+    crypto.delete_ratchet("chat", "root_ratchet")
+
+    assert sqlite_keystore.read_record("ratchets", "chat") is None
+    assert set(crypto.read_ratchets("chat", tmp=True)) == { "tmp-snd_ratchet" }
+
+def test_records_are_sealed (sqlite_keystore: SqliteKeystore) -> None:
+    crypto.save_ratchets("chat", { "root_ratchet": SymmetricRatchet(b"\x01" * 32) })
+
+    with sqlite3.connect(sqlite_keystore.path / DATABASE_NAME) as conn:
+        sealed = conn.execute("SELECT sealed FROM records").fetchone()[0]
+        assert b"\x01" * 32 not in sealed
+
+        # a record moved to another chat no longer opens
+        conn.execute("UPDATE records SET name = 'other'")
+
+    with pytest.raises(InvalidTag):
+        sqlite_keystore.read_record("ratchets", "other")
+
+def test_export_records (sqlite_keystore: SqliteKeystore) -> None:
+    for idx in range(10):
+        crypto.save_ratchets(f"chat-{idx}", { "root_ratchet": SymmetricRatchet(b"\x01" * 32, idx) })
+
+    exported = dict(sqlite_keystore.export_records("ratchets"))
+
+    assert len(exported) == 10
+    assert crypto.decode_ratchet(exported["chat-3"]["root_ratchet"]).count == 3
+
+def test_migrate_files_moves_the_sealed_records (tmp_path: Path) -> None:
+    files = Keystore(tmp_path)
+    files.write_record("ratchets", "chat", { "root_ratchet": (3, b"\x01" * 32) })
+    files.write_record("keys", "id_key", { "key": (1, b"\x02" * 32) })
+
+    keystore = SqliteKeystore(tmp_path)
+
+    assert keystore.migrate_files() == 2
+    assert keystore.read_record("ratchets", "chat") == { "root_ratchet": (3, b"\x01" * 32) }
+    assert keystore.read_record("keys", "id_key") == { "key": (1, b"\x02" * 32) }
+    assert list((tmp_path / "ratchets").glob("*.bin")) == []
+
+def test_clean_removes_the_database (sqlite_keystore: SqliteKeystore) -> None:
+    crypto.save_ratchets("chat", { "root_ratchet": SymmetricRatchet(b"\x01" * 32) })
+    crypto.save_private_key("id_key", X25519PrivateKey.generate())
+
+    sqlite_keystore.clean("keys")
+    assert sqlite_keystore.list_records("keys") == []
+
+    crypto.clean_keys()
+    assert not sqlite_keystore.path.exists()
+    assert sqlite_keystore.read_record("ratchets", "chat") is None
+
+def test_private_keys_are_written_and_cleaned_in_bulk (sqlite_keystore: SqliteKeystore) -> None:
+    crypto.save_private_keys({
+        f"{prefix}-chat{idx}-user": X25519PrivateKey.generate()
+        for idx in range(50) for prefix in ("eph", "dhr")
+    } | { "id_key": X25519PrivateKey.generate() })
+
+    assert len(sqlite_keystore.list_records("keys")) == 101
+
+    crypto.clean_chats_keys([ f"chat{idx}" for idx in range(50) ], "user")
+
+    assert sqlite_keystore.list_records("keys") == [ "id_key" ]
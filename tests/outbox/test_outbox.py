@@ -0,0 +1,133 @@
+import threading
+from collections.abc import Callable
+from unittest.mock import patch
+
+from app.util import jobs
+from app.util.jobs import JobQueue
+from app.util.keystore import SqliteKeystore
+from app.util.outbox import OUTBOX, Outbox
+
+
+def message (idx: int) -> dict:
+    return {
+        "telephone": "alice",
+        "body": { "cipher": bytes([idx]), "counter": idx, "chat_id": "0" * 24 }
+    }
+
+def test_jobs_are_loaded_in_order (sqlite_keystore: SqliteKeystore) -> None:
+    outbox = Outbox(window=0.0)
+    names = [ outbox.store({ "data": message(idx) }) for idx in range(20) ]
+
+    loaded = Outbox().load()
+
+    assert [ name for name, _ in loaded ] == names
+    assert [ stored["data"] for _, stored in loaded ] == [ message(idx) for idx in range(20) ]
+
+def test_names_go_on_after_a_restart (sqlite_keystore: SqliteKeystore) -> None:
+    first = Outbox(window=0.0).store({ "data": None })
+    second = Outbox(window=0.0).store({ "data": None })
+
+    assert second > first
+
+def test_jobs_stored_together_share_a_write (sqlite_keystore: SqliteKeystore) -> None:
+    outbox = Outbox(window=0.05)
+    barrier = threading.Barrier(8)
+
+    def store (idx: int) -> None:
+        barrier.wait()
+        outbox.store({ "data": message(idx) })
+
+    write_records = sqlite_keystore.write_records
+
+    with patch.object(sqlite_keystore, "write_records", wraps=write_records) as write:
+        workers = [ threading.Thread(target=store, args=(idx,)) for idx in range(8) ]
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+    assert write.call_count < 8
+    assert len(sqlite_keystore.list_records(OUTBOX)) == 8
+
+def test_acknowledged_jobs_are_removed (sqlite_keystore: SqliteKeystore) -> None:
+    outbox = Outbox(window=0.0)
+    names = [ outbox.store({ "data": None }) for _ in range(4) ]
+
+    outbox.ack(names[0])
+    outbox.ack_many(names[1:3])
+
+    assert [ name for name, _ in outbox.load() ] == names[3:]
+
+def test_queue_is_restored_until_acknowledged (sqlite_keystore: SqliteKeystore) -> None:
+    queue = JobQueue(outbox=Outbox(window=0.0))
+
+    for idx in range(3):
+        queue.add_job("user", 2, jobs.SendMessageJob, data=message(idx), chat_id="chat")
+
+    queue.add_job("user", 0, jobs.RefreshJob)
+
+    # only the jobs sent to the server survive the restart, in the same order
+    restarted = JobQueue(outbox=Outbox(window=0.0))
+    assert restarted.restore() == 3
+
+    acks = []
+    def emit (event: str, data: dict, callback: Callable = None) -> None:
+        acks.append((data, callback))
+
+    with patch("app.api.emit", side_effect=emit):
+        restarted.resolve_jobs("user")
+
+    assert [ data for data, _ in acks ] == [ message(idx) for idx in range(3) ]
+    assert len(restarted.outbox.load()) == 3
+
+    for _, callback in acks[:2]:
+        callback()
+
+    assert [ stored["data"] for _, stored in Outbox().load() ] == [ message(2) ]
+
+def test_failed_jobs_stay_on_the_outbox (sqlite_keystore: SqliteKeystore) -> None:
+    queue = JobQueue(outbox=Outbox(window=0.0))
+    queue.add_job("user", 1, jobs.CreateChatJob, data=message(0))
+
+    with patch("app.api.emit", side_effect=ValueError):
+        queue.resolve_jobs("user")
+
+    # never acknowledged by the server, so it is sent again on the next start
+    assert queue.pending("user") == 0
+    assert JobQueue(outbox=Outbox(window=0.0)).restore() == 1
+
+def test_durable_jobs_are_never_dropped (sqlite_keystore: SqliteKeystore) -> None:
+    queue = JobQueue(outbox=Outbox(window=0.0))
+    queue.add_job("user", 2, jobs.SendMessageJob, data=message(0), chat_id="chat")
+
+    with patch("app.api.emit", side_effect=ConnectionRefusedError):
+        for _ in range(jobs.MAX_RETRIES * 2):
+            queue.wake("user")
+            queue.resolve_jobs("user")
+
+    assert queue.pending("user") == 1
+    assert len(Outbox().load()) == 1
+
+def test_merged_jobs_acknowledge_every_record (sqlite_keystore: SqliteKeystore) -> None:
+    queue = JobQueue(outbox=Outbox(window=0.0))
+
+    for idx in range(3):
+        queue.add_job("user", 2, jobs.ConfirmMessageJob, data={
+            "body": {
+                "sender": { "telephone": "alice" },
+                "receiver": { "telephone": "bob", "chat_id": "0" * 24 },
+                "acks": [ idx ]
+            }
+        }, chat_id="chat")
+
+    assert len(Outbox().load()) == 3
+
+    sent = []
+    with patch("app.api.emit", side_effect=lambda event, data, callback: sent.append(callback)):
+        queue.resolve_jobs("user")
+
+    assert len(sent) == 1
+
+    sent[0]()
+    assert Outbox().load() == []
@@ -0,0 +1,80 @@
+import pytest
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.keystore import Keystore
+from app.util.prekeys import PrekeyPool
+
+
+def test_generate_stores_every_key_in_a_single_record (keystore: Keystore) -> None:
+    pool = PrekeyPool()
+    opkeys = pool.generate(300)
+
+    assert [ opkey["id"] for opkey in opkeys ] == list(range(1, 301))
+    assert keystore.list_records("prekeys") == [ "opk" ]
+    assert pool.available() == 300
+
+    for opkey in (opkeys[0], opkeys[-1]):
+        assert crypto.public_key(pool.load(opkey["id"])) == opkey["key"]
+
+def test_ids_are_never_reused (keystore: Keystore) -> None:
+    pool = PrekeyPool()
+    pool.generate(5)
+    pool.consume([ 4, 5 ])
+
+    assert [ opkey["id"] for opkey in pool.generate(2) ] == [ 6, 7 ]
+
+def test_ids_follow_the_legacy_keys (keystore: Keystore) -> None:
+    for idx in range(1, 11):
+        crypto.save_private_key(f"{idx}_opk", X25519PrivateKey.generate())
+
+    pool = PrekeyPool()
+
+    assert pool.generate(1)[0]["id"] == 11
+    assert isinstance(pool.load(3), X25519PrivateKey)
+
+def test_consume_removes_the_used_keys (keystore: Keystore) -> None:
+    crypto.save_private_key("1_opk", X25519PrivateKey.generate())
+
+    pool = PrekeyPool()
+    pool.generate(3)
+    pool.consume([ 1, 2 ])
+
+    assert pool.available() == 2
+    assert keystore.read_record("keys", "1_opk") is None
+
+    with pytest.raises(FileNotFoundError):
+        pool.load(2)
+
+def test_replenish_uploads_a_single_batch (keystore: Keystore) -> None:
+    pool = PrekeyPool(batch_size=100, low_water=20)
+    pool.generate(10)
+    uploads = []
+
+    assert pool.replenish(uploads.append) == 90
+    assert len(uploads) == 1 and len(uploads[0]) == 90
+    assert pool.available() == 100
+
+    assert pool.replenish(uploads.append) == 0
+    assert len(uploads) == 1
+
+def test_failed_upload_keeps_the_batch (keystore: Keystore) -> None:
+    pool = PrekeyPool(batch_size=100, low_water=20)
+    pool.generate(10)
+    uploads = []
+
+    def upload (opkeys: list) -> None:
+        uploads.append(opkeys)
+        raise ConnectionRefusedError
+
+    with pytest.raises(ConnectionRefusedError):
+        pool.replenish(upload)
+
+    assert pool.available() == 10
+    assert pool.low()
+
+    # the next refill uploads the same keys, without generating new ones
+    assert pool.replenish(uploads.append) == 90
+    assert uploads[1] == uploads[0]
+    assert pool.available() == 100
+    assert pool.pending() == []
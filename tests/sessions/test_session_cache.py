@@ -0,0 +1,169 @@
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.crypto import SkippedKeys, SymmetricRatchet
+from app.util.journal import RatchetJournal
+from app.util.keystore import Keystore
+from app.util.sessions import SessionCache
+
+
+@pytest.fixture
+def session () -> dict[str, crypto.Ratchet | str]:
+    return {
+        "dh_ratchet": X25519PrivateKey.generate(),
+        "root_ratchet": SymmetricRatchet(b"\x01" * 32),
+        "user_ratchet": crypto.public_key(X25519PrivateKey.generate())
+    }
+
+def save_session (
+    cache: SessionCache, chat_id: str, session: dict[str, crypto.Ratchet | str]
+) -> None:
+    for ratchet_name, ratchet in session.items():
+        cache.save_ratchet(chat_id, ratchet_name, ratchet)
+
+def test_save_ratchet_does_not_write_before_flush (
+    keystore: Keystore, session: dict
+) -> None:
+    cache = SessionCache()
+    save_session(cache, "chat", session)
+
+    assert keystore.read_record("ratchets", "chat") is None
+
+    ratchets, pbkey = cache.load_ratchets("chat")
+
+    assert crypto.public_key(pbkey) == session["user_ratchet"]
+    assert ratchets["root_ratchet"].state == session["root_ratchet"].state
+
+def test_flush_writes_ratchets_to_disk (keystore: Keystore, session: dict) -> None:
+    cache = SessionCache()
+    save_session(cache, "chat", session)
+
+    assert cache.flush() == 3
+    assert cache.flush() == 0
+
+    ratchets, pbkey = crypto.load_ratchets("chat")
+
+    assert crypto.public_key(pbkey) == session["user_ratchet"]
+    assert ratchets["root_ratchet"].state == session["root_ratchet"].state
+
+def test_load_ratchets_returns_copies (keystore: Keystore, session: dict) -> None:
+    cache = SessionCache()
+    save_session(cache, "chat", session)
+
+    ratchets, _ = cache.load_ratchets("chat")
+    ratchets["root_ratchet"].next()
+
+    cached_ratchets, _ = cache.load_ratchets("chat")
+
+    assert cached_ratchets["root_ratchet"].state == session["root_ratchet"].state
+
+def test_unchanged_skipped_keys_are_not_written_again (
+    keystore: Keystore, session: dict
+) -> None:
+    cache = SessionCache()
+    save_session(cache, "chat", session | { "skipped_keys": SkippedKeys() })
+    cache.flush()
+
+    ratchets, pbkey = cache.load_ratchets("chat")
+    ratchets["root_ratchet"].next()
+    cache.save_ratchets("chat", ratchets | { "user_ratchet": pbkey })
+
+    assert ("chat", "root_ratchet", False) in cache.pending
+    assert ("chat", "skipped_keys", False) not in cache.pending
+
+def test_evicted_session_keeps_unflushed_changes (
+    keystore: Keystore, session: dict
+) -> None:
+    cache = SessionCache(max_size=1)
+    save_session(cache, "chat", session)
+    save_session(cache, "other-chat", session)
+
+    assert len(cache.sessions) == 1
+
+    ratchets, pbkey = cache.load_ratchets("chat")
+
+    assert crypto.public_key(pbkey) == session["user_ratchet"]
+    assert ratchets["root_ratchet"].state == session["root_ratchet"].state
+
+def test_delete_ratchet_removes_file_on_flush (keystore: Keystore, session: dict) -> None:
+    cache = SessionCache()
+    save_session(cache, "chat", session)
+    cache.save_ratchet("chat", "root_ratchet", session["root_ratchet"], tmp=True)
+    cache.flush()
+
+    cache.delete_ratchet("chat", "root_ratchet", tmp=True)
+
+    assert keystore.read_record("ratchets", "tmp-chat") is not None
+
+    cache.flush()
+
+    assert keystore.read_record("ratchets", "tmp-chat") is None
+    assert cache.load_ratchets("chat", tmp=True) == ({}, None)
+
+def test_fill_lookahead_fills_only_the_message_chains (
+    keystore: Keystore, session: dict
+) -> None:
+    cache = SessionCache(lookahead=4)
+    save_session(cache, "chat", session | { "snd_ratchet": SymmetricRatchet(b"\x02" * 32) })
+
+    assert cache.fill_lookahead() == 4
+
+    cached = cache.sessions[("chat", False)]
+    assert len(cached["snd_ratchet"].lookahead) == 4
+    assert len(cached["root_ratchet"].lookahead) == 0
+
+    ratchets, _ = cache.load_ratchets("chat")
+    assert len(ratchets["snd_ratchet"].lookahead) == 4
+
+def test_clear_wipes_the_lookahead (keystore: Keystore, session: dict) -> None:
+    cache = SessionCache(lookahead=4)
+    save_session(cache, "chat", session | { "snd_ratchet": SymmetricRatchet(b"\x02" * 32) })
+    cache.fill_lookahead()
+
+    chain = cache.sessions[("chat", False)]["snd_ratchet"]
+    outputs = list(chain.lookahead)
+    cache.clear()
+
+    assert len(chain.lookahead) == 0
+    assert all(output == bytes(80) for output in outputs)
+
+def test_save_sessions_waits_for_a_single_commit (
+    keystore: Keystore, session: dict, tmp_path: Path
+) -> None:
+    cache = SessionCache(journal=RatchetJournal(tmp_path / "journal"))
+
+    with patch.object(RatchetJournal, "wait", autospec=True) as mock_wait:
+        cache.save_sessions({ f"chat-{idx}": session for idx in range(20) })
+
+        mock_wait.assert_called_once_with(cache.journal, 20)
+
+    cache.journal.close()
+    assert len(cache.journal.recover()) == 20
+    assert crypto.public_key(cache.load_ratchets("chat-7")[1]) == session["user_ratchet"]
+
+def test_consumed_keys_are_not_left_in_memory (keystore: Keystore, session: dict) -> None:
+    cache = SessionCache(lookahead=4)
+    save_session(cache, "chat", session | { "snd_ratchet": SymmetricRatchet(b"\x02" * 32) })
+    cache.fill_lookahead()
+    replaced = cache.sessions[("chat", False)]["snd_ratchet"]
+
+    ratchets, _ = cache.load_ratchets("chat")
+    key, _ = ratchets["snd_ratchet"].next()
+    cache.save_ratchets("chat", ratchets)
+
+    chains = [
+        replaced, ratchets["snd_ratchet"], cache.sessions[("chat", False)]["snd_ratchet"],
+        *cache.pending.values()
+    ]
+    outputs = [
+        bytes(output) for chain in chains if isinstance(chain, SymmetricRatchet)
+        for output in chain.lookahead
+    ]
+
+    # the three keys left ahead live only on the cached chain
+    assert len(outputs) == 3
+    assert not any(key in output for output in outputs)
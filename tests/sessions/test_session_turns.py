@@ -0,0 +1,61 @@
+import pytest
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto
+from app.util.crypto import MessageHeader, create_chat_encryption, rcv_msg, snd_msg
+from app.util.keystore import Keystore
+from app.util.sessions import SessionCache
+
+
+@pytest.fixture
+def cache (keystore: Keystore) -> SessionCache:
+    yield SessionCache()
+
+@pytest.fixture
+def chat (cache: SessionCache) -> None:
+    # the x3dh keys of alice and bob, bob's signed prekey starting his dh ratchet
+    alice = { "IK": X25519PrivateKey.generate(), "EK": X25519PrivateKey.generate() }
+    bob = {
+        "IK": X25519PrivateKey.generate(), "SPK": X25519PrivateKey.generate(),
+        "OPK": X25519PrivateKey.generate()
+    }
+    public_keys = lambda keys: { name: key.public_key() for name, key in keys.items() }
+
+    cache.save_ratchets("alice", {
+        "dh_ratchet": X25519PrivateKey.generate(),
+        "root_ratchet": create_chat_encryption(alice, public_keys(bob), True),
+        "user_ratchet": crypto.public_key(bob["SPK"])
+    })
+    cache.save_ratchets("bob", {
+        "dh_ratchet": bob["SPK"],
+        "root_ratchet": create_chat_encryption(bob, public_keys(alice), False)
+    })
+
+def send (cache: SessionCache, sender: str, receiver: str, msg: bytes) -> MessageHeader:
+    # each side goes through the cache and the keystore, as the events of the app do
+    ratchets, pbkey = cache.load_ratchets(sender)
+    ratchets["user_ratchet"] = pbkey
+
+    cipher, header = snd_msg(ratchets, pbkey, msg)
+    cache.save_ratchets(sender, ratchets)
+
+    ratchets, pbkey = cache.load_ratchets(receiver)
+    ratchets["user_ratchet"] = pbkey
+
+    assert rcv_msg(ratchets, header, cipher) == msg
+    cache.save_ratchets(receiver, ratchets)
+
+    cache.flush()
+    cache.clear()
+
+    return header
+
+def test_dh_ratchet_rotates_on_every_turn (cache: SessionCache, chat: None) -> None:
+    first = send(cache, "alice", "bob", b"first")
+    second = send(cache, "alice", "bob", b"second")
+    send(cache, "bob", "alice", b"reply")
+    third = send(cache, "alice", "bob", b"third")
+
+    assert second.dh_ratchet == first.dh_ratchet
+    assert third.dh_ratchet != first.dh_ratchet
+    assert "snd_ratchet" not in crypto.keystore.read_record("ratchets", "bob")
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+from app.util import crypto, wire
+
+
+@pytest.fixture
+def message () -> dict:
+    return {
+        "Signed-Message": crypto.sign_message(Ed25519PrivateKey.generate()),
+        "telephone": "5511999999999",
+        "body": {
+            "sender": { "telephone": "5511999999999", "chat_id": "6571a0c3e4b0f1a2b3c4d5e6" },
+            "receiver": { "telephone": "5511888888888", "chat_id": "6571a0c3e4b0f1a2b3c4d5e7" },
+            "message_id": "6571a0c3e4b0f1a2b3c4d5e8",
+            "cipher": bytes(range(256)) * 4,
+            "dh_ratchet": crypto.public_key(X25519PrivateKey.generate()),
+            "counter": 12,
+            "mode": crypto.GCM_MODE,
+            "acks": [ "a", None, True, False, -3, 0.5 ]
+        }
+    }
+
+def test_binary_envelope_round_trip (message: dict) -> None:
+    assert wire.decode(wire.encode(message)) == message
+
+def test_keys_are_sent_as_raw_bytes (message: dict) -> None:
+    payload = wire.encode(message)
+
+    assert message["body"]["dh_ratchet"].encode("utf-8") not in payload
+    assert crypto.encode_b64(message["body"]["dh_ratchet"]) in payload
+
+def test_binary_envelope_is_smaller_than_json (message: dict) -> None:
+    json_payload = json.dumps(wire.to_json(message)).encode("utf-8")
+
+    assert len(wire.encode(message)) < len(json_payload) * 0.8
+
+def test_to_json_matches_the_base64_of_crypto (message: dict) -> None:
+    converted = wire.to_json(message)
+
+    assert converted["body"]["cipher"] == crypto.decode_b64(message["body"]["cipher"])
+    assert converted["body"]["dh_ratchet"] == message["body"]["dh_ratchet"]
+
+def test_payload_keeps_json_responses () -> None:
+    resp = { "msg": "ok", "status": "ok" }
+
+    assert wire.payload(resp) is resp
+    assert wire.payload(wire.encode(resp)) == resp
+
+def test_unsupported_values_raise () -> None:
+    with pytest.raises(TypeError):
+        wire.encode({ "value": object() })
+
+    with pytest.raises(ValueError):
+        wire.decode(b"\xff")
+
+@pytest.mark.parametrize(
+    "formats,expected", [
+        ([ "json", "binary" ], "binary"), ([ "json" ], "json"), ([ "" ], "json"), ([], "json")
+    ]
+)
+def test_negotiate_wire (formats: list[str], expected: str) -> None:
+    assert wire.negotiate_wire(formats) == expected
+
+def test_unknown_fields_and_ids_keep_their_names () -> None:
+    data = { "custom": { "chat_id": "not an object id", "message_id": "6571a0c3e4b0f1a2b3c4d5e8" } }
+
+    assert wire.decode(wire.encode(data)) == data